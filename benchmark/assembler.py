@@ -0,0 +1,145 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional
+
+from compiler.assembler import Assembler, Tokenizer
+
+
+# Every workload is a list of source chunks, each chunk is processed as its own section so the linker has to place
+# them. Chunks are kept well below the size of a rom bank.
+CHUNK_LINES = 500
+
+
+def chunked(lines: List[str], header: str = "") -> List[str]:
+    return [header + "".join(lines[n:n + CHUNK_LINES]) for n in range(0, len(lines), CHUNK_LINES)]
+
+
+def straight_line(size: int) -> List[str]:
+    lines = []
+    for n in range(size):
+        lines.append(f"    ld a, {n & 0xFF}\n    ld [$C000 + {n & 0x7F}], a\n    inc hl\n    add a, b\n")
+    return chunked(lines)
+
+
+MACRO_HEADER = r"""
+#MACRO store
+    ld a, \2
+    ld [\1], a
+#END
+#MACRO store16
+    store \1, \2 & $FF
+    store \1 + 1, \2 >> 8
+#END
+"""
+
+
+def macro_heavy(size: int) -> List[str]:
+    return chunked([f"    store16 $C000 + {n & 0x7F}, {n & 0xFFFF}\n" for n in range(size)], MACRO_HEADER)
+
+
+def labels_and_jumps(size: int) -> List[str]:
+    lines = []
+    for n in range(size):
+        lines.append(f"bench_label_{n}:\n    dec a\n    jr nz, bench_label_{n}\n    jp bench_label_{n - n % 16}\n")
+    return chunked(lines)
+
+
+def data_tables(size: int) -> List[str]:
+    lines = []
+    for n in range(size):
+        values = ", ".join(str((n + m) & 0xFF) for m in range(16))
+        lines.append(f"    db {values}\n")
+    return chunked(lines)
+
+
+def small_sections(size: int) -> List[str]:
+    return [f"bench_func_{n}:\n    ld a, {n & 0xFF}\n    call bench_func_{n // 2}\n    ret\n" for n in range(size)]
+
+
+WORKLOADS: Dict[str, Callable[[int], List[str]]] = {
+    "straight-line": straight_line,
+    "macro-heavy": macro_heavy,
+    "labels-and-jumps": labels_and_jumps,
+    "data-tables": data_tables,
+    "small-sections": small_sections,
+}
+
+
+def measure(chunks: List[str], repeat: int) -> Dict[str, float]:
+    """Run the tokenize, process and link phases over the chunks, keep the best time of each phase."""
+    best = {"tokenize": float("inf"), "process": float("inf"), "link": float("inf")}
+    tokens = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens = sum(len(Tokenizer.tokenize(chunk)) for chunk in chunks)
+        best["tokenize"] = min(best["tokenize"], time.perf_counter() - start)
+
+        asm = Assembler()
+        start = time.perf_counter()
+        for chunk in chunks:
+            asm.process(chunk, base_address=-2)
+        best["process"] = min(best["process"], time.perf_counter() - start)
+
+        start = time.perf_counter()
+        asm.link()
+        best["link"] = min(best["link"], time.perf_counter() - start)
+    result = {"tokens": tokens, "sections": len(chunks)}
+    result.update(best)
+    result["tokens_per_second"] = tokens / best["tokenize"]
+    result["total"] = best["process"] + best["link"]
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size: int, repeat: int, names: List[str]) -> Dict:
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "size": size,
+        "repeat": repeat,
+        "workloads": {name: measure(WORKLOADS[name](size), repeat) for name in names},
+    }
+
+
+def report(results: Dict, baseline: Optional[Dict] = None) -> None:
+    print(f"revision {results['revision']}, python {results['python']}, size {results['size']}")
+    print(f"{'workload':<18} {'tokens':>8} {'Mtok/s':>7} {'tokenize':>9} {'process':>9} {'link':>9} {'total':>9}" + (f" {'change':>7}" if baseline else ""))
+    for name, w in results["workloads"].items():
+        line = f"{name:<18} {w['tokens']:>8} {w['tokens_per_second'] / 1e6:>7.2f} {w['tokenize']:>8.3f}s {w['process']:>8.3f}s {w['link']:>8.3f}s {w['total']:>8.3f}s"
+        if baseline:
+            old = baseline["workloads"].get(name)
+            line += f" {(w['total'] / old['total'] - 1) * 100:>+6.1f}%" if old else f" {'-':>7}"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the assembler tokenize, process and link phases")
+    parser.add_argument("--size", type=int, default=10000, help="number of generated items per workload")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per workload, the best time is reported")
+    parser.add_argument("--workload", action="append", choices=list(WORKLOADS), help="only run the given workloads")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--compare", help="json results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = run(args.size, args.repeat, args.workload or list(WORKLOADS))
+    baseline = None
+    if args.compare:
+        with open(args.compare, "rt") as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
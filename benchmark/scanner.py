@@ -0,0 +1,52 @@
+import time
+from typing import Callable, List, Tuple
+
+from compiler.scanner import Scanner
+
+
+def const_block(lines: int) -> str:
+    return "".join(f"const VALUE_{n}: u16 = 0x{n & 0xFFFF:04x} + {n} << 2 ; generated\n" for n in range(lines))
+
+
+def data_table(lines: int) -> str:
+    result = ["fn table\n"]
+    for n in range(lines):
+        result.append(f"    a = {n & 0xFF} + 0b1010 * ({n} - b) >= c && d != 0\n")
+        if n % 8 == 0:
+            result.append("\n    ; section break\n")
+    return "".join(result)
+
+
+def scan(code: str) -> int:
+    scanner = Scanner("benchmark", code)
+    count = 0
+    while scanner:
+        scanner.advance()
+        count += 1
+    return count
+
+
+def measure(func: Callable[[str], int], code: str) -> Tuple[int, float]:
+    start = time.perf_counter()
+    count = func(code)
+    return count, time.perf_counter() - start
+
+
+def run(sizes: List[int]) -> List[Tuple[str, int, int, float]]:
+    results = []
+    for size in sizes:
+        for name, generate in (("const", const_block), ("table", data_table)):
+            tokens, duration = measure(scan, generate(size))
+            results.append((name, size, tokens, duration))
+    return results
+
+
+def main() -> None:
+    sizes = [10000, 50000, 100000]
+    print(f"{'source':>8} {'lines':>8} {'tokens':>8} {'scan':>10} {'ns/token':>9}")
+    for name, size, tokens, duration in run(sizes):
+        print(f"{name:>8} {size:>8} {tokens:>8} {duration:>9.3f}s {duration / tokens * 1e9:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+from compiler.assembler import Assembler, Tokenizer
+
+
+MACRO_HEADER = r"""
+#MACRO store
+    ld [\1], a
+#END
+"""
+
+
+def synthetic_source(lines: int) -> str:
+    result = [MACRO_HEADER]
+    for n in range(lines // 4):
+        result.append(f"label_{n}:\n")
+        result.append(f"    ld a, {n & 0xFF} ; comment\n")
+        result.append(f"    store $C000 + {n & 0xFF}\n")
+        result.append(f"    jr label_{n}\n")
+    return "".join(result)
+
+
+def lex(code: str) -> int:
+    return len(Tokenizer.tokenize(code))
+
+
+def lexed_memory(code: str) -> int:
+    tracemalloc.start()
+    tokens = Tokenizer.tokenize(code)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del tokens
+    return size
+
+
+def drain_tokenizer(code: str) -> int:
+    tok = Tokenizer(code)
+    count = 0
+    while tok:
+        tok.pop()
+        count += 1
+    return count
+
+
+def assemble(code: str) -> int:
+    asm = Assembler()
+    asm.process(code, base_address=0x0000, bank=0)
+    return sum(len(section.data) for section in asm.getSections())
+
+
+def measure(func: Callable[[str], int], code: str) -> float:
+    start = time.perf_counter()
+    func(code)
+    return time.perf_counter() - start
+
+
+def run(sizes: List[int]) -> List[Tuple[int, float, float, float, int]]:
+    results = []
+    for size in sizes:
+        code = synthetic_source(size)
+        results.append((size, measure(lex, code), measure(drain_tokenizer, code), measure(assemble, code), lexed_memory(code)))
+    return results
+
+
+def main() -> None:
+    sizes = [12500, 25000, 50000, 100000]
+    results = run(sizes)
+    print(f"{'lines':>8} {'lex':>10} {'tokens':>8} {'tokenize':>10} {'us/line':>8} {'process':>10} {'us/line':>8}")
+    for size, lex_time, tok_time, asm_time, memory in results:
+        print(f"{size:>8} {lex_time:>9.3f}s {memory / size:>6.0f}B/l {tok_time:>9.3f}s {tok_time / size * 1e6:>8.2f} {asm_time:>9.3f}s {asm_time / size * 1e6:>8.2f}")
+    # With a linear token stream the time per line stays flat when the input grows.
+    first, last = results[0], results[-1]
+    print(f"scaling {last[0] / first[0]:.0f}x lines: tokenize {last[2] / first[2]:.1f}x, process {last[3] / first[3]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
+import array
 import binascii
-from typing import Optional, Dict, Iterator, List, Union, Tuple, Generator
+import bisect
+import functools
+import sys
+from typing import Optional, Callable, Dict, Iterable, Iterator, List, Sequence, Set, Union, Tuple, Generator
 
 import re
 import os
+import weakref
 
 
 REGS8 = {"A": 7, "B": 0, "C": 1, "D": 2, "E": 3, "H": 4, "L": 5, "[HL]": 6}
@@ -12,16 +17,226 @@ FLAGS = {"NZ": 0x00, "Z": 0x08, "NC": 0x10, "C": 0x18}
 
 JP_TO_JR = {0xC3: 0x18, 0xC2: 0x20, 0xD2: 0x30, 0xCA: 0x28, 0xDA: 0x38}
 
+# Every instruction operand is reduced to a key before the encoding lookup. Registers and conditions are keyed by
+# their name, memory references to registers by their bracketed name, everything else is an expression "n" or a
+# memory reference to an expression "[n]".
+OPERAND_KEYS = {name: name for name in ("A", "B", "C", "D", "E", "H", "L", "BC", "DE", "HL", "SP", "AF", "NZ", "Z", "NC")}
+REF_OPERAND_KEYS = {name: f"[{name}]" for name in ("BC", "DE", "HL", "HL+", "HL-", "C")}
+
+# Operand patterns that match a group of registers or conditions, with the bits each one adds to the opcode.
+OPERAND_PATTERNS = {
+    "r8": dict(REGS8),
+    "r8<<3": {name: value << 3 for name, value in REGS8.items()},
+    "r16a<<4": {name: value << 4 for name, value in REGS16A.items()},
+    "r16b<<4": {name: value << 4 for name, value in REGS16B.items()},
+    "cc": dict(FLAGS),
+}
+# Operand patterns that match an expression, with the operand key they match. The pattern name is the relocation
+# kind of the immediate that is emitted after the opcode, or a field that is or-ed into the opcode.
+IMMEDIATE_PATTERNS = {
+    "n8": "n",
+    "n16": "n",
+    "rel8": "n",
+    "jpr16": "n",
+    "[n16]": "[n]",
+    "[high8]": "[n]",
+    "bit<<3": "n",
+    "rst": "n",
+}
+OPCODE_FIELD_PATTERNS = {"bit<<3", "rst"}
+
+ALU_INSTR = {"ADD": 0x80, "ADC": 0x88, "SUB": 0x90, "SBC": 0x98, "AND": 0xA0, "XOR": 0xA8, "OR": 0xB0, "CP": 0xB8}
+CB_INSTR = {"RLC": 0xCB00, "RRC": 0xCB08, "RL": 0xCB10, "RR": 0xCB18, "SLA": 0xCB20, "SRA": 0xCB28, "SWAP": 0xCB30, "SRL": 0xCB38}
+BIT_INSTR = {"BIT": 0xCB40, "RES": 0xCB80, "SET": 0xCBC0}
+
+# SM83 encodings as (mnemonic, operand patterns, opcode template). Opcode templates above 0xFF are CB prefixed.
+# When patterns overlap the first entry wins. Any other operand pattern is literal and has to match the operand key.
+SM83_ENCODINGS: List[Tuple[str, Tuple[str, ...], int]] = [
+    ("NOP", (), 0x00),
+    ("RLCA", (), 0x07),
+    ("RRCA", (), 0x0F),
+    ("STOP", (), 0x10),
+    ("RLA", (), 0x17),
+    ("RRA", (), 0x1F),
+    ("DAA", (), 0x27),
+    ("CPL", (), 0x2F),
+    ("SCF", (), 0x37),
+    ("CCF", (), 0x3F),
+    ("HALT", (), 0x76),
+    ("RETI", (), 0xD9),
+    ("DI", (), 0xF3),
+    ("EI", (), 0xFB),
+
+    ("LD", ("r8<<3", "r8"), 0x40),
+    ("LD", ("A", "[BC]"), 0x0A),
+    ("LD", ("A", "[DE]"), 0x1A),
+    ("LD", ("A", "[HL+]"), 0x2A),
+    ("LD", ("A", "[HL-]"), 0x3A),
+    ("LD", ("A", "[C]"), 0xF2),
+    ("LD", ("A", "[n16]"), 0xFA),
+    ("LD", ("[BC]", "A"), 0x02),
+    ("LD", ("[DE]", "A"), 0x12),
+    ("LD", ("[HL+]", "A"), 0x22),
+    ("LD", ("[HL-]", "A"), 0x32),
+    ("LD", ("[C]", "A"), 0xE2),
+    ("LD", ("[n16]", "A"), 0xEA),
+    ("LD", ("SP", "HL"), 0xF9),
+    ("LD", ("r16a<<4", "n16"), 0x01),
+    ("LD", ("[n16]", "SP"), 0x08),
+    ("LD", ("r8<<3", "n8"), 0x06),
+    ("LDH", ("A", "[C]"), 0xF2),
+    ("LDH", ("A", "[high8]"), 0xF0),
+    ("LDH", ("[C]", "A"), 0xE2),
+    ("LDH", ("[high8]", "A"), 0xE0),
+    ("LDI", ("A", "[HL]"), 0x2A),
+    ("LDI", ("[HL]", "A"), 0x22),
+    ("LDD", ("A", "[HL]"), 0x3A),
+    ("LDD", ("[HL]", "A"), 0x32),
+
+    ("INC", ("r8<<3",), 0x04),
+    ("INC", ("r16a<<4",), 0x03),
+    ("DEC", ("r8<<3",), 0x05),
+    ("DEC", ("r16a<<4",), 0x0B),
+    ("ADD", ("HL", "r16a<<4"), 0x09),
+    ("ADD", ("SP", "n8"), 0xE8),
+    *[(name, ("A", "r8"), code) for name, code in ALU_INSTR.items()],
+    *[(name, ("A", "n8"), code | 0x46) for name, code in ALU_INSTR.items()],
+    *[(name, ("r8",), code) for name, code in ALU_INSTR.items()],
+    *[(name, ("n8",), code | 0x46) for name, code in ALU_INSTR.items()],
+    *[(name, ("r8",), code) for name, code in CB_INSTR.items()],
+    *[(name, ("bit<<3", "r8"), code) for name, code in BIT_INSTR.items()],
+
+    ("RET", (), 0xC9),
+    ("RET", ("cc",), 0xC0),
+    ("CALL", ("n16",), 0xCD),
+    ("CALL", ("cc", "n16"), 0xC4),
+    ("JP", ("HL",), 0xE9),
+    ("JP", ("n16",), 0xC3),
+    ("JP", ("cc", "n16"), 0xC2),
+    ("JR", ("rel8",), 0x18),
+    ("JR", ("cc", "rel8"), 0x20),
+    ("JPR", ("jpr16",), 0xC3),
+    ("JPR", ("cc", "jpr16"), 0xC2),
+    ("RST", ("rst",), 0xC7),
+    ("PUSH", ("r16b<<4",), 0xC5),
+    ("POP", ("r16b<<4",), 0xC1),
+]
+
+
+class Encoding:
+    __slots__ = ("opcode", "fields", "immediates")
+
+    def __init__(self, opcode: int, fields: Tuple[Tuple[int, str], ...], immediates: Tuple[Tuple[int, str], ...]) -> None:
+        self.opcode = opcode
+        self.fields = fields
+        self.immediates = immediates
+
+    def __repr__(self) -> str:
+        return f"Encoding({self.opcode:02x}, {self.fields}, {self.immediates})"
+
+
+def compileEncodings(table: List[Tuple[str, Tuple[str, ...], int]]) -> Dict[str, Dict[Tuple[str, ...], Encoding]]:
+    """Expand the encoding table into a lookup per mnemonic, keyed by the operand keys of an instruction.
+    Register bits are folded into the opcode here, so only expression operands need work while assembling."""
+    valid_keys = set(OPERAND_KEYS.values()) | set(REF_OPERAND_KEYS.values())
+    result: Dict[str, Dict[Tuple[str, ...], Encoding]] = {}
+    for mnemonic, patterns, template in table:
+        variants: List[Tuple[Tuple[str, ...], int, Tuple[Tuple[int, str], ...]]] = [((), template, ())]
+        for idx, pattern in enumerate(patterns):
+            if pattern in OPERAND_PATTERNS:
+                choices = [(key, value, ()) for key, value in OPERAND_PATTERNS[pattern].items()]
+            elif pattern in IMMEDIATE_PATTERNS:
+                choices = [(IMMEDIATE_PATTERNS[pattern], 0, ((idx, pattern),))]
+            else:
+                assert pattern in valid_keys, pattern
+                choices = [(pattern, 0, ())]
+            variants = [(keys + (key,), opcode | value, operands + operand) for keys, opcode, operands in variants for key, value, operand in choices]
+        encodings = result.setdefault(mnemonic, {})
+        for keys, opcode, operands in variants:
+            if keys not in encodings:
+                fields = tuple(operand for operand in operands if operand[1] in OPCODE_FIELD_PATTERNS)
+                immediates = tuple(operand for operand in operands if operand[1] not in OPCODE_FIELD_PATTERNS)
+                encodings[keys] = Encoding(opcode, fields, immediates)
+    return result
+
+
+# Opcode groups for the peephole optimizer, CB prefixed opcodes are written as 0xCBxx.
+IMMEDIATE_SIZES = {"n8": 1, "n16": 2, "rel8": 1, "jpr16": 2, "[n16]": 2, "[high8]": 1}
+FLAG_READERS = {
+    0x20, 0x28, 0x30, 0x38, 0xC0, 0xC8, 0xD0, 0xD8, 0xC2, 0xCA, 0xD2, 0xDA, 0xC4, 0xCC, 0xD4, 0xDC,  # Conditions
+    0x17, 0x1F, 0x27, 0x3F, 0xF5, 0xCE, 0xDE, *range(0x88, 0x90), *range(0x98, 0xA0), *range(0xCB10, 0xCB20),
+}
+FLAG_WRITERS = {  # Instructions that set all flags without reading them
+    *range(0x80, 0x88), *range(0x90, 0x98), *range(0xA0, 0xC0), 0xC6, 0xD6, 0xE6, 0xEE, 0xF6, 0xFE, 0xF1, 0xE8, 0xF8,
+    *range(0xCB00, 0xCB10), *range(0xCB20, 0xCB40),
+}
+CONTROL_FLOW = {
+    0x18, 0x20, 0x28, 0x30, 0x38, 0xC3, 0xC2, 0xCA, 0xD2, 0xDA, 0xCD, 0xC4, 0xCC, 0xD4, 0xDC,
+    0xC9, 0xC0, 0xC8, 0xD0, 0xD8, 0xD9, 0xE9, 0xC7, 0xCF, 0xD7, 0xDF, 0xE7, 0xEF, 0xF7, 0xFF, 0x76, 0x10,
+}
+JUMPS = {0xC3, 0xC2, 0xCA, 0xD2, 0xDA, 0x18, 0x20, 0x28, 0x30, 0x38}
+CALL_TO_JP = {0xCD: 0xC3, 0xC4: 0xC2, 0xCC: 0xCA, 0xD4: 0xD2, 0xDC: 0xDA}
+
+
+# M-cycles of branches as (unconditional, (taken, not taken) when conditional).
+BRANCH_CYCLES = {"JP": (4, (4, 3)), "JR": (3, (3, 2)), "CALL": (6, (6, 3)), "RET": (4, (5, 2))}
+# Instructions that read and write their memory operand.
+READ_MODIFY_WRITE = {"INC", "DEC", "RLC", "RRC", "RL", "RR", "SLA", "SRA", "SWAP", "SRL", "RES", "SET"}
+# Stack accesses and internal delays, on top of fetching the instruction and accessing memory operands.
+EXTRA_CYCLES = {
+    "PUSH": 3, "POP": 2, "RST": 3, "RETI": 3,
+    ("LD", ("SP", "HL")): 1, ("ADD", ("SP", "n")): 2,
+    **{("ADD", ("HL", reg)): 1 for reg in REGS16A},
+    **{(mnemonic, (reg,)): 1 for mnemonic in ("INC", "DEC") for reg in REGS16A},
+}
+
+
+def opcodeVariants(instructions: Dict[str, Dict[Tuple[str, ...], Encoding]]) -> Iterator[Tuple[int, str, Tuple[str, ...], Encoding]]:
+    """Every opcode the assembler can emit, with the mnemonic, operand keys and encoding that emit it."""
+    for mnemonic, encodings in instructions.items():
+        for keys, encoding in encodings.items():
+            opcodes = [encoding.opcode]
+            for idx, kind in encoding.fields:
+                opcodes = [opcode | (value << 3 if kind == "bit<<3" else value) for opcode in opcodes for value in (range(8) if kind == "bit<<3" else range(0, 0x40, 8))]
+            for opcode in opcodes:
+                yield opcode, mnemonic, keys, encoding
+
+
+def opcodeSizes(instructions: Dict[str, Dict[Tuple[str, ...], Encoding]]) -> Dict[int, int]:
+    """Instruction size for every opcode the assembler can emit."""
+    result: Dict[int, int] = {}
+    for opcode, mnemonic, keys, encoding in opcodeVariants(instructions):
+        result[opcode] = (2 if encoding.opcode > 0xFF else 1) + sum(IMMEDIATE_SIZES[kind] for idx, kind in encoding.immediates)
+    return result
+
+
+def instructionCycles(mnemonic: str, keys: Tuple[str, ...], size: int) -> Tuple[int, int]:
+    """M-cycles of an instruction as (taken, not taken), which only differ for conditional branches."""
+    if mnemonic in BRANCH_CYCLES and keys != ("HL",):
+        unconditional, conditional = BRANCH_CYCLES[mnemonic]
+        if len(keys) > (0 if mnemonic == "RET" else 1):
+            return conditional
+        return unconditional, unconditional
+    memory = sum(1 for key in keys if key.startswith("["))
+    if memory and mnemonic in READ_MODIFY_WRITE or keys == ("[n]", "SP"):
+        memory = 2
+    cycles = size + memory + EXTRA_CYCLES.get(mnemonic, 0) + EXTRA_CYCLES.get((mnemonic, keys), 0)
+    return cycles, cycles
+
 
 class ExprBase:
-    def asReg8(self) -> Optional[int]:
-        return None
+    __slots__ = ()
+
+    def operandKey(self) -> str:
+        return "n"
 
     def isA(self, kind: str, value: Optional[str] = None) -> bool:
         return False
 
 
 class Token(ExprBase):
+    __slots__ = ("kind", "value", "line_nr")
+
     def __init__(self, kind: str, value: Union[str, int], line_nr: int) -> None:
         self.kind = kind
         self.value = value
@@ -33,10 +248,14 @@ class Token(ExprBase):
     def __repr__(self) -> str:
         return "[%s:%s:%d]" % (self.kind, self.value, self.line_nr)
 
-    def asReg8(self) -> Optional[int]:
+    @property
+    def key(self) -> tuple:
+        return self.kind, self.value
+
+    def operandKey(self) -> str:
         if self.kind == 'ID':
-            return REGS8.get(str(self.value), None)
-        return None
+            return OPERAND_KEYS.get(str(self.value), "n")
+        return "n"
 
     def copy(self):
         return Token(self.kind, self.value, self.line_nr)
@@ -46,76 +265,68 @@ class REF(ExprBase):
     def __init__(self, expr: ExprBase) -> None:
         self.expr = expr
 
-    def asReg8(self) -> Optional[int]:
-        if self.expr.isA('ID', 'HL'):
-            return REGS8['[HL]']
-        return None
+    def operandKey(self) -> str:
+        if self.expr.isA('ID'):
+            return REF_OPERAND_KEYS.get(str(self.expr.value), "[n]")
+        return "[n]"
 
     def __repr__(self) -> str:
         return "[%s]" % (self.expr)
 
+    @property
+    def key(self) -> tuple:
+        return "REF", self.expr.key
+
+
+FOLD_OPS: Dict[str, Callable[[int, int], int]] = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a // b,
+    '<': lambda a, b: 1 if a < b else 0,
+    '>': lambda a, b: 1 if a > b else 0,
+    '<=': lambda a, b: 1 if a <= b else 0,
+    '>=': lambda a, b: 1 if a >= b else 0,
+    '==': lambda a, b: 1 if a == b else 0,
+    '<<': lambda a, b: a << b,
+    '>>': lambda a, b: a >> b,
+    '&': lambda a, b: a & b,
+    '|': lambda a, b: a | b,
+}
+
 
 class OP(ExprBase):
+    # OP nodes are hash-consed: structurally equal expressions share a single node. Nodes are never modified after
+    # creation, so they can be shared between relocations and their resolved values can be cached.
+    _interned: "weakref.WeakValueDictionary[tuple, OP]" = weakref.WeakValueDictionary()
+
     def __init__(self, op: str, left: ExprBase, right: Optional[ExprBase] = None):
         self.op = op
         self.left = left
         self.right = right
+        self.key = ("OP", op, left.key, right.key if right is not None else None)
 
     def __repr__(self) -> str:
         return "(%s %s %s)" % (self.left, self.op, self.right)
 
     @staticmethod
     def make(op: str, left: ExprBase, right: Optional[ExprBase] = None) -> ExprBase:
-        if left.isA('NUMBER') and right is not None and right.isA('NUMBER'):
+        if left.isA('NUMBER') and right is not None and right.isA('NUMBER') and op in FOLD_OPS:
             assert isinstance(right, Token) and isinstance(right.value, int)
             assert isinstance(left, Token) and isinstance(left.value, int)
-            if op == '+':
-                left.value += right.value
-                return left
-            if op == '-':
-                left.value -= right.value
-                return left
-            if op == '*':
-                left.value *= right.value
-                return left
-            if op == '/':
-                left.value //= right.value
-                return left
-            if op == '<':
-                left.value = 1 if left.value < right.value else 0
-                return left
-            if op == '>':
-                left.value = 1 if left.value > right.value else 0
-                return left
-            if op == '<=':
-                left.value = 1 if left.value <= right.value else 0
-                return left
-            if op == '>=':
-                left.value = 1 if left.value >= right.value else 0
-                return left
-            if op == '==':
-                left.value = 1 if left.value == right.value else 0
-                return left
-            if op == '<<':
-                left.value <<= right.value
-                return left
-            if op == '>>':
-                left.value >>= right.value
-                return left
-            if op == '&':
-                left.value &= right.value
-                return left
-            if op == '|':
-                left.value |= right.value
-                return left
+            return Token('NUMBER', FOLD_OPS[op](left.value, right.value), left.line_nr)
         if left.isA('NUMBER') and right is None:
             assert isinstance(left, Token) and isinstance(left.value, int)
             if op == '+':
                 return left
             if op == '-':
-                left.value = -left.value
-                return left
-        return OP(op, left, right)
+                return Token('NUMBER', -left.value, left.line_nr)
+        key = ("OP", op, left.key, right.key if right is not None else None)
+        node = OP._interned.get(key)
+        if node is None:
+            node = OP(op, left, right)
+            OP._interned[key] = node
+        return node
 
 
 class CALL(ExprBase):
@@ -123,81 +334,201 @@ class CALL(ExprBase):
         self.function = function
         self.params = params
         self.line_nr = line_nr
+        self.key = ("CALL", function, tuple(param.key for param in params))
 
     def __repr__(self) -> str:
         return f"{self.function}({self.params})"
 
 
+def referencedNames(expr: ExprBase) -> Iterator[str]:
+    """All identifiers used in an expression."""
+    if isinstance(expr, Token):
+        if expr.kind == 'ID':
+            yield str(expr.value)
+    elif isinstance(expr, OP):
+        yield from referencedNames(expr.left)
+        if expr.right is not None:
+            yield from referencedNames(expr.right)
+    elif isinstance(expr, REF):
+        yield from referencedNames(expr.expr)
+    elif isinstance(expr, CALL):
+        for param in expr.params:
+            yield from referencedNames(param)
+
+
 class AssemblerException(Exception):
     def __init__(self, token, message):
         self.token = token
         self.message = message
 
 
+TOKEN_PATTERNS: List[Tuple[str, str]] = [
+    ('NUMBER', r'\d+(?:\.\d*)?'),
+    ('HEX', r'\$[0-9A-Fa-f]+'),
+    ('GFX', r'`[0-3]+'),
+    ('ASSIGN', r':='),
+    ('LABEL', r':'),
+    ('DIRECTIVE', r'#[A-Za-z_]+'),
+    ('STRING', '[a-zA-Z]?"[^"]*"'),
+    ('ID', r'\.?[A-Za-z_][A-Za-z0-9_\.]*'),
+    ('OP', r'(?:<=)|(?:>=)|(?:==)|(?:<<)|(?:>>)|[+\-*/,\(\)<>&|]'),
+    ('REFOPEN', r'\['),
+    ('REFCLOSE', r'\]'),
+    ('MACROARG', r'\\[0-9]+'),
+    ('TOKENCONCAT', r'##'),
+    ('NEWLINE', r'\n'),
+    ('END', r'\Z'),
+    ('MISMATCH', r'.'),
+]
+# Token kinds are stored as their index in this table.
+TOKEN_KINDS: Tuple[str, ...] = tuple(sys.intern(kind) for kind, _ in TOKEN_PATTERNS)
+(KIND_NUMBER, KIND_HEX, KIND_GFX, KIND_ASSIGN, KIND_LABEL, KIND_DIRECTIVE, KIND_STRING, KIND_ID, KIND_OP, KIND_REFOPEN,
+ KIND_REFCLOSE, KIND_MACROARG, KIND_TOKENCONCAT, KIND_NEWLINE, KIND_END, KIND_MISMATCH) = range(len(TOKEN_KINDS))
+# The lexer regex only finds the token text, the kind is looked up from the complete text for fixed tokens, and from
+# the first character for the others. Single characters that can only start a longer token are mismatches.
+FIXED_TOKENS: Dict[str, Tuple[int, str]] = {
+    ':=': (KIND_ASSIGN, ':='), ':': (KIND_LABEL, ':'), '[': (KIND_REFOPEN, '['), ']': (KIND_REFCLOSE, ']'),
+    '##': (KIND_TOKENCONCAT, '##'), '\n': (KIND_NEWLINE, '\n'), '': (KIND_END, ''),
+    **{op: (KIND_OP, op) for op in ('<=', '>=', '==', '<<', '>>', '+', '-', '*', '/', ',', '(', ')', '<', '>', '&', '|')},
+    **{c: (KIND_MISMATCH, c) for c in '.$`#"\\='},
+}
+LEADING_CHAR_KINDS: Dict[str, int] = {
+    '$': KIND_HEX, '`': KIND_GFX, '#': KIND_DIRECTIVE, '"': KIND_STRING, '.': KIND_ID, '_': KIND_ID, '\\': KIND_MACROARG,
+    **{c: KIND_NUMBER for c in '0123456789'},
+    **{c: KIND_ID for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'},
+}
+
+
+class TokenList:
+    """Lexed tokens stored as parallel arrays of kind codes, values and line numbers.
+    Token objects are only created when the token stream reads them."""
+    __slots__ = ("kinds", "values", "lines")
+
+    def __init__(self) -> None:
+        self.kinds = bytearray()
+        self.values: List[Union[str, int]] = []
+        self.lines = array.array('I')
+
+    def append(self, kind: int, value: Union[str, int], line_nr: int) -> None:
+        self.kinds.append(kind)
+        self.values.append(value)
+        self.lines.append(line_nr)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, index: int) -> Token:
+        return Token(TOKEN_KINDS[self.kinds[index]], self.values[index], self.lines[index])
+
+
+class MacroExpansion:
+    """Tokens of a shared macro expansion, read as if they were on the line of the macro call."""
+    __slots__ = ("tokens", "line_nr")
+
+    def __init__(self, tokens: List[Token], line_nr: int) -> None:
+        self.tokens = tokens
+        self.line_nr = line_nr
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __getitem__(self, index: int) -> Token:
+        token = self.tokens[index]
+        return Token(token.kind, token.value, self.line_nr)
+
+
 class Tokenizer:
-    TOKEN_REGEX = re.compile('|'.join('(?P<%s>%s)' % pair for pair in [
-        ('NUMBER', r'\d+(\.\d*)?'),
-        ('HEX', r'\$[0-9A-Fa-f]+'),
-        ('GFX', r'`[0-3]+'),
-        ('ASSIGN', r':='),
-        ('COMMENT', r';[^\n]*'),
-        ('LABEL', r':'),
-        ('DIRECTIVE', r'#[A-Za-z_]+'),
-        ('STRING', '[a-zA-Z]?"[^"]*"'),
-        ('ID', r'\.?[A-Za-z_][A-Za-z0-9_\.]*'),
-        ('OP', r'(?:<=)|(?:>=)|(?:==)|(?:<<)|(?:>>)|[+\-*/,\(\)<>&|]'),
-        ('REFOPEN', r'\['),
-        ('REFCLOSE', r'\]'),
-        ('MACROARG', r'\\[0-9]+'),
-        ('TOKENCONCAT', r'##'),
-        ('NEWLINE', r'\n'),
-        ('SKIP', r'[ \t]+'),
-        ('MISMATCH', r'.'),
-    ]))
+    # Whitespace and comments are consumed as the prefix of the next token, so they never produce a match of their
+    # own. The END alternative makes sure trailing whitespace and comments are consumed as well.
+    TOKEN_REGEX = re.compile(r'[ \t]*(?:;[^\n]*)?(%s)' % '|'.join(pattern for _, pattern in TOKEN_PATTERNS))
 
     def __init__(self, code: str) -> None:
-        self.__tokens: List[Token] = []
+        # Stack of token frames, each with its own read cursor. Macro expansions and includes push a new frame
+        # on top of the stream instead of copying the remaining tokens, so pop and shift are constant time.
+        self.__frames: List[Sequence[Token]] = []
+        self.__cursors: List[int] = []
+        self.__peeked: Optional[Token] = None
         self.shiftCode(code)
 
     def shiftCode(self, code: str) -> None:
-        new_tokens: List[Token] = []
+        self.shift(self.tokenize(code))
+
+    @staticmethod
+    def tokenize(code: str) -> TokenList:
+        result = TokenList()
+        kinds = result.kinds
+        values = result.values
+        lines = result.lines
+        names: Dict[str, str] = {}
         line_num = 1
-        for mo in self.TOKEN_REGEX.finditer(code):
-            kind = mo.lastgroup
-            assert kind is not None
-            value: Union[str, int] = mo.group()
-            if kind == 'MISMATCH':
+        for text in Tokenizer.TOKEN_REGEX.findall(code):
+            fixed = FIXED_TOKENS.get(text)
+            value: Union[str, int]
+            if fixed is not None:
+                kind, value = fixed
+                if kind == KIND_NEWLINE:
+                    kinds.append(kind)
+                    values.append(value)
+                    lines.append(line_num)
+                    line_num += 1
+                    continue
+                if kind == KIND_END:
+                    continue
+            else:
+                kind = LEADING_CHAR_KINDS.get(text[0], KIND_MISMATCH)
+                value = text
+                if kind == KIND_ID:
+                    if text[-1] == '"':
+                        kind = KIND_STRING
+                    else:
+                        name = names.get(text)
+                        if name is None:
+                            name = names[text] = sys.intern(text.upper())
+                        value = name
+                elif kind == KIND_NUMBER:
+                    value = int(text)
+                elif kind == KIND_HEX:
+                    value = int(text[1:], 16)
+                    kind = KIND_NUMBER
+                elif kind == KIND_GFX:
+                    value = sum(((int(c) & 1) << (7 - idx)) | ((int(c) & 2) << (14 - idx)) for idx, c in enumerate(text[1:]))
+                    kind = KIND_NUMBER
+            if kind == KIND_MISMATCH:
                 print(code.split("\n")[line_num-1])
                 raise AssemblerException(Token('?', '', line_num), "Syntax error on line: %d: %s" % (line_num, value))
-            elif kind == 'SKIP':
-                pass
-            elif kind == 'COMMENT':
-                pass
-            else:
-                if kind == 'NUMBER':
-                    value = int(value)
-                elif kind == 'HEX':
-                    value = int(str(value)[1:], 16)
-                    kind = 'NUMBER'
-                elif kind == 'GFX':
-                    value = sum(((int(c) & 1) << (7 - idx)) | ((int(c) & 2) << (14 - idx)) for idx, c in enumerate(value[1:]))
-                    kind = 'NUMBER'
-                elif kind == 'ID':
-                    value = str(value).upper()
-                new_tokens.append(Token(kind, value, line_num))
-                if kind == 'NEWLINE':
-                    line_num += 1
-        new_tokens.append(Token('NEWLINE', '\n', line_num))
-        self.shift(new_tokens)
+            kinds.append(kind)
+            values.append(value)
+            lines.append(line_num)
+        result.append(KIND_NEWLINE, '\n', line_num)
+        return result
 
     def peek(self) -> Token:
-        return self.__tokens[0]
+        if self.__peeked is None:
+            self.__peeked = self.__frames[-1][self.__cursors[-1]]
+        return self.__peeked
 
     def pop(self) -> Token:
-        return self.__tokens.pop(0)
+        tokens = self.__frames[-1]
+        position = self.__cursors[-1]
+        token = self.__peeked
+        if token is None:
+            token = tokens[position]
+        self.__peeked = None
+        position += 1
+        if position == len(tokens):
+            # Drop exhausted frames right away, so the stream is empty exactly when no frames are left.
+            self.__frames.pop()
+            self.__cursors.pop()
+        else:
+            self.__cursors[-1] = position
+        return token
 
-    def shift(self, tokens: List[Token]) -> None:
-        self.__tokens = tokens + self.__tokens
+    def shift(self, tokens: Sequence[Token]) -> None:
+        # The list is referenced, not copied, the caller should not modify it afterwards.
+        if tokens:
+            self.__peeked = None
+            self.__frames.append(tokens)
+            self.__cursors.append(0)
 
     def expect(self, kind: str, value: Optional[str] = None) -> Token:
         pop = self.pop()
@@ -215,7 +546,84 @@ class Tokenizer:
         return False
 
     def __bool__(self) -> bool:
-        return bool(self.__tokens)
+        return bool(self.__frames)
+
+
+# Included files are usually the same few hardware definition files. Their tokens can be shared, as tokens are never
+# modified once lexed and the token stream does not modify the lists it is given.
+tokenizeInclude = functools.lru_cache(maxsize=32)(Tokenizer.tokenize)
+
+
+class Macro:
+    """Macro body compiled at definition time into a template of literal token runs, argument slots and
+    concatenations. Expansions are cached by their arguments, and shared as they are never modified. The stream reads
+    them with the line number of the call."""
+    EMIT = 0
+    ARG = 1
+    CONCAT = 2
+    CONCAT_ARG = 3
+
+    def __init__(self, name: Token, body: List[Token]) -> None:
+        self.name = name
+        self.template: List[Tuple[int, Union[List[Token], int, str]]] = []
+        self.arg_count = 0
+        self.__expansions: Dict[tuple, List[Token]] = {}
+        self.hits = 0
+        concat = False
+        for token in body:
+            if concat:
+                concat = False
+                if token.isA('MACROARG'):
+                    self.template.append((Macro.CONCAT_ARG, self.__argIndex(token)))
+                elif self.template and self.template[-1][0] == Macro.EMIT:
+                    run = self.template[-1][1]
+                    assert isinstance(run, list)
+                    if not run[-1].isA('ID'):
+                        raise AssemblerException(token, "Can only concat ID tokens")
+                    run[-1] = Token('ID', str(run[-1].value) + str(token.value), run[-1].line_nr)
+                else:
+                    self.template.append((Macro.CONCAT, str(token.value)))
+            elif token.isA('MACROARG'):
+                self.template.append((Macro.ARG, self.__argIndex(token)))
+            elif token.isA('TOKENCONCAT'):
+                concat = True
+            elif self.template and self.template[-1][0] == Macro.EMIT:
+                run = self.template[-1][1]
+                assert isinstance(run, list)
+                run.append(token)
+            else:
+                self.template.append((Macro.EMIT, [token]))
+
+    def __argIndex(self, token: Token) -> int:
+        argn = int(str(token.value)[1:]) - 1
+        self.arg_count = max(self.arg_count, argn + 1)
+        return argn
+
+    def expand(self, start: Token, params: List[List[Token]]) -> MacroExpansion:
+        if len(params) < self.arg_count:
+            raise AssemblerException(start, "Missing argument for macro")
+        key = tuple(tuple(token.key for token in param) for param in params[:self.arg_count])
+        result = self.__expansions.get(key)
+        if result is not None:
+            self.hits += 1
+            return MacroExpansion(result, start.line_nr)
+        result = []
+        for kind, value in self.template:
+            if kind == Macro.EMIT:
+                assert isinstance(value, list)
+                result += value
+            elif kind == Macro.ARG:
+                assert isinstance(value, int)
+                result += params[value]
+            else:
+                if not result or not result[-1].isA('ID'):
+                    raise AssemblerException(start, "Can only concat ID tokens")
+                if kind == Macro.CONCAT_ARG:
+                    assert isinstance(value, int)
+                    value = "".join(str(p.value) for p in params[value])
+                result[-1] = Token('ID', str(result[-1].value) + str(value), result[-1].line_nr)
+        self.__expansions[key] = result
+        return MacroExpansion(result, start.line_nr)
 
 
 class Section:
@@ -225,6 +633,9 @@ class Section:
         self.data = bytearray()
         self.link: Dict[int, Tuple[int, ExprBase]] = {}
         self.jpr_list: List[int] = []
+        # Offsets where instructions start, all other bytes are data. With the source line of each instruction.
+        self.instructions: List[int] = []
+        self.instruction_lines: List[int] = []
 
     def __repr__(self) -> str:
         if self.bank is not None:
@@ -234,71 +645,351 @@ class Section:
         return f"Section {binascii.hexlify(self.data).decode('ascii')}"
 
 
+class ObjectFile:
+    """Relocatable result of assembling, labels refer to their section by index."""
+    def __init__(self) -> None:
+        self.sections: List[Section] = []
+        self.labels: Dict[str, Tuple[int, int]] = {}
+        self.constants: Dict[str, int] = {}
+        self.asserts: List[Tuple[Token, ExprBase]] = []
+
+
+def buildConstantPool(blobs: List[bytes]) -> Tuple[bytearray, Dict[bytes, int]]:
+    """Lay out blobs without duplicates, returns the pool data and the offset of each blob.
+    A NUL terminated blob that is the tail of another one shares its storage."""
+    unique = list(dict.fromkeys(blobs))
+    # Sorted on their reversed data, a blob that is the tail of others is directly followed by one of them.
+    terminated = sorted((blob for blob in unique if blob.endswith(b'\x00')), key=lambda blob: blob[::-1])
+    owner: Dict[bytes, bytes] = {}
+    for idx in range(len(terminated) - 1, -1, -1):
+        blob = terminated[idx]
+        if idx + 1 < len(terminated) and terminated[idx + 1].endswith(blob):
+            owner[blob] = owner[terminated[idx + 1]]
+        else:
+            owner[blob] = blob
+    data = bytearray()
+    offsets: Dict[bytes, int] = {}
+    for blob in unique:
+        if owner.get(blob, blob) == blob:
+            offsets[blob] = len(data)
+            data += blob
+    for blob in unique:
+        container = owner.get(blob, blob)
+        offsets[blob] = offsets[container] + len(container) - len(blob)
+    return data, offsets
+
+
 class SpaceAllocator:
+    BANK_SIZE = 0x4000
+
     def __init__(self):
-        self.__available = []
-        self.__next_free_bank = 0
+        # Free regions per bank as (size, start) tuples, kept sorted so the best fitting region is found with a bisect.
+        self.__free: List[List[Tuple[int, int]]] = []
+        self.__sections: List[int] = []
 
     def allocate_fixed(self, bank, start, length):
-        while bank >= self.__next_free_bank:
+        while bank >= len(self.__free):
             self.__new_bank()
         end = start + length
-        for idx, (b, s, e) in enumerate(self.__available):
-            if b != bank:
-                continue
+        for idx, (size, s) in enumerate(self.__free[bank]):
+            e = s + size
             if s <= start and e >= end:
-                self.__available.pop(idx)
+                self.__free[bank].pop(idx)
                 if s < start:
-                    self.__available.append((bank, s, start))
+                    bisect.insort(self.__free[bank], (start - s, s))
                 if e > end:
-                    self.__available.append((bank, end, e))
+                    bisect.insort(self.__free[bank], (e - end, end))
+                self.__sections[bank] += 1
                 return
-        print(self.__available)
+        print(self.__free[bank])
         raise AssemblerException(None, f"Failed to allocate fixed region: {bank:02x}:{start:04x}-{end:04x}... region overlaps?")
 
     def allocate(self, length, bank=None, *, allow_new_bank=True):
         if bank is not None:
-            while bank >= self.__next_free_bank:
+            while bank >= len(self.__free):
                 self.__new_bank()
-        for idx, (b, s, e) in enumerate(self.__available):
-            if bank is not None and b != bank:
-                continue
-            if e - s >= length:
-                if e - s > length:
-                    self.__available[idx] = (b, s + length, e)
-                else:
-                    self.__available.pop(idx)
-                return b, s
-        if not allow_new_bank:
-            raise AssemblerException(None, f"Failed to allocate region: {length:04x}... region too big?")
-        self.__new_bank()
-        return self.allocate(length, bank, allow_new_bank=False)
+        best = None
+        for b in (range(len(self.__free)) if bank is None else (bank,)):
+            free = self.__free[b]
+            idx = bisect.bisect_left(free, (length, -1))
+            if idx < len(free) and (best is None or free[idx][0] < best[0]):
+                best = (free[idx][0], b, idx)
+        if best is None:
+            if not allow_new_bank or bank is not None:
+                raise AssemblerException(None, f"Failed to allocate region: {length:04x}... region too big?")
+            self.__new_bank()
+            return self.allocate(length, bank, allow_new_bank=False)
+        size, b, idx = best
+        size, start = self.__free[b].pop(idx)
+        if size > length:
+            bisect.insort(self.__free[b], (size - length, start + length))
+        self.__sections[b] += 1
+        return b, start
+
+    def getBankUsage(self) -> List[Tuple[int, int, int, int]]:
+        """Per bank fill report as (bank, used bytes, free bytes, number of sections)."""
+        result = []
+        for bank, free in enumerate(self.__free):
+            free_size = sum(size for size, start in free)
+            result.append((bank, self.BANK_SIZE - free_size, free_size, self.__sections[bank]))
+        return result
 
     def __new_bank(self):
-        if self.__next_free_bank == 0:
-            self.__available.append((self.__next_free_bank, 0x0000, 0x4000))
+        if not self.__free:
+            self.__free.append([(self.BANK_SIZE, 0x0000)])
+        else:
+            self.__free.append([(self.BANK_SIZE, 0x4000)])
+        self.__sections.append(0)
+
+
+class PeepholeItem:
+    """Decoded instruction, or a run of data when opcode is None. Relocations are relative to the start."""
+    __slots__ = ("offset", "size", "opcode", "data", "link", "jpr", "deleted", "line_nr")
+
+    def __init__(self, offset: int, opcode: Optional[int], data: bytearray, line_nr: int = 0) -> None:
+        self.offset = offset
+        self.size = len(data)
+        self.opcode = opcode
+        self.data = data
+        self.link: Dict[int, Tuple[int, ExprBase]] = {}
+        self.jpr = False
+        self.deleted = False
+        self.line_nr = line_nr
+
+    def target(self) -> Optional[str]:
+        """Label name of a jump or call target."""
+        link = self.link.get(1)
+        if link is not None and link[1].isA('ID'):
+            return str(link[1].value)
+        return None
+
+
+class PeepholeOptimizer:
+    """Rewrites short sequences of decoded instructions with a table of rules. Only the bytes that the assembler
+    emitted as instructions are decoded, data is never touched. Rules do not look past a label, as code can jump
+    there. Instructions only shrink or disappear, so distances between labels never grow."""
+
+    def __init__(self, sections: List[Section], labels: Dict[str, Tuple[Section, int]], knownAddress: Callable[[ExprBase], Optional[int]]) -> None:
+        self.sections = sections
+        self.labels = labels
+        self.knownAddress = knownAddress
+        self.stats: Dict[str, int] = {name: 0 for name, rule in PeepholeOptimizer.RULES}
+        self.items: Dict[Section, List[PeepholeItem]] = {}
+        self.labelled: Dict[Section, Set[int]] = {}
+        self.item_at: Dict[Tuple[Section, int], PeepholeItem] = {}
+
+    def run(self, max_passes: int = 4) -> Dict[str, int]:
+        for _ in range(max_passes):
+            self.decode()
+            count = 0
+            for section, items in self.items.items():
+                for idx, item in enumerate(items):
+                    for name, rule in PeepholeOptimizer.RULES:
+                        if item.deleted or item.opcode is None:
+                            break
+                        if rule(self, section, items, idx):
+                            self.stats[name] += 1
+                            count += 1
+            self.encode()
+            if count == 0:
+                break
+        return self.stats
+
+    def decode(self) -> None:
+        self.items = {}
+        self.labelled = {}
+        self.item_at = {}
+        for section in self.sections:
+            if not section.instructions:
+                continue
+            items: List[PeepholeItem] = []
+            position = 0
+            for start, line_nr in zip(section.instructions, section.instruction_lines):
+                if start > position:
+                    items.append(PeepholeItem(position, None, section.data[position:start]))
+                opcode = section.data[start]
+                if opcode == 0xCB:
+                    opcode = 0xCB00 | section.data[start + 1]
+                size = OPCODE_SIZES[opcode]
+                items.append(PeepholeItem(start, opcode, section.data[start:start + size], line_nr))
+                position = start + size
+            if position < len(section.data):
+                items.append(PeepholeItem(position, None, section.data[position:]))
+            starts = [item.offset for item in items]
+            for offset, link in section.link.items():
+                item = items[bisect.bisect_right(starts, offset) - 1]
+                item.link[offset - item.offset] = link
+            for offset in section.jpr_list:
+                items[bisect.bisect_right(starts, offset) - 1].jpr = True
+            for item in items:
+                self.item_at[(section, item.offset)] = item
+            self.items[section] = items
+            self.labelled[section] = set()
+        for section, offset in self.labels.values():
+            if section in self.labelled:
+                self.labelled[section].add(offset)
+
+    def encode(self) -> None:
+        # New offset of every item, a deleted item moves to where the item after it starts.
+        new_offsets: Dict[Section, List[int]] = {}
+        for section, items in self.items.items():
+            data = bytearray()
+            section.link = {}
+            section.jpr_list = []
+            section.instructions = []
+            section.instruction_lines = []
+            offsets = new_offsets[section] = []
+            for item in items:
+                offsets.append(len(data))
+                if item.deleted:
+                    continue
+                if item.opcode is not None:
+                    section.instructions.append(len(data))
+                    section.instruction_lines.append(item.line_nr)
+                for offset, link in item.link.items():
+                    section.link[len(data) + offset] = link
+                if item.jpr:
+                    section.jpr_list.append(len(data) + 1)
+                data += item.data
+            section.data = data
+        starts = {section: [item.offset for item in items] for section, items in self.items.items()}
+        for label, (section, offset) in self.labels.items():
+            if section not in self.items:
+                continue
+            idx = bisect.bisect_right(starts[section], offset) - 1
+            item = self.items[section][idx]
+            self.labels[label] = (section, new_offsets[section][idx] + min(offset - item.offset, 0 if item.deleted else len(item.data)))
+
+    def following(self, items: List[PeepholeItem], idx: int) -> Optional[PeepholeItem]:
+        for item in items[idx + 1:]:
+            if not item.deleted:
+                return item
+        return None
+
+    def target(self, item: PeepholeItem) -> Optional[Tuple[Section, int]]:
+        name = item.target()
+        if name is None:
+            return None
+        return self.labels.get(name)
+
+    def address(self, item: PeepholeItem) -> Optional[int]:
+        """Memory address of a load or store, if it is known and not an IO register."""
+        link = item.link.get(1)
+        if link is not None:
+            address = self.knownAddress(link[1])
+        elif item.opcode in (0xE0, 0xF0):
+            address = 0xFF00 | item.data[1]
         else:
-            self.__available.append((self.__next_free_bank, 0x4000, 0x8000))
-        self.__next_free_bank += 1
+            address = item.data[1] | (item.data[2] << 8)
+        if address is not None and (0xC000 <= address < 0xE000 or 0xFF80 <= address < 0xFFFF):
+            return address
+        return None
+
+    def flagsUnused(self, section: Section, items: List[PeepholeItem], idx: int) -> bool:
+        """True when the flags are overwritten before they are read, looking forward in straight line code only."""
+        for item in items[idx + 1:]:
+            if item.deleted:
+                continue
+            if item.opcode is None or item.offset in self.labelled[section] or item.opcode in FLAG_READERS:
+                return False
+            if item.opcode in FLAG_WRITERS:
+                return True
+            if item.opcode in CONTROL_FLOW:
+                return False
+        return False
+
+    def redundantLoad(self, section: Section, items: List[PeepholeItem], idx: int) -> bool:
+        """`ld r1, r2` followed by `ld r2, r1`, or a load and store of a of the same RAM address."""
+        item = items[idx]
+        after = self.following(items, idx)
+        if after is None or after.opcode is None or after.offset in self.labelled[section]:
+            return False
+        if 0x40 <= item.opcode < 0x80 and item.opcode != 0x76 and (item.opcode & 7) != 6 and (item.opcode & 0x38) != 0x30:
+            if after.opcode != 0x40 | ((item.opcode & 7) << 3) | ((item.opcode >> 3) & 7):
+                return False
+        elif (item.opcode, after.opcode) in ((0xEA, 0xFA), (0xFA, 0xEA), (0xE0, 0xF0), (0xF0, 0xE0)):
+            address = self.address(item)
+            if address is None or address != self.address(after):
+                return False
+        else:
+            return False
+        after.deleted = True
+        return True
+
+    def threadJump(self, section: Section, items: List[PeepholeItem], idx: int) -> bool:
+        """Jump to an unconditional jump goes to the final target directly."""
+        item = items[idx]
+        if item.opcode not in JUMPS:
+            return False
+        target = self.target(item)
+        name = None
+        visited: Set[Tuple[Section, int]] = set()
+        while target is not None and target not in visited:
+            visited.add(target)
+            jump = self.item_at.get(target)
+            if jump is None or jump.deleted or jump.opcode not in (0xC3, 0x18):
+                break
+            name = jump.target()
+            target = self.target(jump)
+        if name is None or target is None or name == item.target():
+            return False
+        if item.opcode in JP_TO_JR.values():
+            # Relative jumps can only be redirected within the section and in range.
+            if target[0] != section or not -128 <= target[1] - (item.offset + 2) < 128:
+                return False
+        link_type, expr = item.link[1]
+        item.link[1] = (link_type, Token('ID', name, expr.line_nr))
+        return True
+
+    def jumpToNext(self, section: Section, items: List[PeepholeItem], idx: int) -> bool:
+        """A jump to the instruction right after it."""
+        item = items[idx]
+        if item.opcode not in JUMPS:
+            return False
+        target = self.target(item)
+        if target is None or target[0] != section:
+            return False
+        after = self.following(items, idx)
+        end = after.offset if after is not None else items[-1].offset + items[-1].size
+        if not item.offset + item.size <= target[1] <= end:
+            return False
+        item.deleted = True
+        return True
+
+    def tailCall(self, section: Section, items: List[PeepholeItem], idx: int) -> bool:
+        """`call f` followed by `ret` becomes `jp f`, the ret stays when the call is conditional or it is a label."""
+        item = items[idx]
+        if item.opcode not in CALL_TO_JP:
+            return False
+        after = self.following(items, idx)
+        if after is None or after.opcode != 0xC9:
+            return False
+        item.opcode = item.data[0] = CALL_TO_JP[item.opcode]
+        item.jpr = 1 in item.link
+        if item.opcode == 0xC3 and after.offset not in self.labelled[section]:
+            after.deleted = True
+        return True
+
+    def clearA(self, section: Section, items: List[PeepholeItem], idx: int) -> bool:
+        """`ld a, 0` becomes `xor a` when the flags it changes are not used."""
+        item = items[idx]
+        if item.opcode != 0x3E or item.link or item.data[1] != 0 or not self.flagsUnused(section, items, idx):
+            return False
+        item.opcode = 0xAF
+        item.data = bytearray([0xAF])
+        return True
+
+    RULES: List[Tuple[str, Callable[["PeepholeOptimizer", Section, List[PeepholeItem], int], bool]]] = [
+        ("redundant load", redundantLoad),
+        ("jump threading", threadJump),
+        ("jump to next", jumpToNext),
+        ("call ret to jp", tailCall),
+        ("ld a 0 to xor a", clearA),
+    ]
 
 
 class Assembler:
-    SIMPLE_INSTR = {
-        'NOP':  0x00,
-        'RLCA': 0x07,
-        'RRCA': 0x0F,
-        'STOP': 0x010,
-        'RLA':  0x17,
-        'RRA':  0x1F,
-        'DAA':  0x27,
-        'CPL':  0x2F,
-        'SCF':  0x37,
-        'CCF':  0x3F,
-        'HALT': 0x76,
-        'RETI': 0xD9,
-        'DI':   0xF3,
-        'EI':   0xFB,
-    }
+    INSTRUCTIONS = compileEncodings(SM83_ENCODINGS)
 
     LINK_REL8 = 0
     LINK_ABS8 = 1
@@ -311,10 +1002,15 @@ class Assembler:
         self.__label: Dict[str, Tuple[Section, int]] = {}
         self.__constant: Dict[str, int] = {}
         self.__scope: Optional[str] = None
-        self.__macros: Dict[str, List[Token]] = {}
+        self.__macros: Dict[str, Macro] = {}
         self.__asserts: List[Tuple[Token, ExprBase]] = []
         self.__base_path = None
         self.__tok = Tokenizer("")
+        self.__relax_passes: List[int] = []
+        self.__strip_stats = (0, 0)
+        self.__peephole_stats: Dict[str, int] = {}
+        self.__space_allocator = SpaceAllocator()
+        self.__resolved: Dict[tuple, ExprBase] = {}
 
     def processFile(self, base_path: str, filename: str, **kwargs):
         self.__base_path = base_path
@@ -356,11 +1052,11 @@ class Assembler:
                             raise AssemblerException(name, 'Unterminated macro')
                     self.__tok.pop()
                     self.__tok.expect('NEWLINE')
-                    self.__macros[name.value] = macro
+                    self.__macros[str(name.value)] = Macro(name, macro)
                 elif start.value == '#INCLUDE':
                     filename = self.__tok.expect('STRING').value[1:-1]
                     self.__tok.expect('NEWLINE')
-                    self.__tok.shiftCode(open(os.path.join(self.__base_path, filename), "rt").read())
+                    self.__tok.shift(tokenizeInclude(open(os.path.join(self.__base_path, filename), "rt").read()))
                 elif start.value == '#ALIGN':
                     value = self.__tok.expect('NUMBER').value
                     self.__tok.expect('NEWLINE')
@@ -380,7 +1076,11 @@ class Assembler:
                 while not self.__tok.pop().isA('NEWLINE'):
                     pass
             elif start.kind == 'ID':
-                if start.value == 'DB':
+                encodings = self.INSTRUCTIONS.get(str(start.value))
+                if encodings is not None:
+                    self.instruction(start, encodings)
+                    self.__tok.expect('NEWLINE')
+                elif start.value == 'DB':
                     self.instrDB()
                     self.__tok.expect('NEWLINE')
                 elif start.value == 'DS':
@@ -389,108 +1089,6 @@ class Assembler:
                 elif start.value == 'DW':
                     self.instrDW()
                     self.__tok.expect('NEWLINE')
-                elif start.value == 'LD':
-                    self.instrLD()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'LDH':
-                    self.instrLDH()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'LDI':
-                    self.instrLDI()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'LDD':
-                    self.instrLDD()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'INC':
-                    self.instrINC()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'DEC':
-                    self.instrDEC()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'ADD':
-                    self.instrADD()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'ADC':
-                    self.instrALU(0x88)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SUB':
-                    self.instrALU(0x90)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SBC':
-                    self.instrALU(0x98)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'AND':
-                    self.instrALU(0xA0)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'XOR':
-                    self.instrALU(0xA8)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'OR':
-                    self.instrALU(0xB0)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'CP':
-                    self.instrALU(0xB8)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'BIT':
-                    self.instrBIT(0x40)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RES':
-                    self.instrBIT(0x80)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SET':
-                    self.instrBIT(0xC0)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RET':
-                    self.instrRET()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'CALL':
-                    self.instrCALL()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RLC':
-                    self.instrCB(0x00)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RRC':
-                    self.instrCB(0x08)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RL':
-                    self.instrCB(0x10)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RR':
-                    self.instrCB(0x18)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SLA':
-                    self.instrCB(0x20)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SRA':
-                    self.instrCB(0x28)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SWAP':
-                    self.instrCB(0x30)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'SRL':
-                    self.instrCB(0x38)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'RST':
-                    self.instrRST()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'JP':
-                    self.instrJP()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'JR':
-                    self.instrJR()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'JPR':
-                    self.instrJPR()
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'PUSH':
-                    self.instrPUSHPOP(0xC5)
-                    self.__tok.expect('NEWLINE')
-                elif start.value == 'POP':
-                    self.instrPUSHPOP(0xC1)
-                    self.__tok.expect('NEWLINE')
-                elif start.value in self.SIMPLE_INSTR:
-                    self.__current_section.data.append(self.SIMPLE_INSTR[str(start.value)])
-                    self.__tok.expect('NEWLINE')
                 elif start.value in self.__macros:
                     params = [[]]
                     while not self.__tok.peek().isA('NEWLINE'):
@@ -500,33 +1098,7 @@ class Assembler:
                         else:
                             params[-1].append(self.__tok.pop())
                     self.__tok.pop()
-                    to_add = []
-                    concat = False
-                    for token in self.__macros[start.value]:
-                        if concat:
-                            concat = False
-                            if not to_add[-1].isA('ID'):
-                                raise AssemblerException(token, "Can only concat ID tokens")
-                            to_add[-1] = to_add[-1].copy()
-                            if token.isA('MACROARG'):
-                                argn = int(token.value[1:]) - 1
-                                if argn >= len(params):
-                                    raise AssemblerException(start, "Missing argument for macro")
-                                for p in params[int(token.value[1:]) - 1]:
-                                    to_add[-1].value += p.value
-                            else:
-                                to_add[-1].value = to_add[-1].value + token.value
-                        elif token.isA('MACROARG'):
-                            argn = int(token.value[1:]) - 1
-                            if argn >= len(params):
-                                raise AssemblerException(start, "Missing argument for macro")
-                            for p in params[argn]:
-                                to_add.append(p.copy())
-                        elif token.isA('TOKENCONCAT'):
-                            concat = True
-                        else:
-                            to_add.append(token.copy())
-                    self.__tok.shift(to_add)
+                    self.__tok.shift(self.__macros[str(start.value)].expand(start, params))
                 elif self.__tok.peek().kind == 'LABEL':
                     self.__tok.pop()
                     self.addLabel(str(start.value))
@@ -559,7 +1131,7 @@ class Assembler:
             value = int(expr.value)
         else:
             self.__current_section.link[len(self.__current_section.data)] = (Assembler.LINK_HIGH8, expr)
-            value = 0
+            value = 0xFF00
         if 0xFF00 <= value < 0x10000:
             self.__current_section.data.append(value & 0xFF)
         else:
@@ -597,280 +1169,50 @@ class Assembler:
     def currentSectionSize(self) -> int:
         return len(self.__current_section.data)
 
-    def instrLD(self) -> None:
-        left_param = self.parseParam()
-        self.__tok.expect('OP', ',')
-        right_param = self.parseParam()
-        lr8 = left_param.asReg8()
-        rr8 = right_param.asReg8()
-        if lr8 is not None and rr8 is not None:
-            self.__current_section.data.append(0x40 | (lr8 << 3) | rr8)
-        elif left_param.isA('ID', 'A') and isinstance(right_param, REF):
-            if right_param.expr.isA('ID', 'BC'):
-                self.__current_section.data.append(0x0A)
-            elif right_param.expr.isA('ID', 'DE'):
-                self.__current_section.data.append(0x1A)
-            elif right_param.expr.isA('ID', 'HL+'):
-                self.__current_section.data.append(0x2A)
-            elif right_param.expr.isA('ID', 'HL-'):
-                self.__current_section.data.append(0x3A)
-            elif right_param.expr.isA('ID', 'C'):
-                self.__current_section.data.append(0xF2)
-            else:
-                self.__current_section.data.append(0xFA)
-                self.insert16(right_param.expr)
-        elif right_param.isA('ID', 'A') and isinstance(left_param, REF):
-            if left_param.expr.isA('ID', 'BC'):
-                self.__current_section.data.append(0x02)
-            elif left_param.expr.isA('ID', 'DE'):
-                self.__current_section.data.append(0x12)
-            elif left_param.expr.isA('ID', 'HL+'):
-                self.__current_section.data.append(0x22)
-            elif left_param.expr.isA('ID', 'HL-'):
-                self.__current_section.data.append(0x32)
-            elif left_param.expr.isA('ID', 'C'):
-                self.__current_section.data.append(0xE2)
-            else:
-                self.__current_section.data.append(0xEA)
-                self.insert16(left_param.expr)
-        elif left_param.isA('ID', 'BC'):
-            self.__current_section.data.append(0x01)
-            self.insert16(right_param)
-        elif left_param.isA('ID', 'DE'):
-            self.__current_section.data.append(0x11)
-            self.insert16(right_param)
-        elif left_param.isA('ID', 'HL'):
-            self.__current_section.data.append(0x21)
-            self.insert16(right_param)
-        elif left_param.isA('ID', 'SP'):
-            if right_param.isA('ID', 'HL'):
-                self.__current_section.data.append(0xF9)
-            else:
-                self.__current_section.data.append(0x31)
-                self.insert16(right_param)
-        elif right_param.isA('ID', 'SP') and isinstance(left_param, REF):
-            self.__current_section.data.append(0x08)
-            self.insert16(left_param.expr)
-        elif lr8 is not None:
-            self.__current_section.data.append(0x06 | (lr8 << 3))
-            self.insert8(right_param)
-        else:
-            raise AssemblerException(left_param, "Syntax error")
-
-    def instrLDH(self) -> None:
-        left_param = self.parseParam()
-        self.__tok.expect('OP', ',')
-        right_param = self.parseParam()
-        if left_param.isA('ID', 'A') and isinstance(right_param, REF):
-            if right_param.expr.isA('ID', 'C'):
-                self.__current_section.data.append(0xF2)
-            else:
-                self.__current_section.data.append(0xF0)
-                self.insertHigh8(right_param.expr)
-        elif right_param.isA('ID', 'A') and isinstance(left_param, REF):
-            if left_param.expr.isA('ID', 'C'):
-                self.__current_section.data.append(0xE2)
-            else:
-                self.__current_section.data.append(0xE0)
-                self.insertHigh8(left_param.expr)
-        else:
-            raise AssemblerException(left_param, "Syntax error")
-
-    def instrLDI(self) -> None:
-        left_param = self.parseParam()
-        self.__tok.expect('OP', ',')
-        right_param = self.parseParam()
-        if left_param.isA('ID', 'A') and isinstance(right_param, REF) and right_param.expr.isA('ID', 'HL'):
-            self.__current_section.data.append(0x2A)
-        elif right_param.isA('ID', 'A') and isinstance(left_param, REF) and left_param.expr.isA('ID', 'HL'):
-            self.__current_section.data.append(0x22)
-        else:
-            raise AssemblerException(left_param, "Syntax error")
-
-    def instrLDD(self) -> None:
-        left_param = self.parseParam()
-        self.__tok.expect('OP', ',')
-        right_param = self.parseParam()
-        if left_param.isA('ID', 'A') and isinstance(right_param, REF) and right_param.expr.isA('ID', 'HL'):
-            self.__current_section.data.append(0x3A)
-        elif right_param.isA('ID', 'A') and isinstance(left_param, REF) and left_param.expr.isA('ID', 'HL'):
-            self.__current_section.data.append(0x32)
-        else:
-            raise AssemblerException(left_param, "Syntax error")
-
-    def instrINC(self) -> None:
-        param = self.parseParam()
-        r8 = param.asReg8()
-        if r8 is not None:
-            self.__current_section.data.append(0x04 | (r8 << 3))
-        elif param.isA('ID', 'BC'):
-            self.__current_section.data.append(0x03)
-        elif param.isA('ID', 'DE'):
-            self.__current_section.data.append(0x13)
-        elif param.isA('ID', 'HL'):
-            self.__current_section.data.append(0x23)
-        elif param.isA('ID', 'SP'):
-            self.__current_section.data.append(0x33)
-        else:
-            raise AssemblerException(param, "Syntax error")
-
-    def instrDEC(self) -> None:
-        param = self.parseParam()
-        r8 = param.asReg8()
-        if r8 is not None:
-            self.__current_section.data.append(0x05 | (r8 << 3))
-        elif param.isA('ID', 'BC'):
-            self.__current_section.data.append(0x0B)
-        elif param.isA('ID', 'DE'):
-            self.__current_section.data.append(0x1B)
-        elif param.isA('ID', 'HL'):
-            self.__current_section.data.append(0x2B)
-        elif param.isA('ID', 'SP'):
-            self.__current_section.data.append(0x3B)
-        else:
-            raise AssemblerException(param, "Syntax error")
-
-    def instrADD(self) -> None:
-        left_param = self.parseParam()
-        if self.__tok.popIf('OP', ','):
-            right_param = self.parseParam()
-            if left_param.isA('ID', 'A'):
-                rr8 = right_param.asReg8()
-                if rr8 is not None:
-                    self.__current_section.data.append(0x80 | rr8)
-                else:
-                    self.__current_section.data.append(0xC6)
-                    self.insert8(right_param)
-            elif left_param.isA('ID', 'HL') and right_param.isA('ID') and isinstance(right_param, Token) and right_param.value in REGS16A:
-                self.__current_section.data.append(0x09 | REGS16A[str(right_param.value)] << 4)
-            elif left_param.isA('ID', 'SP'):
-                self.__current_section.data.append(0xE8)
-                self.insert8(right_param)
-            else:
-                raise AssemblerException(left_param, "Syntax error")
-        else:
-            lr8 = left_param.asReg8()
-            if lr8 is not None:
-                self.__current_section.data.append(0x80 | lr8)
-            else:
-                self.__current_section.data.append(0xC6)
-                self.insert8(left_param)
-
-    def instrALU(self, code_value: int) -> None:
-        param = self.parseParam()
-        if param.isA('ID', 'A') and self.__tok.peek().isA('OP', ','):
-            self.__tok.pop()
-            param = self.parseParam()
-        r8 = param.asReg8()
-        if r8 is not None:
-            self.__current_section.data.append(code_value | r8)
-        else:
-            self.__current_section.data.append(code_value | 0x46)
-            self.insert8(param)
-
-    def instrRST(self) -> None:
-        param = self.parseParam()
-        if param.isA('NUMBER') and isinstance(param, Token) and (int(param.value) & ~0x38) == 0:
-            self.__current_section.data.append(0xC7 | int(param.value))
-        else:
-            raise AssemblerException(param, "Syntax error")
-
-    def instrPUSHPOP(self, code_value: int) -> None:
-        param = self.parseParam()
-        if param.isA('ID') and isinstance(param, Token) and str(param.value) in REGS16B:
-            self.__current_section.data.append(code_value | (REGS16B[str(param.value)] << 4))
-        else:
-            raise AssemblerException(param, "Syntax error")
-
-    def instrJR(self) -> None:
-        param = self.parseParam()
-        if self.__tok.peek().isA('OP', ','):
-            self.__tok.pop()
-            condition = param
-            param = self.parseParam()
-            if condition.isA('ID') and isinstance(condition, Token) and str(condition.value) in FLAGS:
-                self.__current_section.data.append(0x20 | FLAGS[str(condition.value)])
-            else:
-                raise AssemblerException(condition, "Syntax error")
-        else:
-            self.__current_section.data.append(0x18)
-        self.insertRel8(param)
-
-    def instrCB(self, code_value: int) -> None:
-        param = self.parseParam()
-        r8 = param.asReg8()
-        if r8 is not None:
-            self.__current_section.data.append(0xCB)
-            self.__current_section.data.append(code_value | r8)
-        else:
-            raise AssemblerException(param, "Syntax error")
-
-    def instrBIT(self, code_value: int) -> None:
-        left_param = self.parseParam()
-        self.__tok.expect('OP', ',')
-        right_param = self.parseParam()
-        rr8 = right_param.asReg8()
-        if left_param.isA('NUMBER') and 0 <= left_param.value < 8 and isinstance(left_param, Token) and rr8 is not None:
-            self.__current_section.data.append(0xCB)
-            self.__current_section.data.append(code_value | (int(left_param.value) << 3) | rr8)
-        else:
-            raise AssemblerException(left_param, "Syntax error")
-
-    def instrRET(self) -> None:
-        if self.__tok.peek().isA('ID'):
-            condition = self.__tok.pop()
-            if condition.isA('ID') and condition.value in FLAGS:
-                self.__current_section.data.append(0xC0 | FLAGS[str(condition.value)])
-            else:
-                raise AssemblerException(condition, "Syntax error")
-        else:
-            self.__current_section.data.append(0xC9)
-
-    def instrCALL(self) -> None:
-        param = self.parseParam()
-        if self.__tok.peek().isA('OP', ','):
-            self.__tok.pop()
-            condition = param
-            param = self.parseParam()
-            if condition.isA('ID') and isinstance(condition, Token) and condition.value in FLAGS:
-                self.__current_section.data.append(0xC4 | FLAGS[str(condition.value)])
-            else:
-                raise AssemblerException(condition, "Syntax error")
-        else:
-            self.__current_section.data.append(0xCD)
-        self.insert16(param)
-
-    def instrJP(self) -> None:
-        param = self.parseParam()
-        if self.__tok.peek().isA('OP', ','):
-            self.__tok.pop()
-            condition = param
-            param = self.parseParam()
-            if condition.isA('ID') and isinstance(condition, Token) and condition.value in FLAGS:
-                self.__current_section.data.append(0xC2 | FLAGS[str(condition.value)])
+    def instruction(self, start: Token, encodings: Dict[Tuple[str, ...], Encoding]) -> None:
+        params: List[ExprBase] = []
+        if not self.__tok.peek().isA('NEWLINE'):
+            params.append(self.parseParam())
+            while self.__tok.popIf('OP', ','):
+                params.append(self.parseParam())
+        encoding = encodings.get(tuple(param.operandKey() for param in params))
+        if encoding is None:
+            raise AssemblerException(start, "Syntax error")
+        self.__current_section.instructions.append(len(self.__current_section.data))
+        self.__current_section.instruction_lines.append(start.line_nr)
+        opcode = encoding.opcode
+        for idx, kind in encoding.fields:
+            param = params[idx]
+            if not param.isA('NUMBER'):
+                raise AssemblerException(start, "Syntax error")
+            assert isinstance(param, Token)
+            value = int(param.value)
+            if kind == "bit<<3" and 0 <= value < 8:
+                opcode |= value << 3
+            elif kind == "rst" and (value & ~0x38) == 0:
+                opcode |= value
             else:
-                raise AssemblerException(condition, "Syntax error")
-        elif param.isA('ID', 'HL'):
-            self.__current_section.data.append(0xE9)
-            return
-        else:
-            self.__current_section.data.append(0xC3)
-        self.insert16(param)
-
-    def instrJPR(self) -> None:
-        param = self.parseParam()
-        self.__current_section.jpr_list.append(len(self.__current_section.data) + 1)
-        if self.__tok.peek().isA('OP', ','):
-            self.__tok.pop()
-            condition = param
-            param = self.parseParam()
-            if condition.isA('ID') and isinstance(condition, Token) and condition.value in FLAGS:
-                self.__current_section.data.append(0xC2 | FLAGS[str(condition.value)])
+                raise AssemblerException(start, "Syntax error")
+        if opcode > 0xFF:
+            self.__current_section.data.append(opcode >> 8)
+        self.__current_section.data.append(opcode & 0xFF)
+        for idx, kind in encoding.immediates:
+            param = params[idx]
+            if isinstance(param, REF):
+                param = param.expr
+            if kind == "n8":
+                self.insert8(param)
+            elif kind == "n16" or kind == "[n16]":
+                self.insert16(param)
+            elif kind == "rel8":
+                self.insertRel8(param)
+            elif kind == "[high8]":
+                self.insertHigh8(param)
+            elif kind == "jpr16":
+                self.__current_section.jpr_list.append(len(self.__current_section.data))
+                self.insert16(param)
             else:
-                raise AssemblerException(condition, "Syntax error")
-        else:
-            self.__current_section.data.append(0xC3)
-        self.insert16(param)
+                raise RuntimeError(kind)
 
     def instrDW(self) -> None:
         param = self.parseExpression()
@@ -1010,12 +1352,10 @@ class Assembler:
         if t.kind not in ('ID', 'NUMBER', 'STRING'):
             raise AssemblerException(t, "Unexpected")
         if t.isA('ID') and t.value in self.__constant:
-            t = t.copy()
-            t.kind = 'NUMBER'
-            t.value = self.__constant[str(t.value)]
+            t = Token('NUMBER', self.__constant[str(t.value)], t.line_nr)
         elif t.isA('ID') and str(t.value).startswith("."):
             assert self.__scope is not None
-            t.value = self.__scope + str(t.value)
+            t = Token('ID', self.__scope + str(t.value), t.line_nr)
         elif t.isA('ID') and self.__tok.peek().isA('OP', '('):
             self.__tok.pop()
             params = [self.parseExpression()]
@@ -1025,7 +1365,108 @@ class Assembler:
             return CALL(t.value, params, line_nr=t.line_nr)
         return t
 
-    def link(self) -> None:
+    def relaxJumps(self) -> None:
+        """Turn `jpr` jumps into `jr` where the target is in the same section and in range.
+        Shortening a jump only brings other jumps closer to their target, so passes are repeated until no more jumps
+        can be shortened. Data, relocations and labels are only updated once in a final sweep."""
+        self.__relax_passes = []
+        candidates: Dict[Section, List[Tuple[int, int]]] = {}
+        for section in self.__sections:
+            for jpr_offset in section.jpr_list:
+                link_type, target = section.link[jpr_offset]
+                if target.isA('ID') and target.value in self.__label:
+                    target_section, target_offset = self.__label[str(target.value)]
+                    if target_section == section:
+                        candidates.setdefault(section, []).append((jpr_offset, target_offset))
+        # Offset delta table per section: sorted operand offsets of the shortened jumps. Every byte after a
+        # shortened jump operand moves down by one, so the new offset is the offset minus the jumps before it.
+        shortened: Dict[Section, List[int]] = {section: [] for section in candidates}
+        while True:
+            count = 0
+            for section, jumps in candidates.items():
+                table = shortened[section]
+                remaining = []
+                newly_shortened = []
+                for jpr_offset, target_offset in jumps:
+                    new_offset = jpr_offset - bisect.bisect_left(table, jpr_offset)
+                    new_target = target_offset - bisect.bisect_left(table, target_offset)
+                    if target_offset > jpr_offset:
+                        new_target -= 1  # This jump itself is shortened as well
+                    if -128 <= new_target - new_offset - 1 < 128:
+                        newly_shortened.append(jpr_offset)
+                    else:
+                        remaining.append((jpr_offset, target_offset))
+                if newly_shortened:
+                    shortened[section] = sorted(table + newly_shortened)
+                    candidates[section] = remaining
+                    count += len(newly_shortened)
+            if count == 0:
+                break
+            self.__relax_passes.append(count)
+
+        for section, table in shortened.items():
+            if not table:
+                continue
+            data = bytearray()
+            start = 0
+            for jpr_offset in table:
+                data += section.data[start:jpr_offset + 1]
+                data[-2] = JP_TO_JR[data[-2]]
+                start = jpr_offset + 2
+            data += section.data[start:]
+            section.data = data
+            short = set(table)
+            section.link = {o - bisect.bisect_left(table, o): (self.LINK_REL8 if o in short else link_type, expr) for o, (link_type, expr) in section.link.items()}
+            section.jpr_list = [o - bisect.bisect_left(table, o) for o in section.jpr_list if o not in short]
+            section.instructions = [o - bisect.bisect_left(table, o) for o in section.instructions]
+        for label, (section, offset) in self.__label.items():
+            table = shortened.get(section)
+            if table:
+                self.__label[label] = (section, offset - bisect.bisect_left(table, offset))
+
+    def getRelaxationStats(self) -> List[int]:
+        """Number of jumps shortened in each pass of the last relaxJumps call."""
+        return list(self.__relax_passes)
+
+    def stripSections(self, keep: Iterable[str]) -> None:
+        """Remove relocatable sections that cannot be reached through relocations from the kept labels or from any
+        section at a fixed address."""
+        todo = [section for section in self.__sections if section.base_address != -2]
+        for name in keep:
+            # Labels are case insensitive, they are stored upper case.
+            if name.upper() not in self.__label:
+                raise AssemblerException(None, f"Cannot find label to keep: {name}")
+            todo.append(self.__label[name.upper()][0])
+        reachable: Set[Section] = set()
+        names: Dict[tuple, List[str]] = {}
+        while todo:
+            section = todo.pop()
+            if section in reachable:
+                continue
+            reachable.add(section)
+            for link_type, expr in section.link.values():
+                if expr.key not in names:
+                    names[expr.key] = list(referencedNames(expr))
+                for name in names[expr.key]:
+                    if name in self.__label:
+                        todo.append(self.__label[name][0])
+        removed = [section for section in self.__sections if section not in reachable]
+        self.__strip_stats = (len(removed), sum(len(section.data) for section in removed))
+        self.__sections = [section for section in self.__sections if section in reachable]
+        self.__label = {label: (section, offset) for label, (section, offset) in self.__label.items() if section in reachable}
+
+    def getStripStats(self) -> Tuple[int, int]:
+        """Number of sections and bytes removed by the last stripSections call."""
+        return self.__strip_stats
+
+    def getPeepholeStats(self) -> Dict[str, int]:
+        """Number of times each peephole rule was applied by the last link."""
+        return dict(self.__peephole_stats)
+
+    def link(self, *, keep: Optional[Iterable[str]] = None, optimize: bool = False) -> None:
+        """Place and link all sections. When labels to keep are given, unreferenced sections are removed first.
+        With optimize the peephole optimizer runs on all instructions before they are placed."""
+        self.__resolved = {}
         for token, expr in self.__asserts:
             result = self.resolveExpr(expr)
             if not result.isA('NUMBER'):
@@ -1034,54 +1475,32 @@ class Assembler:
             value = int(result.value)
             if value == 0:
                 raise AssemblerException(token, f"Assertion failed")
-        for section in self.__sections:
-            for jpr_offset in sorted(section.jpr_list, reverse=True):
-                link_type, target = section.link[jpr_offset]
-                if target.kind == "ID" and target.value in self.__label:
-                    target_section, target_offset = self.__label[target.value]
-                    diff = target_offset - jpr_offset
-                    if target_section == section and -128 <= diff < 128:
-                        section.link[jpr_offset] = (self.LINK_REL8, target)
-                        section.data.pop(jpr_offset)
-                        section.data[jpr_offset-1] = JP_TO_JR[section.data[jpr_offset-1]]
-                        section.link = {o if o <= jpr_offset else o - 1: t for o, t in section.link.items()}
-                        for k, (s, o) in self.__label.items():
-                            if s == section and o > jpr_offset:
-                                self.__label[k] = (s, o - 1)
+        if keep is not None:
+            self.stripSections(keep)
+        if optimize:
+            self.__peephole_stats = PeepholeOptimizer(self.__sections, self.__label, self.__knownAddress).run()
+        self.relaxJumps()
         sa = SpaceAllocator()
         for section in self.__sections:
             if 0 <= section.base_address < 0x8000 and section.bank is not None:
                 sa.allocate_fixed(section.bank, section.base_address, len(section.data))
+        # Best fit decreasing: sections tied to a bank go first, then the largest sections, so small sections end up
+        # filling the gaps that are left and new banks are only opened when nothing fits anymore.
+        relocatable = [section for section in self.__sections if section.base_address == -2]
+        for section in sorted(relocatable, key=lambda section: (section.bank is None, -len(section.data))):
+            b, a = sa.allocate(len(section.data), section.bank)
+            section.base_address = a
+            section.bank = b
+        self.__space_allocator = sa
+        # Label values are final now, every distinct expression is resolved only once from here on.
+        self.__resolved = {}
+        inline_addresses = self.placeInlineData(sa)
         for section in self.__sections:
-            if section.base_address == -2:
-                b, a = sa.allocate(len(section.data), section.bank)
-                section.base_address = a
-                section.bank = b
-        for section in self.__sections:
-            inline_strings: Dict[bytes, int] = {}
             for offset, (link_type, link_expr) in section.link.items():
                 expr = self.resolveExpr(link_expr)
                 assert expr is not None
-                if expr.isA('STRING') and expr.value.startswith("i"):
-                    strdata = expr.value[2:-1].encode("ascii") + b'\x00'
-                    if strdata not in inline_strings:
-                        inline_strings[strdata] = len(section.data) + section.base_address
-                        section.data += strdata
-                    expr = Token('NUMBER', inline_strings[strdata], expr.line_nr)
-                if isinstance(expr, CALL) and expr.function == 'INLINE':
-                    data = bytearray()
-                    for p in expr.params:
-                        p = self.resolveExpr(p)
-                        if not p.isA('NUMBER'):
-                            raise AssemblerException(p, f"Failed to link {p}, symbol not found?")
-                        if p.value < 0 or p.value > 255:
-                            raise AssemblerException(p, f"Value out of range for INLINE")
-                        data.append(p.value)
-                    data = bytes(data)
-                    if data not in inline_strings:
-                        inline_strings[data] = len(section.data) + section.base_address
-                        section.data += data
-                    expr = Token('NUMBER', inline_strings[data], expr.line_nr)
+                if (section, offset) in inline_addresses:
+                    expr = Token('NUMBER', inline_addresses[(section, offset)], expr.line_nr)
                 if not expr.isA('NUMBER'):
                     raise AssemblerException(expr, f"Failed to link {link_expr}:{link_type}, symbol not found?")
                 assert isinstance(expr, Token)
@@ -1105,10 +1524,97 @@ class Assembler:
                 else:
                     raise RuntimeError
 
+    def placeInlineData(self, sa: SpaceAllocator) -> Dict[Tuple[Section, int], int]:
+        """Place the data of inline strings and INLINE() calls, returns the address for each link that uses them.
+        Data is pooled per bank, so identical data used by many sections is only stored once. Data used from
+        multiple banks goes to bank 0, which is always mapped in."""
+        inline_data: Dict[Tuple[Section, int], bytes] = {}
+        data_banks: Dict[bytes, Set[int]] = {}
+        local_data: Dict[Section, List[bytes]] = {}
+        for section in self.__sections:
+            for offset, (link_type, link_expr) in section.link.items():
+                data = self.__inlineData(self.resolveExpr(link_expr))
+                if data is None:
+                    continue
+                inline_data[(section, offset)] = data
+                if section.bank is not None and 0 <= section.base_address < 0x8000:
+                    data_banks.setdefault(data, set()).add(section.bank)
+                else:
+                    # Sections that are not placed in ROM banks keep their data directly behind their own.
+                    local_data.setdefault(section, []).append(data)
+        pools: Dict[int, List[bytes]] = {}
+        for data, banks in data_banks.items():
+            pools.setdefault(min(banks) if len(banks) == 1 else 0, []).append(data)
+        pool_addresses: Dict[Tuple[Optional[Section], bytes], int] = {}
+        for bank, blobs in sorted(pools.items()):
+            pool, offsets = buildConstantPool(blobs)
+            try:
+                b, a = sa.allocate(len(pool), bank)
+            except AssemblerException:
+                if bank == 0:
+                    raise
+                b, a = sa.allocate(len(pool), 0)
+            pool_section = Section(a, b)
+            pool_section.data = pool
+            self.__sections.append(pool_section)
+            for data, offset in offsets.items():
+                pool_addresses[(None, data)] = a + offset
+        for section, blobs in local_data.items():
+            pool, offsets = buildConstantPool(blobs)
+            for data, offset in offsets.items():
+                pool_addresses[(section, data)] = section.base_address + len(section.data) + offset
+            section.data += pool
+        result = {}
+        for (section, offset), data in inline_data.items():
+            address = pool_addresses.get((section, data))
+            result[(section, offset)] = address if address is not None else pool_addresses[(None, data)]
+        return result
+
+    def __inlineData(self, expr: Optional[ExprBase]) -> Optional[bytes]:
+        if expr is None:
+            return None
+        if expr.isA('STRING') and str(expr.value).startswith("i"):
+            return str(expr.value)[2:-1].encode("ascii") + b'\x00'
+        if isinstance(expr, CALL) and expr.function == 'INLINE':
+            data = bytearray()
+            for p in expr.params:
+                p = self.resolveExpr(p)
+                if not p.isA('NUMBER'):
+                    raise AssemblerException(p, f"Failed to link {p}, symbol not found?")
+                if p.value < 0 or p.value > 255:
+                    raise AssemblerException(p, f"Value out of range for INLINE")
+                data.append(p.value)
+            return bytes(data)
+        return None
+
+    def __knownAddress(self, expr: ExprBase) -> Optional[int]:
+        """Value of an expression that only uses constants and labels of data sections at a fixed address."""
+        for name in referencedNames(expr):
+            if name in self.__label:
+                section = self.__label[name][0]
+                if section.base_address < 0 or section.instructions:
+                    return None
+            elif name not in self.__constant:
+                return None
+        result = self.resolveExpr(expr)
+        if result is None or not result.isA('NUMBER'):
+            return None
+        assert isinstance(result, Token)
+        return int(result.value)
+
     def resolveExpr(self, expr: Optional[ExprBase]) -> Optional[ExprBase]:
         if expr is None:
             return None
-        elif isinstance(expr, OP):
+        if isinstance(expr, Token) and expr.kind != 'ID':
+            return expr
+        result = self.__resolved.get(expr.key)
+        if result is None:
+            result = self.__resolveExpr(expr)
+            self.__resolved[expr.key] = result
+        return result
+
+    def __resolveExpr(self, expr: ExprBase) -> ExprBase:
+        if isinstance(expr, OP):
             left = self.resolveExpr(expr.left)
             assert left is not None
             return OP.make(expr.op, left, self.resolveExpr(expr.right))
@@ -1137,11 +1643,37 @@ class Assembler:
         elif isinstance(expr, Token) and expr.isA('ID') and isinstance(expr, Token) and expr.value in self.__label:
             section, offset = self.__label[str(expr.value)]
             return Token('NUMBER', offset + section.base_address, expr.line_nr)
+        elif isinstance(expr, Token) and expr.isA('ID') and expr.value in self.__constant:
+            # Constants from other objects are only known at link time.
+            return Token('NUMBER', self.__constant[str(expr.value)], expr.line_nr)
         return expr
 
+    def getObject(self) -> ObjectFile:
+        obj = ObjectFile()
+        obj.sections = list(self.__sections)
+        section_index = {section: idx for idx, section in enumerate(obj.sections)}
+        obj.labels = {label: (section_index[section], offset) for label, (section, offset) in self.__label.items()}
+        obj.constants = dict(self.__constant)
+        obj.asserts = list(self.__asserts)
+        return obj
+
+    def addObject(self, obj: ObjectFile) -> None:
+        """Add the sections and symbols of an object, the sections are taken over and modified by link()."""
+        self.__sections += obj.sections
+        for label, (idx, offset) in obj.labels.items():
+            assert label not in self.__label, "Duplicate label: %s" % (label)
+            assert label not in self.__constant, "Duplicate label: %s" % (label)
+            self.__label[label] = obj.sections[idx], offset
+        for name, value in obj.constants.items():
+            self.setConstant(name, value)
+        self.__asserts += obj.asserts
+
     def getSections(self) -> Iterator[Section]:
         return iter(self.__sections)
 
+    def getBankUsage(self) -> List[Tuple[int, int, int, int]]:
+        return self.__space_allocator.getBankUsage()
+
     def getLabels(self) -> Generator[Tuple[str, int, int], None, None]:
         for label, (section, address) in self.__label.items():
             yield label, address + section.base_address, section.bank
@@ -1150,6 +1682,70 @@ class Assembler:
         section, offset = self.__label[name.upper()]
         return section.base_address + offset, section.bank
 
+    def getListing(self) -> List[Tuple[int, int, bytes, int, Tuple[int, int], str]]:
+        """Every placed instruction as (bank, address, bytes, source line, M-cycles taken/not taken, text)."""
+        result = []
+        for section in self.__sections:
+            for offset, line_nr in zip(section.instructions, section.instruction_lines):
+                opcode = section.data[offset] if section.data[offset] != 0xCB else 0xCB00 | section.data[offset + 1]
+                data = bytes(section.data[offset:offset + OPCODE_SIZES[opcode]])
+                link = {o - offset: section.link[o] for o in range(offset, offset + len(data)) if o in section.link}
+                address = section.base_address + offset
+                text, cycles = disassemble(data, link, address)
+                result.append((section.bank or 0, address, data, line_nr, cycles, text))
+        result.sort(key=lambda entry: (entry[0], entry[1]))
+        return result
+
+
+OPCODE_SIZES = opcodeSizes(Assembler.INSTRUCTIONS)
+# Mnemonic, operand keys and encoding per opcode, when encodings overlap the first one wins like when assembling.
+OPCODE_TABLE: Dict[int, Tuple[str, Tuple[str, ...], Encoding]] = {}
+for _opcode, _mnemonic, _keys, _encoding in opcodeVariants(Assembler.INSTRUCTIONS):
+    OPCODE_TABLE.setdefault(_opcode, (_mnemonic, _keys, _encoding))
+
+
+def formatExpr(expr: ExprBase) -> str:
+    if isinstance(expr, Token):
+        if expr.kind == 'NUMBER' and not 0 <= int(expr.value) < 10:
+            return f"${int(expr.value):X}" if int(expr.value) > 0 else str(expr.value)
+        return str(expr.value)
+    if isinstance(expr, OP):
+        left = f"({formatExpr(expr.left)})" if isinstance(expr.left, OP) else formatExpr(expr.left)
+        if expr.right is None:
+            return f"{expr.op}{left}"
+        right = f"({formatExpr(expr.right)})" if isinstance(expr.right, OP) else formatExpr(expr.right)
+        return f"{left} {expr.op} {right}"
+    if isinstance(expr, REF):
+        return f"[{formatExpr(expr.expr)}]"
+    if isinstance(expr, CALL):
+        return f"{expr.function}({', '.join(formatExpr(param) for param in expr.params)})"
+    return repr(expr)
+
+
+def disassemble(data: bytes, link: Dict[int, Tuple[int, ExprBase]], address: int) -> Tuple[str, Tuple[int, int]]:
+    """Text and M-cycles of the instruction at the start of data. Relocations in link are relative to the
+    instruction, operands that have one are shown as the original expression."""
+    opcode = data[0] if data[0] != 0xCB else 0xCB00 | data[1]
+    mnemonic, keys, encoding = OPCODE_TABLE[opcode]
+    operands = [key.lower() for key in keys]
+    for idx, kind in encoding.fields:
+        operands[idx] = str((opcode >> 3) & 7) if kind == "bit<<3" else f"${opcode & 0x38:02X}"
+    position = 2 if opcode > 0xFF else 1
+    for idx, kind in encoding.immediates:
+        if position in link:
+            text = formatExpr(link[position][1])
+        elif kind == "rel8":
+            text = f"${address + position + 1 + (data[position] ^ 0x80) - 0x80:04X}"
+        elif kind == "[high8]":
+            text = f"$FF{data[position]:02X}"
+        elif IMMEDIATE_SIZES[kind] == 2:
+            text = f"${data[position] | (data[position + 1] << 8):04X}"
+        else:
+            text = f"${data[position]:02X}"
+        operands[idx] = f"[{text}]" if keys[idx] == "[n]" else text
+        position += IMMEDIATE_SIZES[kind]
+    return f"{mnemonic.lower()} {', '.join(operands)}".strip(), instructionCycles(mnemonic, keys, position)
+
 
 def ASM(code: str, base_address: Optional[int] = None, labels_result: Optional[Dict[str, int]] = None) -> bytes:
     asm = Assembler()
@@ -0,0 +1,109 @@
+from typing import Dict, List, Set
+
+from .exception import CompileException
+from .parse.function import Function
+from .pseudo import OP_CALL, OP_STORE, PseudoOp
+
+
+class CallGraph:
+    """Calls between functions, found from the OP_CALL pseudo ops. Parameters and locals live at fixed addresses,
+    so recursion cannot work, and functions that are never active at the same time can share their storage."""
+
+    def __init__(self, funcs: Dict[str, Function], ops: Dict[str, List[PseudoOp]]):
+        self.funcs = funcs
+        self.calls: Dict[str, List[str]] = {name: [] for name in funcs}
+        # Functions called between storing the first argument of a call and making that call. These run while
+        # the arguments are already in place, so they cannot share storage with the function that is called.
+        self.argument_calls: Dict[str, Set[str]] = {name: set() for name in funcs}
+        param_labels = {f"local_{func.name}_{param.token.value}": name for name, func in funcs.items() for param in func.parameters}
+        for name, func_ops in ops.items():
+            pending: List[str] = []
+            for op in func_ops:
+                if op.kind == OP_STORE and op.args[1] in param_labels:
+                    if param_labels[op.args[1]] not in pending:
+                        pending.append(param_labels[op.args[1]])
+                elif op.kind == OP_CALL:
+                    callee = op.args[0]
+                    if callee not in self.calls[name]:
+                        self.calls[name].append(callee)
+                    if callee in pending:
+                        pending.remove(callee)
+                    for other in pending:
+                        self.argument_calls[other].add(callee)
+
+    def check_recursion(self) -> None:
+        for name in self.funcs:
+            for callee in self.argument_calls[name]:
+                if name in self.reachable(callee):
+                    raise CompileException(self.funcs[name].token, f"Cannot call {callee} in the arguments of {name}, it calls {name}")
+        active: List[str] = []
+        done: Set[str] = set()
+
+        def visit(name: str) -> None:
+            active.append(name)
+            for callee in self.calls[name]:
+                if callee in active:
+                    cycle = active[active.index(callee):] + [callee]
+                    raise CompileException(self.funcs[callee].token, f"Recursion is not supported: {' -> '.join(cycle)}")
+                if callee not in done:
+                    visit(callee)
+            active.pop()
+            done.add(name)
+
+        for name in self.funcs:
+            if name not in done:
+                visit(name)
+
+    def reachable(self, name: str) -> Set[str]:
+        """The function and everything it can call, directly or indirectly."""
+        result = {name}
+        todo = [name]
+        while todo:
+            for callee in self.calls[todo.pop()]:
+                if callee not in result:
+                    result.add(callee)
+                    todo.append(callee)
+        return result
+
+    def conflicts(self) -> Dict[str, Set[str]]:
+        """For every function the functions that can be active at the same time."""
+        result: Dict[str, Set[str]] = {name: set() for name in self.funcs}
+        for name in self.funcs:
+            for other in self.reachable(name) - {name}:
+                result[name].add(other)
+                result[other].add(name)
+            for callee in self.argument_calls[name]:
+                for other in self.reachable(callee) - {name}:
+                    result[name].add(other)
+                    result[other].add(name)
+        return result
+
+    def callers_first(self) -> List[str]:
+        callers = {name: 0 for name in self.funcs}
+        for callees in self.calls.values():
+            for callee in callees:
+                callers[callee] += 1
+        todo = [name for name, count in callers.items() if count == 0]
+        result = []
+        while todo:
+            name = todo.pop(0)
+            result.append(name)
+            for callee in self.calls[name]:
+                callers[callee] -= 1
+                if callers[callee] == 0:
+                    todo.append(callee)
+        return result
+
+    def overlay(self, sizes: Dict[str, int]) -> Dict[str, int]:
+        """Offsets of the local storage of each function. Every function takes the lowest offset that does not
+        overlap a function that can be active at the same time. Requires a call graph without recursion."""
+        conflicts = self.conflicts()
+        offsets: Dict[str, int] = {}
+        for name in self.callers_first():
+            offset = 0
+            for start, end in sorted((offsets[other], offsets[other] + sizes[other]) for other in conflicts[name] if other in offsets and sizes[other]):
+                if offset + sizes[name] <= start:
+                    break
+                offset = max(offset, end)
+            offsets[name] = offset
+        return offsets
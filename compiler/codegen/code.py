@@ -1,8 +1,10 @@
 
 class Code:
-    def __init__(self):
+    def __init__(self, favor_size: bool = False):
         self.code = ""
         self.addition = ""
+        # Handlers with a choice between a shorter and a faster sequence pick the shorter one.
+        self.favor_size = favor_size
 
     def comment(self, line):
         self.code += f"; {line}\n"
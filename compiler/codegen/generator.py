@@ -1,30 +1,35 @@
+from typing import Optional, Tuple
+
 from ..pseudo import *
 from .code import Code
 from .register import RegisterAllocator
-from .handler import handler, get_handlers
+from .handler import HandlerStats, handler, match_handlers
 from .u8 import memory
 from .u8 import arithmetic
 from .u16 import memory
 from .u16 import arithmetic
 
 
+LOGIC_CALL = {"==": "__logic_equal", "!=": "__logic_not_equal", "<": "__logic_less", ">": "__logic_greater"}
+LOGIC_SWAPPED = {"==": "==", "!=": "!=", "<": ">", ">": "<"}
+
+
 @handler(8, OP_LOGIC)
 def op_handler(code: Code, ra: RegisterAllocator, op):
+    if op.args[0] not in LOGIC_CALL:
+        raise RuntimeError(f"No codegen implementation for {op}")
     r0 = ra.get(op.args[1])
+    if r0 != 'A' and ra.get(op.args[2]) == 'A':
+        # Compare the other way around, instead of moving both values
+        code.add(f"cp A, {r0}")
+        code.add(f"call {LOGIC_CALL[LOGIC_SWAPPED[op.args[0]]]}")
+        ra.reg_replaced_by(op.args[1], op.args[2])
+        return True
     if r0 != 'A':
         r0 = ra.move_reg(r0, "A")
     r1 = ra.get(op.args[2])
     code.add(f"cp {r0}, {r1}")
-    if op.args[0] == "==":
-        code.add("call __logic_equal")
-    elif op.args[0] == "!=":
-        code.add("call __logic_not_equal")
-    elif op.args[0] == "<":
-        code.add("call __logic_less")
-    elif op.args[0] == ">":
-        code.add("call __logic_greater")
-    else:
-        raise RuntimeError(f"No codegen implementation for {op}")
+    code.add(f"call {LOGIC_CALL[op.args[0]]}")
     ra.free(op.args[2])
     return True
 
@@ -114,8 +119,8 @@ def op_handler_cast(code: Code, ra: RegisterAllocator, op):
         r0 = ra.get(op.args[0])
         ra.free(op.args[0])
         r1 = ra.alloc16(op.args[0])
-        code.add(f"ld {r1[0]}, 0")
         code.add(f"ld {r1[1]}, {r0}")
+        code.add(f"ld {r1[0]}, 0")
         return True
     return False
 
@@ -153,12 +158,22 @@ def op_handler_store_ref(code: Code, ra: RegisterAllocator, op):
     return True
 
 
-def gen_code(ps: PseudoState):
-    code = Code()
-    ra = RegisterAllocator(code)
+@handler(8, OP_COPY)
+def op_handler_copy(code: Code, ra: RegisterAllocator, op):
+    r0 = ra.alloc(op.args[0])
+    r1 = ra.get(op.args[1])
+    code.add(f"ld {r0}, {r1}")
+    return True
+
+
+def gen_code(ps: PseudoState, spill_prefix: str = "_spill", stats: Optional[HandlerStats] = None,
+             favor_size: bool = False) -> Tuple[str, int]:
+    """The asm code of the ops, and the bytes of HRAM it uses for spilled values."""
+    code = Code(favor_size)
+    ra = RegisterAllocator(code, ps.volatile, ps.ops, spill_prefix)
     for op in ps.ops:
         if op.kind in {OP_ARITHMETIC, OP_LOGIC, OP_JUMP_ZERO}:
-            ra.set_alu_result(op.args[1])
+            ra.set_alu_result(op.args[1], op.size)
         if op.kind in {OP_LOAD, OP_STORE} and op.size == 8:
             ra.set_alu_result(op.args[0])
     idx = 0
@@ -166,27 +181,27 @@ def gen_code(ps: PseudoState):
         op = ps.ops[idx]
         if op.kind == OP_LABEL:
             code.add(f"._{op.args[0]}:")
+            ra.forget_all()
             idx += 1
         else:
+            ra.begin(idx, ps.ops[idx:idx+1])
             done = False
-            for h in get_handlers(op):
+            for h in match_handlers(ps.ops, idx):
                 ops = ps.ops[idx+1:idx+1+len(h.ops)]
-                if ops_match(ops, h.ops) and h(code, ra, op, *ops):
+                fired = h(code, ra, op, *ops)
+                if stats is not None:
+                    stats.count(h, fired)
+                if fired:
                     code.comment(f"{op}")
                     for o in ops:
                         code.comment(f"{o}")
+                    if any(o.kind in {OP_CALL, OP_STORE_REF} for o in (op, *ops)):
+                        # The called function or the pointer can change any register or label
+                        ra.forget_all()
                     done = True
                     idx += 1 + len(ops)
                     break
             if not done:
                 raise RuntimeError(f"No codegen implementation for {op}")
         code.finish()
-    return code.code
-
-def ops_match(ops, target_ops):
-    if len(ops) != len(target_ops):
-        return False
-    for a, b in zip(ops, target_ops):
-        if a.kind != b:
-            return False
-    return True
+    return code.code, ra.spill_size
@@ -1,6 +1,18 @@
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
 
+from ..pseudo import OP_NAMES, PseudoOp
 
 _handlers = {}
+# The handlers of each (size, main op) as a trie on the kinds of the ops that follow, built when first needed.
+_tries: Dict[Tuple[int, int], "_Node"] = {}
+
+
+class _Node:
+    def __init__(self):
+        # Handlers that match when the ops up to here match, in the order they are tried.
+        self.handlers: List[Callable] = []
+        self.next: Dict[int, "_Node"] = {}
+
 
 def handler(size: int, main_op, *ops, priority=50):
     def impl(f):
@@ -11,12 +23,56 @@ def handler(size: int, main_op, *ops, priority=50):
         f.size = size
         f.priority = priority
         f.ops = ops
+        f.name = f"{' '.join(OP_NAMES[kind] for kind in (main_op, *ops))} ({size})"
         _handlers[size][main_op].append(f)
         _handlers[size][main_op].sort(key=lambda n: (-len(n.ops), n.priority))
+        _tries.pop((size, main_op), None)
         return f
     return impl
 
-def get_handlers(op):
-    if op.size in _handlers and op.kind in _handlers[op.size]:
-        return _handlers[op.size][op.kind]
-    return []
\ No newline at end of file
+def _build_trie(size: int, main_op) -> _Node:
+    root = _Node()
+    for f in _handlers.get(size, {}).get(main_op, []):
+        node = root
+        for kind in f.ops:
+            node = node.next.setdefault(kind, _Node())
+        node.handlers.append(f)
+    return root
+
+def match_handlers(ops: Sequence[PseudoOp], idx: int) -> Iterator[Callable]:
+    """The handlers whose op kinds match the ops from idx on, longest match first and by priority after that."""
+    op = ops[idx]
+    key = (op.size, op.kind)
+    if key not in _tries:
+        _tries[key] = _build_trie(op.size, op.kind)
+    node = _tries[key]
+    matched = [node.handlers]
+    for following in range(idx + 1, len(ops)):
+        node = node.next.get(ops[following].kind)
+        if node is None:
+            break
+        matched.append(node.handlers)
+    for handlers in reversed(matched):
+        yield from handlers
+
+
+class HandlerStats:
+    """How often each handler was tried, and how often it generated the code, for the ops it was tried on."""
+
+    def __init__(self):
+        self.tried: Dict[str, int] = {}
+        self.fired: Dict[str, int] = {}
+
+    def count(self, f, fired: bool) -> None:
+        self.tried[f.name] = self.tried.get(f.name, 0) + 1
+        if fired:
+            self.fired[f.name] = self.fired.get(f.name, 0) + 1
+
+    def add(self, other: "HandlerStats") -> None:
+        for name, tried in other.tried.items():
+            self.tried[name] = self.tried.get(name, 0) + tried
+        for name, fired in other.fired.items():
+            self.fired[name] = self.fired.get(name, 0) + fired
+
+    def __repr__(self):
+        return ", ".join(f"{name} {self.fired.get(name, 0)}/{tried}" for name, tried in self.tried.items())
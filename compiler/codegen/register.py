@@ -1,6 +1,8 @@
-from typing import Set
+from bisect import bisect_left
+from typing import AbstractSet, Dict, List, Optional, Sequence, Set, Tuple
 
 from ..pseudo import *
+from ..optimizer.cfg import RESULT_ARG, registers
 from .code import Code
 
 FLAG_ALU_RESULT = 1
@@ -10,50 +12,101 @@ ALL_REGS16 = ["BC", "DE", "HL"]
 
 
 class RegisterAllocator:
-    def __init__(self, code: Code):
+    """Assigns the virtual registers of the pseudo ops to cpu registers while the handlers generate code.
+
+    The live ranges of the virtual registers are known from the ops up front. When the registers run out, the
+    value that is used again the latest is spilled: constants are loaded again when they are needed, other values
+    are stored to a slot in HRAM and loaded back when a handler gets them.
+    """
+
+    def __init__(self, code: Code, volatile: AbstractSet[str] = frozenset(), ops: Sequence[PseudoOp] = (), spill_prefix: str = "_spill"):
         self._code = code
         self._flags = {}
         self._free_regs = {"A", "B", "C", "D", "E", "H", "L"}
         self._alloc = {}
         self._reg_is = {}
+        # Free registers and register pairs that still hold the value last stored to a label, as (label, size).
+        # Only valid until the register is written, or memory changes behind our back.
+        self._mirrors: Dict[str, Tuple[str, int]] = {}
+        self._volatile = volatile
+        # Positions of the ops that use each virtual register, and the constants that can be loaded again instead of
+        # spilled, as (value, position of the first op that changes the register).
+        self._uses: Dict[int, List[int]] = {}
+        self._constants: Dict[int, Tuple[int, int]] = {}
+        for idx, op in enumerate(ops):
+            for nr in registers(op):
+                self._uses.setdefault(nr, []).append(idx)
+            if op.kind == OP_LOAD_VALUE:
+                self._constants[op.args[0]] = (op.args[1] & ((1 << op.size) - 1), len(ops))
+            elif op.kind == OP_COPY and op.args[1] in self._constants and self._constants[op.args[1]][1] == len(ops):
+                self._constants[op.args[0]] = (self._constants[op.args[1]][0], len(ops))
+            elif op.kind in RESULT_ARG and op.args[RESULT_ARG[op.kind]] in self._constants:
+                nr = op.args[RESULT_ARG[op.kind]]
+                if self._constants[nr][1] == len(ops):
+                    self._constants[nr] = (self._constants[nr][0], idx)
+        self._position = 0
+        self._end = len(ops)
+        # Virtual registers the current handler works with, which are never spilled, and the registers it freed,
+        # which it can still read.
+        self._pinned: Set[int] = set()
+        self._released: Set[str] = set()
+        # Spilled virtual registers, as (HRAM slot, size, value). Constants have no slot.
+        self._spilled: Dict[int, Tuple[Optional[int], int, Optional[int]]] = {}
+        self._slots: List[bool] = []
+        self._spill_prefix = spill_prefix
+
+    @property
+    def spill_size(self) -> int:
+        """Bytes of HRAM the function needs for spilled values."""
+        return len(self._slots)
+
+    def begin(self, position: int, ops: Sequence[PseudoOp] = ()) -> None:
+        """Start generating code for the op at position, the registers of the ops stay where they are."""
+        self._position = position
+        self._pinned = {nr for op in ops for nr in registers(op)}
+        self._released = set()
 
-    def set_alu_result(self, nr: int) -> None:
-        self._flags[nr] = self._flags.get(nr, 0) | FLAG_ALU_RESULT
+    def set_alu_result(self, nr: int, size: int = 8) -> None:
+        """The value of nr is used as an ALU result while it has the size, which works best in A or HL."""
+        self._flags[nr, size] = self._flags.get((nr, size), 0) | FLAG_ALU_RESULT
 
-    def alloc(self, nr: int) -> str:
+    def alloc(self, nr: int, prefer: Optional[str] = None) -> str:
         assert nr not in self._alloc
-        flags = self._flags.get(nr, 0)
+        self._pinned.add(nr)
+        flags = self._flags.get((nr, 8), 0)
         allowed = {"A", "B", "C", "D", "E", "H", "L"}
         if flags & FLAG_ALU_RESULT:
             allowed = {"A"}
         options = allowed.intersection(self._free_regs)
-        if not options and self._free_regs:
-            # Move an allowed reg to a free reg
-            pick = self._pick_best_reg(allowed)
-            self._move_reg(pick, self._pick_best_reg(self._free_regs))
+        if not options and flags & FLAG_ALU_RESULT:
+            # Move the value in A to a free reg
+            self._vacate("A")
+            options = {"A"}
+        elif not options:
+            self._spill(self._victim())
+            options = set(self._free_regs)
+        if prefer in options:
+            pick = prefer
         else:
             pick = self._pick_best_reg(options)
-        self._alloc[nr] = pick
-        self._reg_is[pick] = nr
-        self._free_regs.remove(pick)
+        self._assign(nr, pick)
         return pick
 
-    def alloc16(self, nr: int) -> str:
+    def alloc16(self, nr: int, prefer: Optional[str] = None) -> str:
         assert nr not in self._alloc
-        flags = self._flags.get(nr, 0)
+        self._pinned.add(nr)
+        flags = self._flags.get((nr, 16), 0)
         allowed = {"BC", "DE", "HL"}
         if flags & FLAG_ALU_RESULT:
             allowed = {"HL"}
         options = {opt for opt in allowed if opt[0] in self._free_regs and opt[1] in self._free_regs}
-        if not options and self._free_regs:
-            raise NotImplementedError(f"Want {allowed} but free: {self._free_regs} (flags: {flags})")
+        if not options:
+            pick = self._vacate16(allowed)
+        elif prefer in options:
+            pick = prefer
         else:
             pick = self._pick_best_reg16(options)
-        self._alloc[nr] = pick
-        self._reg_is[pick[0]] = nr
-        self._reg_is[pick[1]] = nr
-        self._free_regs.remove(pick[0])
-        self._free_regs.remove(pick[1])
+        self._assign(nr, pick)
         return pick
 
     def is_free(self, *regs) -> bool:
@@ -62,7 +115,17 @@ class RegisterAllocator:
                 return False
         return True
 
+    def make_free(self, reg: str) -> None:
+        """Move the value out of reg, for handlers that need it as scratch register."""
+        self._vacate(reg)
+
     def free(self, nr):
+        if nr in self._spilled:
+            slot, size, _ = self._spilled.pop(nr)
+            if slot is not None:
+                for offset in range(slot, slot + size // 8):
+                    self._slots[offset] = False
+            return
         reg = self._alloc[nr]
         if len(reg) == 2:
             self._reg_is.pop(reg[0])
@@ -74,13 +137,16 @@ class RegisterAllocator:
             self._reg_is.pop(reg)
             self._alloc.pop(nr)
             self._free_regs.add(reg)
+        self._released.update(reg)
 
     def get(self, nr):
+        self._pinned.add(nr)
+        if nr in self._spilled:
+            self._reload(nr)
         return self._alloc[nr]
 
     def move_reg(self, from_reg, to_reg):
-        if to_reg not in self._free_regs:
-            self._move_reg(to_reg, self._pick_best_reg(self._free_regs))
+        self._vacate(to_reg)
         self._move_reg(from_reg, to_reg)
         return to_reg
 
@@ -88,9 +154,44 @@ class RegisterAllocator:
         self.free(source)
         self._alloc[source] = self._alloc[target]
         self._alloc.pop(target)
-        self._reg_is[target] = self._alloc[source]
+        self._reg_is[self._alloc[source]] = source
+
+    def stored(self, reg: str, label: str, size: int) -> None:
+        """The free register (pair) reg now holds the value that was just stored to label."""
+        self._mirrors = {r: mirror for r, mirror in self._mirrors.items() if mirror[0] != label}
+        if label in self._volatile:
+            # Writing a hardware register can have any effect on memory.
+            self.forget_all()
+        else:
+            self._mirrors[reg] = (label, size)
+
+    def mirror_of(self, label: str, size: int) -> Optional[str]:
+        """A free register (pair) that holds the value of the label, so it does not have to be loaded again."""
+        if label in self._volatile:
+            return None
+        for reg, mirror in self._mirrors.items():
+            if mirror == (label, size) and self.is_free(*reg):
+                return reg
+        return None
+
+    def clobber(self, *regs: str) -> None:
+        """The registers are written, for handlers that use free registers as scratch."""
+        written = set("".join(regs))
+        self._mirrors = {reg: mirror for reg, mirror in self._mirrors.items() if not written.intersection(reg)}
+
+    def forget_all(self) -> None:
+        """Memory or registers changed in a way that is not tracked, at labels, calls and stores through pointers."""
+        self._mirrors = {}
+
+    def _assign(self, nr, reg):
+        self.clobber(reg)
+        self._alloc[nr] = reg
+        for r in reg:
+            self._reg_is[r] = nr
+            self._free_regs.remove(r)
 
     def _move_reg(self, from_reg, to_reg):
+        self.clobber(to_reg)
         self._code.add(f"ld {to_reg}, {from_reg}")
         nr = self._reg_is.pop(from_reg)
         self._alloc.pop(nr)
@@ -98,7 +199,157 @@ class RegisterAllocator:
         self._alloc[nr] = to_reg
         self._reg_is[to_reg] = nr
         self._free_regs.remove(to_reg)
-    
+
+    def _move_reg16(self, from_reg, to_reg):
+        nr = self._reg_is[from_reg[0]]
+        self.free(nr)
+        self._released.difference_update(from_reg)
+        self._assign(nr, to_reg)
+        self._code.add(f"ld {to_reg[0]}, {from_reg[0]}")
+        self._code.add(f"ld {to_reg[1]}, {from_reg[1]}")
+
+    def _vacate(self, reg: str) -> None:
+        """Make the register free, by moving its value to a free register or spilling a value."""
+        if reg in self._free_regs:
+            return
+        if not self._spares(exclude=reg):
+            self._spill(self._victim(reg))
+        if reg not in self._free_regs:
+            self._move_reg(reg, self._spare_reg())
+
+    def _vacate16(self, allowed: Set[str]) -> str:
+        """Make one of the allowed register pairs free, by moving the values in it to free registers or spilling
+        them."""
+        best = None
+        for pair in sorted(allowed):
+            owners = {self._reg_is[r] for r in pair if r not in self._free_regs}
+            if owners & self._pinned:
+                continue
+            cost = (sum(len(self._alloc[nr]) for nr in owners), -min((self._next_use(nr) for nr in owners), default=0))
+            if best is None or cost < best[0]:
+                best = (cost, pair, owners)
+        if best is None:
+            raise RuntimeError(f"Want {allowed} but all registers are in use")
+        _, pair, owners = best
+        for nr in sorted(owners, key=self._next_use):
+            reg = self._alloc[nr]
+            pairs = [other for other in ALL_REGS16 if other != pair and self._usable(*other)]
+            if len(reg) == 1 and self._spares(exclude=pair):
+                self._move_reg(reg, self._spare_reg(exclude=pair))
+            elif len(reg) == 2 and pairs:
+                self._move_reg16(reg, pairs[0])
+            else:
+                self._spill(nr)
+        return pair
+
+    def _next_use(self, nr: int) -> int:
+        uses = self._uses.get(nr, [])
+        idx = bisect_left(uses, self._position)
+        return uses[idx] if idx < len(uses) else self._end
+
+    def _constant(self, nr: int) -> Optional[int]:
+        if nr in self._constants and self._position <= self._constants[nr][1]:
+            return self._constants[nr][0]
+        return None
+
+    def _victim_options(self) -> List[int]:
+        return [nr for nr in self._alloc if nr not in self._pinned]
+
+    def _victim(self, vacating: Optional[str] = None) -> int:
+        """The virtual register to spill: a constant if there is one, else the value in the register that has to be
+        made free, which saves moving it, else the value that is used again the latest."""
+        options = self._victim_options()
+        if not options:
+            raise RuntimeError(f"All registers are in use: {self._alloc}")
+        return max(options, key=lambda nr: (self._constant(nr) is not None, self._alloc[nr] == vacating, self._next_use(nr)))
+
+    def _spill(self, nr: int) -> None:
+        reg = self._alloc[nr]
+        value = self._constant(nr)
+        slot = None
+        if value is None:
+            slot = self._take_slot(len(reg))
+            self._copy_slot(reg, slot, store=True)
+        self.free(nr)
+        self._released.difference_update(reg)
+        self._spilled[nr] = (slot, len(reg) * 8, value)
+
+    def _reload(self, nr: int) -> None:
+        slot, size, value = self._spilled[nr]
+        if size == 16:
+            options = {pair for pair in ALL_REGS16 if self._usable(*pair)}
+            if self._flags.get((nr, 16), 0) & FLAG_ALU_RESULT and "HL" in options:
+                options = {"HL"}
+            reg = self._pick_best_reg16(options) if options else self._vacate16(set(ALL_REGS16))
+        else:
+            if not self._spares():
+                self._spill(self._victim())
+            if self._flags.get((nr, 8), 0) & FLAG_ALU_RESULT and self._usable("A"):
+                reg = "A"
+            else:
+                reg = self._spare_reg()
+        self._spilled.pop(nr)
+        self._assign(nr, reg)
+        if slot is None:
+            # Loading a constant again is cheaper than a slot, and does not change the flags like xor does.
+            self._code.add(f"ld {reg}, {value}")
+            return
+        self._copy_slot(reg, slot, store=False)
+        self._slots[slot:slot + len(reg)] = [False] * len(reg)
+
+    def _copy_slot(self, reg: str, slot: int, store: bool) -> None:
+        """Copy a register (pair) to its HRAM slot or back, low byte first. ldh only works with A, when A is in use
+        a free HL points at the slot instead, else A is saved on the stack."""
+        labels = [f"{self._spill_prefix}_{slot + offset}" for offset in range(len(reg))]
+        if "A" in reg or self._usable("A"):
+            if "A" not in reg:
+                self.clobber("A")
+            for r, label in zip(reversed(reg), labels):
+                if store:
+                    if r != "A":
+                        self._code.add(f"ld A, {r}")
+                    self._code.add(f"ldh [{label}], A")
+                else:
+                    self._code.add(f"ldh A, [{label}]")
+                    if r != "A":
+                        self._code.add(f"ld {r}, A")
+        elif self._usable("H", "L"):
+            self.clobber("H", "L")
+            self._code.add(f"ld HL, {labels[0]}")
+            for offset, r in enumerate(reversed(reg)):
+                if offset:
+                    self._code.add("inc HL")
+                self._code.add(f"ld [HL], {r}" if store else f"ld {r}, [HL]")
+        else:
+            self._code.add("push AF")
+            for r, label in zip(reversed(reg), labels):
+                if store:
+                    self._code.add(f"ld A, {r}")
+                    self._code.add(f"ldh [{label}], A")
+                else:
+                    self._code.add(f"ldh A, [{label}]")
+                    self._code.add(f"ld {r}, A")
+            self._code.add("pop AF")
+
+    def _usable(self, *regs: str) -> bool:
+        """The registers can be used as scratch, they are free and the current handler does not read them anymore."""
+        return self.is_free(*regs) and not self._released.intersection(regs)
+
+    def _spares(self, exclude: str = "") -> Set[str]:
+        """Free registers a value can be moved to. The current handler can still read the ones it freed."""
+        return self._free_regs.difference(exclude, self._released)
+
+    def _spare_reg(self, exclude: str = "") -> str:
+        return self._pick_best_reg(self._spares(exclude))
+
+    def _take_slot(self, size: int) -> int:
+        slot = 0
+        while any(self._slots[slot:slot + size]):
+            slot += 1
+        self._slots.extend([False] * (slot + size - len(self._slots)))
+        self._slots[slot:slot + size] = [True] * size
+        return slot
+
     def push_in_use(self):
         for reg in ["BC", "DE", "HL", "AF"]:
             if reg[0] not in self._free_regs or (reg[1] not in self._free_regs and reg[1] != "F"):
@@ -16,8 +16,8 @@ def op_handler(code: Code, ra: RegisterAllocator, op):
     if op.args[0] == '+' and r0 == "HL":
         code.add(f"add {r0}, {r1}")
     else:
-        if not ra.is_free("A"):
-            raise RuntimeError("Need A")
+        ra.make_free("A")
+        ra.clobber("A")
         code.add(f"ld A, {r0[1]}")
         code.add(f"{ARITHMETIC_ASM[op.args[0]][0]} A, {r1[1]}")
         code.add(f"ld {r0[1]}, A")
@@ -30,7 +30,11 @@ def op_handler(code: Code, ra: RegisterAllocator, op):
 
 @handler(16, OP_LOAD_VALUE, OP_ARITHMETIC)
 def op_arithmetic_constant(code: Code, ra: RegisterAllocator, load, arithmetic):
-    if load.args[0] != arithmetic.args[2] or arithmetic.args[0] != '*':
+    if load.args[0] != arithmetic.args[2]:
+        return False
+    if arithmetic.args[0] in ARITHMETIC_ASM:
+        return arithmetic_immediate(code, ra, arithmetic, load.args[1] & 0xFFFF)
+    if arithmetic.args[0] != '*':
         return False
     r0 = ra.get(arithmetic.args[1])
     if r0 != "HL":
@@ -41,3 +45,32 @@ def op_arithmetic_constant(code: Code, ra: RegisterAllocator, load, arithmetic):
             code.add(f"add {r0}, {r0}")
             n //= 2
     return True
+
+
+def arithmetic_immediate(code: Code, ra: RegisterAllocator, op, value: int) -> bool:
+    """Arithmetic with a constant, which then does not need a register pair."""
+    r0 = ra.get(op.args[1])
+    add_pair = op.args[0] == '+' and r0 == "HL" and any(ra.is_free(*pair) for pair in ("BC", "DE"))
+    # inc rr takes 1 byte and 8 cycles, ld rr, n and add HL, rr 4 bytes and 20 cycles, going through A 8 bytes and
+    # 32 cycles.
+    if code.favor_size:
+        steps = 3 if add_pair else 7
+    else:
+        steps = 2 if add_pair else 4
+    if op.args[0] in {'+', '-'} and (value <= steps or value >= 0x10000 - steps):
+        step = value if value <= steps else 0x10000 - value
+        inc = (op.args[0] == '+') == (value <= steps)
+        for n in range(step):
+            code.add(f"{'inc' if inc else 'dec'} {r0}")
+        return True
+    if add_pair:
+        return False
+    ra.make_free("A")
+    ra.clobber("A")
+    code.add(f"ld A, {r0[1]}")
+    code.add(f"{ARITHMETIC_ASM[op.args[0]][0]} A, {value & 0xFF}")
+    code.add(f"ld {r0[1]}, A")
+    code.add(f"ld A, {r0[0]}")
+    code.add(f"{ARITHMETIC_ASM[op.args[0]][1]} A, {value >> 8}")
+    code.add(f"ld {r0[0]}, A")
+    return True
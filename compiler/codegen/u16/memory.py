@@ -6,9 +6,18 @@ from ..register import RegisterAllocator
 
 @handler(16, OP_LOAD)
 def op_handler(code: Code, ra: RegisterAllocator, op):
-    if not ra.is_free("A"):
-        return False
-    r0 = ra.alloc16(op.args[0])
+    cached = ra.mirror_of(op.args[1], 16)
+    r0 = ra.alloc16(op.args[0], prefer=cached)
+    if r0 == cached:
+        return True
+    # Making room for the value can overwrite the register pair that held it
+    cached = ra.mirror_of(op.args[1], 16)
+    if cached is not None:
+        code.add(f"ld {r0[0]}, {cached[0]}")
+        code.add(f"ld {r0[1]}, {cached[1]}")
+        return True
+    ra.make_free("A")
+    ra.clobber("A")
     code.add(f"ld A, [_{op.args[1]}]")
     code.add(f"ld {r0[1]}, A")
     code.add(f"ld A, [_{op.args[1]}+1]")
@@ -25,12 +34,13 @@ def op_handler(code: Code, ra: RegisterAllocator, op):
 
 @handler(16, OP_STORE)
 def op_handler(code: Code, ra: RegisterAllocator, op):
-    if not ra.is_free("A"):
-        return False
     r0 = ra.get(op.args[0])
+    ra.make_free("A")
+    ra.clobber("A")
     code.add(f"ld A, {r0[1]}")
     code.add(f"ld [_{op.args[1]}], A")
     code.add(f"ld A, {r0[0]}")
     code.add(f"ld [_{op.args[1]}+1], A")
     ra.free(op.args[0])
+    ra.stored(r0, op.args[1], 16)
     return True
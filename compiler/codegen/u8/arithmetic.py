@@ -16,6 +16,13 @@ def op_handler(code: Code, ra: RegisterAllocator, op):
         code.add(f"{ARITHMETIC_ASM[op.args[0]]} {r1}, {r0}")
         ra.reg_replaced_by(op.args[1], op.args[2])
         return True
+    if ra.get(op.args[2]) == "A" and op.args[0] == '-':
+        # a - b is -(b - a), negating is as cheap as moving both values around
+        code.add(f"sub A, {r0}")
+        code.add("cpl")
+        code.add("inc A")
+        ra.reg_replaced_by(op.args[1], op.args[2])
+        return True
     if r0 != 'A':
         r0 = ra.move_reg(r0, "A")
     r1 = ra.get(op.args[2])
@@ -33,6 +40,7 @@ def op_arithmetic_by_HL(code: Code, ra: RegisterAllocator, load, arithmetic):
     r0 = ra.get(arithmetic.args[1])
     if r0 != 'A':
         r0 = ra.move_reg(r0, "A")
+    ra.clobber("H", "L")
     code.add(f"ld HL, _{load.args[1]}")
     code.add(f"{ARITHMETIC_ASM[arithmetic.args[0]]} {r0}, [HL]")
     return True
@@ -6,10 +6,20 @@ from ..register import RegisterAllocator
 
 @handler(8, OP_LOAD)
 def op_handler(code: Code, ra: RegisterAllocator, op):
-    r0 = ra.alloc(op.args[0])
+    cached = ra.mirror_of(op.args[1], 8)
+    r0 = ra.alloc(op.args[0], prefer=cached)
+    if r0 == cached:
+        # Still holds the value from the last store to the label
+        if r0 != "A":
+            ra.move_reg(r0, "A")
+        return True
     if r0 != "A":
         r0 = ra.move_reg(r0, "A")
-    code.add(f"ld {r0}, [_{op.args[1]}]")
+    cached = ra.mirror_of(op.args[1], 8)
+    if cached is not None:
+        code.add(f"ld {r0}, {cached}")
+    else:
+        code.add(f"ld {r0}, [_{op.args[1]}]")
     return True
 
 
@@ -30,4 +40,5 @@ def op_handler(code: Code, ra: RegisterAllocator, op):
         r0 = ra.move_reg(r0, "A")
     code.add(f"ld [_{op.args[1]}], {r0}")
     ra.free(op.args[0])
+    ra.stored(r0, op.args[1], 8)
     return True
@@ -1,26 +1,54 @@
-from typing import Dict
-import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 
-from .assembler import Assembler
+from . import objectfile
+from .assembler import Assembler, ObjectFile
 from .astnode import AstNode
+from .callgraph import CallGraph
 from .codegen.generator import gen_code
+from .codegen.handler import HandlerStats
 from .exception import CompileException
+from .incremental import FunctionCache, Use, function_key
+from .linker import assemble, link_objects, build_rom
 from .parse.parser import parse
-from .pseudo import PseudoState
+from .parsecache import ParseCache
+from .pseudo import PseudoOp, PseudoState
 from .scope import Scope, TopLevelScope
+from .stdlib import stdlib_objects
 from .optimizer.constant import constant_collapse
+from .optimizer.manager import OPT_LEVELS, PassManager, PassStats, PassTiming
+from .optimizer.passes import get_pass
+
+WRAM_SIZE = 0x2000
+# Spilled registers go in HRAM after the regs placed there, the stack grows down from the end of it on hardware.
+HRAM_START = 0xFF80
+HRAM_SPILL_END = 0xFFC0
 
 
 class Compiler:
-    def __init__(self):
+    def __init__(self, *, cache_dir: Optional[str] = None, function_cache: Optional[FunctionCache] = None, opt_level: str = "2"):
         self.consts: Dict[str, int] = {}
+        if opt_level not in OPT_LEVELS:
+            raise ValueError(f"Unknown optimization level: {opt_level}")
+        self.opt_level = opt_level
+        # Time and IR size change per optimization pass, summed over the functions generated by the last build.
+        self.pass_stats: Dict[str, PassStats] = {}
+        # How often each codegen handler was tried and used, over the same functions.
+        self.handler_stats = HandlerStats()
+        # Parsed modules and assembled stdlib objects are kept here, nothing is written to disk when None.
+        self.cache_dir = cache_dir
+        self.parse_cache = ParseCache(cache_dir) if cache_dir is not None else None
+        # Shared between the compilers of successive builds, so unchanged functions are not generated again.
+        self.function_cache = function_cache
         self.main_scope = TopLevelScope("global_var")
+        # Linked result of the last build, for writing listings and symbol files.
+        self.asm: Optional[Assembler] = None
 
     def add_file(self, filename: str):
         self.add_module(filename, open(filename, "rt").read())
 
     def add_module(self, name: str, code: str):
-        module = parse(name, code)
+        module = self.parse_cache.parse(name, code) if self.parse_cache is not None else parse(name, code)
         for const in module.consts:
             constant_collapse(const.params[0])
             if const.token.value in self.consts:
@@ -46,84 +74,156 @@ class Compiler:
             if func.token.value in self.main_scope.funcs:
                 raise CompileException(func.token, f"Duplicate function definition: {func.name}")
             for block in func.block:
-                constant_collapse(block, self.consts)
+                constant_collapse(block, self.consts, fold=False)
             self.main_scope.funcs[func.token.value] = func
 
     def dump_ast(self):
         for func in self.main_scope.funcs.values():
             func.dump()
 
-    def build(self, *, print_asm_code=False, print_pseudo_code=False):
-        asm = Assembler()
-        asm.process("jp std_start\nds $150-3", base_address=0x0100, bank=0) # Reserve header area
-        for f in os.listdir("stdlib"):
-            fp = open(f"stdlib/{f}", "rt")
-            asm.process(fp.read(), base_address=-2, bank=0)
-            fp.close()
+    def build(self, *, print_asm_code=False, print_pseudo_code=False, print_bank_usage=False, jobs=1):
+        names = list(self.main_scope.funcs.keys())
+        results: Dict[str, Tuple[List[PseudoOp], str, bytes, int]] = {}
+        keys = {}
+        if self.function_cache is not None:
+            for name in names:
+                keys[name] = (self.opt_level,) + function_key(self.main_scope.funcs[name])
+                cached = self.function_cache.get(self.main_scope, name, keys[name])
+                if cached is not None:
+                    results[name] = cached
+        todo = [name for name in names if name not in results]
+        if jobs != 1 and len(todo) > 1:
+            # Functions are generated independently, results come back in submission order so the output is
+            # the same as a sequential build.
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(self.main_scope, self.opt_level)) as executor:
+                built = list(executor.map(_worker_build_function, todo))
+        else:
+            built = [_serialized(build_function(self.main_scope, name, self.opt_level)) for name in todo]
+        self.pass_stats = {}
+        self.handler_stats = HandlerStats()
+        for name, (ops, code, obj, spill_size, uses, timings, handler_stats) in zip(todo, built):
+            results[name] = ops, code, obj, spill_size
+            for pass_name, timing in timings.items():
+                if pass_name not in self.pass_stats:
+                    self.pass_stats[pass_name] = PassStats(pass_name, get_pass(pass_name).kind)
+                self.pass_stats[pass_name].add(timing)
+            self.handler_stats.add(handler_stats)
+            if self.function_cache is not None:
+                self.function_cache.put(self.main_scope, name, keys[name], uses, ops, code, obj, spill_size)
+        graph = CallGraph(self.main_scope.funcs, {name: results[name][0] for name in names})
+        graph.check_recursion()
+
+        objects = stdlib_objects(self.cache_dir)
+        objects.append(assemble("jp std_start\nds $150-3", base_address=0x0100, bank=0)) # Reserve header area
         ram_code = "__result__:\n ds 2\n"
+        globals_size = 2
         init_code = "__init:\n"
         for name, reg in self.main_scope.regs.items():
             ram_code += f"_{name} := {reg.params[0].token.value}\n"
         for name, var in self.main_scope.vars.items():
             ram_code += f"_{self.main_scope.prefix}_{name}:\n ds {var.data_type.size//8}\n"
+            globals_size += var.data_type.size // 8
             if var.data_type.size == 8:
                 init_code += f"ld a, {var.params[0].token.value}\nld [_{self.main_scope.prefix}_{name}], a\n"
             else:
                 init_code += f"ld a, {var.params[0].token.value&0xFF}\nld [_{self.main_scope.prefix}_{name}], a\n"
                 init_code += f"ld a, {(var.params[0].token.value>>8)&0xFF}\nld [_{self.main_scope.prefix}_{name}+1], a\n"
-        ram_code += "__ram_end:"
-        # TODO: Figure out call tree and overlap function parameters where possible.
-        for name, func in self.main_scope.funcs.items():
-            for param in func.parameters:
-                ram_code += f"_local_{func.name}_{param.token.value}:\n ds {param.data_type.size//8}\n"
-            for var in func.vars:
-                ram_code += f"_local_{func.name}_{var.token.value}:\n ds {var.data_type.size//8}\n"
+        ram_code += "__ram_end:\n"
+        # Functions that are never active at the same time share the storage for their parameters and locals.
+        frames = {name: [(f"_local_{func.name}_{node.token.value}", node.data_type.size // 8) for node in func.parameters + func.vars]
+                  for name, func in self.main_scope.funcs.items()}
+        sizes = {name: sum(size for _, size in frame) for name, frame in frames.items()}
+        offsets = graph.overlay(sizes)
+        slots = sorted((offsets[name] + sum(size for _, size in frame[:idx]), idx, name) for name, frame in frames.items() for idx in range(len(frame)))
+        locals_size = max((offsets[name] + sizes[name] for name in names), default=0)
+        position = 0
+        for offset, idx, name in slots:
+            if offset > position:
+                ram_code += f" ds {offset - position}\n"
+                position = offset
+            ram_code += f"{frames[name][idx][0]}:\n"
+        if locals_size > position:
+            ram_code += f" ds {locals_size - position}\n"
+        # Spill slots are overlaid the same way as locals.
+        spills = {name: results[name][3] for name in names}
+        spill_offsets = graph.overlay(spills)
+        hram_size = max((spill_offsets[name] + spills[name] for name in names), default=0)
+        hram_start = max([HRAM_START] + [reg.params[0].token.value + reg.data_type.size // 8 for reg in self.main_scope.regs.values()
+                                         if HRAM_START <= reg.params[0].token.value < 0xFFFF])
+        if hram_start + hram_size > HRAM_SPILL_END:
+            name = max(names, key=lambda name: spill_offsets[name] + spills[name])
+            raise CompileException(self.main_scope.funcs[name].token, f"Too many spilled registers, {hram_size} bytes of HRAM needed")
+        for name in names:
+            for slot in range(spills[name]):
+                ram_code += f"_spill_{name}_{slot} := {hram_start + spill_offsets[name] + slot}\n"
         if print_asm_code:
             print(ram_code)
             print(init_code)
-        asm.process(ram_code, base_address=0xC000, bank=0)
-        asm.process(init_code + "ret", base_address=-2, bank=1)
-        for name, func in self.main_scope.funcs.items():
-            scope = Scope(f"local_{name}", self.main_scope)
-            for param in func.parameters:
-                scope.vars[param.token.value] = param
-            for var in func.vars:
-                scope.vars[var.token.value] = var
-            ps = PseudoState(scope, func)
+        objects.append(assemble(ram_code, base_address=0xC000, bank=0))
+        objects.append(assemble(init_code + "ret", base_address=-2, bank=1))
+        for name in names:
+            ops, code, obj, _ = results[name]
             if print_pseudo_code:
-                for op in ps.ops:
+                for op in ops:
                     print(op)
-            code = f"_function_{func.name}:\n"
-            code += gen_code(ps)
             if print_asm_code:
                 print(code)
-            asm.process(code, base_address=-2)
-        asm.link()
-
-        rom_data = bytearray(0x8000)
-        for s in asm.getSections():
-            if s.base_address >= 0x8000:
-                assert s.data.count(0) == len(s.data)
-                continue
-            while s.bank * 0x4000 >= len(rom_data):
-                rom_data += bytearray(0x4000)
-            start = s.bank * 0x4000 + (s.base_address & 0x3FFF)
-            rom_data[start:start+len(s.data)] = s.data
-
-        # for label, addr, bank in asm.getLabels():
-        #     print(f"{bank:02x}:{addr:04x} {label}")
-
-        # Fix the header
-        rom_data[0x0104:0x0134] = b'\xCE\xED\x66\x66\xCC\x0D\x00\x0B\x03\x73\x00\x83\x00\x0C\x00\x0D\x00\x08\x11\x1F\x88\x89\x00\x0E\xDC\xCC\x6E\xE6\xDD\xDD\xD9\x99\xBB\xBB\x67\x63\x6E\x0E\xEC\xCC\xDD\xDC\x99\x9F\xBB\xB9\x33\x3E'
-        rom_data[0x0143] = 0 # GBC flag
-        rom_data[0x0147] = 0 # Cart type
-        rom_data[0x0148] = 0 # ROM size
-        rom_data[0x0149] = 0 # SRAM size
-        checksum = 0
-        for b in rom_data[0x0134:0x14D]:
-            checksum -= b + 1
-        rom_data[0x14D] = checksum & 0xFF
-        checksum = sum(rom_data)
-        rom_data[0x14E] = (checksum >> 8) & 0xFF
-        rom_data[0x14F] = checksum & 0xFF
+            objects.append(objectfile.loads(obj))
+        asm = link_objects(objects, keep=["std_start"], optimize=PassManager(self.opt_level).peephole)
+        if print_bank_usage:
+            sections, size = asm.getStripStats()
+            print(f"Removed {sections} unused sections, {size} bytes reclaimed")
+            if asm.getPeepholeStats():
+                print("Peephole: " + ", ".join(f"{name} {count}" for name, count in asm.getPeepholeStats().items()))
+            for bank, used, free, sections in asm.getBankUsage():
+                print(f"Bank {bank:02x}: {used:5d} bytes used, {free:5d} bytes free ({used * 100 // (used + free):3d}%), {sections} sections")
+            for stats in self.pass_stats.values():
+                print(f"Pass {stats}")
+            print(f"Handlers (used/tried): {self.handler_stats}")
+            print(f"WRAM: {globals_size} bytes globals, {locals_size} bytes locals ({sum(sizes.values())} without overlap), "
+                  f"{WRAM_SIZE - globals_size - locals_size} bytes free")
+            print(f"HRAM: {hram_size} bytes spilled registers ({sum(spills.values())} without overlap)")
+
+        rom_data = build_rom(asm.getSections())
+        self.asm = asm
         return rom_data, {l: (a, b) for l, a, b in asm.getLabels()}
+
+
+BuildResult = Tuple[List[PseudoOp], str, ObjectFile, int, Set[Use], Dict[str, PassTiming], HandlerStats]
+
+
+def build_function(main_scope: TopLevelScope, name: str, opt_level: str = "2") -> BuildResult:
+    func = main_scope.funcs[name]
+    scope = Scope(f"local_{name}", main_scope)
+    for param in func.parameters:
+        scope.vars[param.token.value] = param
+    for var in func.vars:
+        scope.vars[var.token.value] = var
+    passes = PassManager(opt_level)
+    ps = PseudoState(scope, func, passes.run_ast(func.block, scope, func))
+    ps.ops = passes.run_pseudo(ps.ops, scope, func)
+    handler_stats = HandlerStats()
+    code, spill_size = gen_code(ps, f"_spill_{func.name}", handler_stats, passes.favor_size)
+    code = f"_function_{func.name}:\n" + code
+    return ps.ops, code, assemble(code, base_address=-2), spill_size, scope.uses, passes.timings, handler_stats
+
+
+def _serialized(result: BuildResult) -> Tuple[List[PseudoOp], str, bytes, int, Set[Use], Dict[str, PassTiming], HandlerStats]:
+    ops, code, obj, spill_size, uses, timings, handler_stats = result
+    return ops, code, objectfile.dumps(obj), spill_size, uses, timings, handler_stats
+
+
+_worker_scope: Optional[TopLevelScope] = None
+_worker_opt_level = "2"
+
+
+def _init_worker(main_scope: TopLevelScope, opt_level: str):
+    global _worker_scope, _worker_opt_level
+    _worker_scope = main_scope
+    _worker_opt_level = opt_level
+
+
+def _worker_build_function(name: str) -> Tuple[List[PseudoOp], str, bytes, int, Set[Use], Dict[str, PassTiming], HandlerStats]:
+    assert _worker_scope is not None
+    return _serialized(build_function(_worker_scope, name, _worker_opt_level))
+
@@ -17,6 +17,12 @@ class DataType:
             self.my_pointer.target = self
         return self.my_pointer
     
+    def __reduce__(self):
+        # Types are compared by identity, so unpickling has to give back the same instances.
+        if self.type == self.POINTER:
+            return DataType.get_pointer, (self.target,)
+        return _base_type, (self.size,)
+
     def __repr__(self):
         if self.type == self.INT:
             return f"u{self.size}"
@@ -30,3 +36,10 @@ BASE_TYPES = {
     "u8": DEFAULT_TYPE,
     "u16": DataType(DataType.INT, 16),
 }
+
+
+def _base_type(size: int) -> DataType:
+    for data_type in BASE_TYPES.values():
+        if data_type.size == size:
+            return data_type
+    raise RuntimeError(f"No base type of size {size}")
@@ -5,6 +5,7 @@ if TYPE_CHECKING:
 
 class CompileException(Exception):
     def __init__(self, token: "Token", message: str):
+        super().__init__(token, message)
         self.message = message
         self.token = token
 
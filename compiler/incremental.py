@@ -0,0 +1,80 @@
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from .astnode import AstNode
+from .parse.function import Function
+from .pseudo import PseudoOp
+from .scope import TopLevelScope
+
+# A name a function looked up in the top level scope, ("var", name) for variables and regs, ("func", name) for calls.
+Use = Tuple[str, str]
+
+
+def _tree(node: AstNode) -> tuple:
+    token = node.token
+    return (
+        node.kind,
+        None if token is None else (token.kind, token.value),
+        repr(node.data_type) if node.data_type is not None else None,
+        tuple(_tree(param) for param in node.params),
+    )
+
+
+def function_key(func: Function) -> tuple:
+    """Everything of a function that ends up in its code. Line numbers are left out, so functions below an edit
+    that only moved do not need to be built again."""
+    return (
+        func.name,
+        tuple((param.token.value, repr(param.data_type)) for param in func.parameters),
+        repr(func.return_type),
+        tuple(_tree(node) for node in func.block),
+    )
+
+
+def use_signature(main_scope: TopLevelScope, use: Use) -> Optional[tuple]:
+    """What a function depends on when it uses a top level name: the type of a variable or reg, and the parameters
+    and return type of a called function. None when the name does not exist."""
+    kind, name = use
+    if kind == "var":
+        if name in main_scope.regs:
+            return "reg", repr(main_scope.regs[name].data_type)
+        if name in main_scope.vars:
+            return "var", repr(main_scope.vars[name].data_type)
+        return None
+    func = main_scope.funcs.get(name)
+    if func is None:
+        return None
+    return tuple((param.token.value, repr(param.data_type)) for param in func.parameters), repr(func.return_type)
+
+
+class _Entry(NamedTuple):
+    key: tuple
+    uses: Dict[Use, Optional[tuple]]
+    ops: List[PseudoOp]
+    code: str
+    obj: bytes
+    spill_size: int
+
+
+class FunctionCache:
+    """Build results of functions kept between builds. A function is reused while its own tree and everything it
+    resolved through the top level scope are unchanged. Objects are kept serialized, as linking modifies them."""
+
+    def __init__(self) -> None:
+        self.__entries: Dict[str, _Entry] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, main_scope: TopLevelScope, name: str, key: tuple) -> Optional[Tuple[List[PseudoOp], str, bytes, int]]:
+        entry = self.__entries.get(name)
+        if entry is None or entry.key != key or any(use_signature(main_scope, use) != signature for use, signature in entry.uses.items()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.ops, entry.code, entry.obj, entry.spill_size
+
+    def put(self, main_scope: TopLevelScope, name: str, key: tuple, uses: Set[Use], ops: List[PseudoOp], code: str, obj: bytes,
+            spill_size: int) -> None:
+        self.__entries[name] = _Entry(key, {use: use_signature(main_scope, use) for use in uses}, ops, code, obj, spill_size)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
@@ -0,0 +1,61 @@
+from typing import Iterable, Optional
+
+from . import objectfile
+from .assembler import Assembler, ObjectFile, Section
+
+
+def assemble(code: str, *, base_address: Optional[int] = None, bank: Optional[int] = None) -> ObjectFile:
+    """Assemble a piece of code on its own into a relocatable object."""
+    asm = Assembler()
+    asm.process(code, base_address=base_address, bank=bank)
+    return asm.getObject()
+
+
+def link_objects(objects: Iterable[ObjectFile], *, keep: Optional[Iterable[str]] = None, optimize: bool = False) -> Assembler:
+    """Merge objects and link them. The resulting assembler gives access to the placed sections and labels.
+    When labels to keep are given, sections that are not referenced from them are left out."""
+    asm = Assembler()
+    for obj in objects:
+        asm.addObject(obj)
+    asm.link(keep=keep, optimize=optimize)
+    return asm
+
+
+def build_rom(sections: Iterable[Section]) -> bytearray:
+    rom_data = bytearray(0x8000)
+    for s in sections:
+        if s.base_address >= 0x8000:
+            assert s.data.count(0) == len(s.data)
+            continue
+        while s.bank * 0x4000 >= len(rom_data):
+            rom_data += bytearray(0x4000)
+        start = s.bank * 0x4000 + (s.base_address & 0x3FFF)
+        rom_data[start:start+len(s.data)] = s.data
+
+    # Fix the header
+    rom_data[0x0104:0x0134] = b'\xCE\xED\x66\x66\xCC\x0D\x00\x0B\x03\x73\x00\x83\x00\x0C\x00\x0D\x00\x08\x11\x1F\x88\x89\x00\x0E\xDC\xCC\x6E\xE6\xDD\xDD\xD9\x99\xBB\xBB\x67\x63\x6E\x0E\xEC\xCC\xDD\xDC\x99\x9F\xBB\xB9\x33\x3E'
+    rom_data[0x0143] = 0 # GBC flag
+    rom_data[0x0147] = 0 # Cart type
+    rom_data[0x0148] = 0 # ROM size
+    rom_data[0x0149] = 0 # SRAM size
+    checksum = 0
+    for b in rom_data[0x0134:0x14D]:
+        checksum -= b + 1
+    rom_data[0x14D] = checksum & 0xFF
+    checksum = sum(rom_data)
+    rom_data[0x14E] = (checksum >> 8) & 0xFF
+    rom_data[0x14F] = checksum & 0xFF
+    return rom_data
+
+
+def main(output: str, filenames: Iterable[str]) -> None:
+    asm = link_objects(objectfile.load(filename) for filename in filenames)
+    open(output, "wb").write(build_rom(asm.getSections()))
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        print(f"Usage: {sys.argv[0]} output.gb input.obj [input.obj...]")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,48 @@
+from typing import Dict, List, TextIO, Tuple
+
+from .assembler import Assembler
+
+
+def _labels_by_address(asm: Assembler) -> Dict[Tuple[int, int], List[str]]:
+    result: Dict[Tuple[int, int], List[str]] = {}
+    for label, address, bank in asm.getLabels():
+        result.setdefault((bank or 0, address), []).append(label)
+    return result
+
+
+def write_listing(asm: Assembler, f: TextIO) -> None:
+    """Every instruction with its address, bytes, M-cycles and source line. Conditional branches show the cycles
+    for taken/not taken."""
+    labels = _labels_by_address(asm)
+    for bank, address, data, line_nr, (taken, not_taken), text in asm.getListing():
+        for label in labels.get((bank, address), []):
+            f.write(f"{label}:\n")
+        cycles = str(taken) if taken == not_taken else f"{taken}/{not_taken}"
+        f.write(f"  {bank:02X}:{address:04X}  {data.hex(' '):<8}  {cycles:>4}  {text:<32} ; line {line_nr}\n")
+
+
+def write_sym(asm: Assembler, f: TextIO) -> None:
+    """Symbol file in the bank:address format that BGB, Emulicious and SameBoy read."""
+    f.write("; Symbols\n")
+    for label, address, bank in sorted(asm.getLabels(), key=lambda entry: (entry[2] or 0, entry[1], entry[0])):
+        f.write(f"{bank or 0:02x}:{address:04x} {label}\n")
+
+
+def write_map(asm: Assembler, f: TextIO) -> None:
+    """Bank usage and every section with its address range, size and first label."""
+    labels = _labels_by_address(asm)
+    sections: Dict[int, List[Tuple[int, int, str]]] = {}
+    for section in asm.getSections():
+        bank = section.bank or 0
+        name = labels.get((bank, section.base_address), ["-"])[0]
+        sections.setdefault(bank, []).append((section.base_address, len(section.data), name))
+    usage = {bank: (used, free) for bank, used, free, count in asm.getBankUsage()}
+    for bank in sorted(sections):
+        if bank in usage:
+            used, free = usage[bank]
+            f.write(f"Bank {bank:02X}: {used} bytes used, {free} bytes free\n")
+        else:
+            f.write(f"Bank {bank:02X}:\n")
+        for address, size, name in sorted(sections[bank]):
+            end = address + size - 1 if size else address
+            f.write(f"  {address:04X}-{end:04X} {size:6d}  {name}\n")
@@ -0,0 +1,231 @@
+from typing import Dict, List, Optional
+
+from .assembler import ObjectFile, Section, ExprBase, Token, OP, CALL
+
+# Object file layout, all integers are LEB128 varints, signed values are zigzag encoded:
+#   magic, version
+#   string table: count, strings as length + utf-8 data. Strings are referenced by index everywhere else.
+#   sections: count, then per section base address (signed), bank + 1 (0 for no bank), data as length + bytes,
+#             relocations as count + (offset, link type, expression), jpr offsets as count + offsets,
+#             instructions as count + (distance to the previous instruction, source line)
+#   labels: count, then (name, section index, offset)
+#   constants: count, then (name, signed value)
+#   asserts: count, then (token, expression)
+MAGIC = b"GBSO"
+VERSION = 3
+
+EXPR_NONE = 0
+EXPR_NUMBER = 1
+EXPR_TOKEN = 2
+EXPR_OP = 3
+EXPR_CALL = 4
+
+
+class ObjectFileException(Exception):
+    pass
+
+
+class _Writer:
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.strings: Dict[str, int] = {}
+
+    def uint(self, value: int) -> None:
+        assert value >= 0
+        while value > 0x7F:
+            self.data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.data.append(value)
+
+    def sint(self, value: int) -> None:
+        self.uint(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def blob(self, value: bytes) -> None:
+        self.uint(len(value))
+        self.data += value
+
+    def string(self, value: str) -> None:
+        if value not in self.strings:
+            self.strings[value] = len(self.strings)
+        self.uint(self.strings[value])
+
+    def expr(self, expr: Optional[ExprBase]) -> None:
+        if expr is None:
+            self.uint(EXPR_NONE)
+        elif isinstance(expr, Token) and expr.kind == 'NUMBER':
+            self.uint(EXPR_NUMBER)
+            self.sint(int(expr.value))
+            self.uint(expr.line_nr)
+        elif isinstance(expr, Token):
+            self.uint(EXPR_TOKEN)
+            self.string(expr.kind)
+            self.string(str(expr.value))
+            self.uint(expr.line_nr)
+        elif isinstance(expr, OP):
+            self.uint(EXPR_OP)
+            self.string(expr.op)
+            self.expr(expr.left)
+            self.expr(expr.right)
+        elif isinstance(expr, CALL):
+            self.uint(EXPR_CALL)
+            self.string(str(expr.function))
+            self.uint(len(expr.params))
+            for param in expr.params:
+                self.expr(param)
+            self.uint(expr.line_nr)
+        else:
+            raise ObjectFileException(f"Cannot store expression: {expr}")
+
+
+class _Reader:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.position = 0
+        self.strings: List[str] = []
+
+    def uint(self) -> int:
+        result = 0
+        shift = 0
+        while True:
+            if self.position >= len(self.data):
+                raise ObjectFileException("Truncated object file")
+            byte = self.data[self.position]
+            self.position += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    def sint(self) -> int:
+        value = self.uint()
+        return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+    def blob(self) -> bytes:
+        length = self.uint()
+        result = self.data[self.position:self.position + length]
+        if len(result) != length:
+            raise ObjectFileException("Truncated object file")
+        self.position += length
+        return result
+
+    def string(self) -> str:
+        return self.strings[self.uint()]
+
+    def expr(self) -> Optional[ExprBase]:
+        tag = self.uint()
+        if tag == EXPR_NONE:
+            return None
+        if tag == EXPR_NUMBER:
+            value = self.sint()
+            return Token('NUMBER', value, self.uint())
+        if tag == EXPR_TOKEN:
+            kind = self.string()
+            value = self.string()
+            return Token(kind, value, self.uint())
+        if tag == EXPR_OP:
+            op = self.string()
+            left = self.expr()
+            assert left is not None
+            return OP.make(op, left, self.expr())
+        if tag == EXPR_CALL:
+            function = self.string()
+            params = [self.expr() for _ in range(self.uint())]
+            return CALL(function, params, line_nr=self.uint())
+        raise ObjectFileException(f"Unknown expression tag: {tag}")
+
+
+def dumps(obj: ObjectFile) -> bytes:
+    w = _Writer()
+    w.uint(len(obj.sections))
+    for section in obj.sections:
+        w.sint(section.base_address)
+        w.uint(section.bank + 1 if section.bank is not None else 0)
+        w.blob(section.data)
+        w.uint(len(section.link))
+        for offset, (link_type, expr) in section.link.items():
+            w.uint(offset)
+            w.uint(link_type)
+            w.expr(expr)
+        w.uint(len(section.jpr_list))
+        for offset in section.jpr_list:
+            w.uint(offset)
+        w.uint(len(section.instructions))
+        previous = 0
+        for offset, line_nr in zip(section.instructions, section.instruction_lines):
+            w.uint(offset - previous)
+            w.uint(line_nr)
+            previous = offset
+    w.uint(len(obj.labels))
+    for label, (idx, offset) in obj.labels.items():
+        w.string(label)
+        w.uint(idx)
+        w.uint(offset)
+    w.uint(len(obj.constants))
+    for name, value in obj.constants.items():
+        w.string(name)
+        w.sint(value)
+    w.uint(len(obj.asserts))
+    for token, expr in obj.asserts:
+        w.expr(token)
+        w.expr(expr)
+
+    header = _Writer()
+    header.data += MAGIC
+    header.uint(VERSION)
+    header.uint(len(w.strings))
+    for string in w.strings:
+        header.blob(string.encode("utf-8"))
+    return bytes(header.data + w.data)
+
+
+def loads(data: bytes) -> ObjectFile:
+    if data[:len(MAGIC)] != MAGIC:
+        raise ObjectFileException("Not an object file")
+    r = _Reader(data)
+    r.position = len(MAGIC)
+    if r.uint() != VERSION:
+        raise ObjectFileException("Unsupported object file version")
+    r.strings = [r.blob().decode("utf-8") for _ in range(r.uint())]
+
+    obj = ObjectFile()
+    for _ in range(r.uint()):
+        base_address = r.sint()
+        bank = r.uint()
+        section = Section(base_address, bank - 1 if bank else None)
+        section.data = bytearray(r.blob())
+        for _ in range(r.uint()):
+            offset = r.uint()
+            link_type = r.uint()
+            expr = r.expr()
+            assert expr is not None
+            section.link[offset] = (link_type, expr)
+        section.jpr_list = [r.uint() for _ in range(r.uint())]
+        previous = 0
+        for _ in range(r.uint()):
+            previous += r.uint()
+            section.instructions.append(previous)
+            section.instruction_lines.append(r.uint())
+        obj.sections.append(section)
+    for _ in range(r.uint()):
+        label = r.string()
+        idx = r.uint()
+        obj.labels[label] = (idx, r.uint())
+    for _ in range(r.uint()):
+        name = r.string()
+        obj.constants[name] = r.sint()
+    for _ in range(r.uint()):
+        token = r.expr()
+        expr = r.expr()
+        assert isinstance(token, Token) and expr is not None
+        obj.asserts.append((token, expr))
+    return obj
+
+
+def load(filename: str) -> ObjectFile:
+    with open(filename, "rb") as f:
+        return loads(f.read())
+
+
+def save(filename: str, obj: ObjectFile) -> None:
+    with open(filename, "wb") as f:
+        f.write(dumps(obj))
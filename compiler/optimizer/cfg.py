@@ -0,0 +1,166 @@
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from ..pseudo import *
+from ..scope import Scope, TopLevelScope
+
+# Positions of the virtual registers in the args of each kind of op.
+REGISTER_ARGS: Dict[int, Tuple[int, ...]] = {
+    OP_LOAD: (0,), OP_LOAD_VALUE: (0,), OP_STORE: (0,), OP_ARITHMETIC: (1, 2), OP_LOGIC: (1, 2), OP_JUMP_ZERO: (1,),
+    OP_COMPLEMENT: (0,), OP_SHIFT: (1, 2), OP_CAST: (0,), OP_DEREF: (0, 1), OP_STORE_REF: (0, 1), OP_COPY: (0, 1),
+}
+# Position of the register an op gives a new value, which can be a register it also reads.
+RESULT_ARG: Dict[int, int] = {
+    OP_LOAD: 0, OP_LOAD_VALUE: 0, OP_ARITHMETIC: 1, OP_LOGIC: 1, OP_COMPLEMENT: 0, OP_SHIFT: 1, OP_CAST: 0,
+    OP_DEREF: 0, OP_COPY: 0,
+}
+# Positions of the registers that are no longer in use after the op.
+CONSUMED_ARGS: Dict[int, Tuple[int, ...]] = {
+    OP_STORE: (0,), OP_ARITHMETIC: (2,), OP_LOGIC: (2,), OP_JUMP_ZERO: (1,), OP_SHIFT: (2,), OP_DEREF: (1,),
+    OP_STORE_REF: (0, 1),
+}
+# A definition of a label that is not a store in the function itself, like its value on entry or a write by a
+# called function.
+UNKNOWN = -1
+
+
+def registers(op: PseudoOp) -> List[int]:
+    return [op.args[idx] for idx in REGISTER_ARGS.get(op.kind, ())]
+
+
+def renamed(op: PseudoOp, mapping: Dict[int, int]) -> PseudoOp:
+    """A copy of the op with its registers renamed, the op itself when none of them is in the mapping."""
+    positions = REGISTER_ARGS.get(op.kind, ())
+    if not any(op.args[idx] in mapping for idx in positions):
+        return op
+    args = tuple(mapping.get(arg, arg) if idx in positions else arg for idx, arg in enumerate(op.args))
+    return _with_args(op, args)
+
+
+def _with_args(op: PseudoOp, args: tuple) -> PseudoOp:
+    result = PseudoOp(op.kind, *args)
+    result.size = op.size
+    return result
+
+
+def function_labels(scope: Scope) -> Tuple[Set[str], Set[str]]:
+    """The labels of the parameters and locals of a function, which nothing reads after it returns, and the labels
+    of regs. Regs are hardware registers, every read and write of them has to stay where it is."""
+    own = {f"{scope.prefix}_{name}" for name in scope.vars}
+    top = scope
+    while top.parent is not None:
+        top = top.parent
+    return own, set(top.regs) if isinstance(top, TopLevelScope) else set()
+
+
+class BasicBlock:
+    """Ops start to end of the function, control only enters at the first op and leaves after the last."""
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.successors: List["BasicBlock"] = []
+        self.predecessors: List["BasicBlock"] = []
+
+    def __repr__(self):
+        return f"BasicBlock({self.start}, {self.end})"
+
+
+class ControlFlowGraph:
+    def __init__(self, ops: List[PseudoOp]):
+        self.ops = ops
+        self.blocks: List[BasicBlock] = []
+        starts = {0}
+        for idx, op in enumerate(ops):
+            if op.kind == OP_LABEL:
+                starts.add(idx)
+            elif op.kind in {OP_JUMP, OP_JUMP_ZERO, OP_RETURN}:
+                starts.add(idx + 1)
+        starts = sorted(start for start in starts if start < len(ops))
+        for start, end in zip(starts, starts[1:] + [len(ops)]):
+            self.blocks.append(BasicBlock(start, end))
+        by_label = {ops[block.start].args[0]: block for block in self.blocks if ops[block.start].kind == OP_LABEL}
+        for idx, block in enumerate(self.blocks):
+            last = ops[block.end - 1]
+            if last.kind in {OP_JUMP, OP_JUMP_ZERO}:
+                self._link(block, by_label[last.args[0]])
+            if last.kind not in {OP_JUMP, OP_RETURN} and idx + 1 < len(self.blocks):
+                self._link(block, self.blocks[idx + 1])
+
+    @staticmethod
+    def _link(source: BasicBlock, target: BasicBlock):
+        if target not in source.successors:
+            source.successors.append(target)
+            target.predecessors.append(source)
+
+    def labels(self) -> Set[str]:
+        return {op.args[1] for op in self.ops if op.kind in {OP_LOAD, OP_STORE}}
+
+    def liveness(self, own: Set[str]) -> List[Set[str]]:
+        """Labels that can still be read after each op. A called function can read every label except the locals
+        of this one, a pointer can point at any label, and everything except the locals is live when returning."""
+        universe = self.labels()
+        at_return = universe - own
+        live_in: Dict[BasicBlock, Set[str]] = {block: set() for block in self.blocks}
+        live_after: List[Set[str]] = [set() for _ in self.ops]
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.blocks):
+                live: Set[str] = set()
+                if block is self.blocks[-1] and self.ops[-1].kind != OP_JUMP:
+                    live = set(at_return)
+                for successor in block.successors:
+                    live |= live_in[successor]
+                for idx in range(block.end - 1, block.start - 1, -1):
+                    op = self.ops[idx]
+                    if op.kind == OP_RETURN:
+                        live = set(at_return)
+                    live_after[idx] = live
+                    live = set(live)
+                    if op.kind == OP_STORE:
+                        live.discard(op.args[1])
+                    elif op.kind == OP_LOAD:
+                        live.add(op.args[1])
+                    elif op.kind == OP_CALL:
+                        live |= at_return
+                    elif op.kind == OP_DEREF:
+                        live |= universe
+                if live != live_in[block]:
+                    live_in[block] = live
+                    changed = True
+        return live_after
+
+    def reaching_definitions(self, own: Set[str]) -> List[Dict[str, FrozenSet[int]]]:
+        """For each op the stores that can have given each label its value before the op, as op indices. Values
+        from before the function, from called functions and from stores through a pointer are UNKNOWN."""
+        universe = self.labels()
+        unknown = frozenset([UNKNOWN])
+        reach_out: Dict[BasicBlock, Optional[Dict[str, FrozenSet[int]]]] = {block: None for block in self.blocks}
+        reach_before: List[Dict[str, FrozenSet[int]]] = [{} for _ in self.ops]
+        changed = True
+        while changed:
+            changed = False
+            for block in self.blocks:
+                if block is self.blocks[0]:
+                    reach = {label: unknown for label in universe}
+                else:
+                    reach = {label: frozenset() for label in universe}
+                for predecessor in block.predecessors:
+                    incoming = reach_out[predecessor]
+                    if incoming is not None:
+                        for label, defs in incoming.items():
+                            reach[label] = reach[label] | defs
+                for idx in range(block.start, block.end):
+                    op = self.ops[idx]
+                    reach_before[idx] = reach
+                    if op.kind == OP_STORE:
+                        reach = dict(reach)
+                        reach[op.args[1]] = frozenset([idx])
+                    elif op.kind == OP_CALL:
+                        reach = {label: defs if label in own else unknown for label, defs in reach.items()}
+                    elif op.kind == OP_STORE_REF:
+                        reach = {label: unknown for label in reach}
+                if reach != reach_out[block]:
+                    reach_out[block] = reach
+                    changed = True
+        return reach_before
@@ -1,31 +1,241 @@
 from ..astnode import AstNode
-from typing import Dict
+from ..datatype import DataType
+from ..scanner import Token
+from typing import Callable, Dict, List, Optional, Tuple
 
 
-def constant_collapse(node: AstNode, lookup: Dict[str, int]={}):
+def _compare(op: str, a: int, b: int) -> bool:
+    if op == '<':
+        return a < b
+    if op == '>':
+        return a > b
+    if op == '<=':
+        return a <= b
+    if op == '>=':
+        return a >= b
+    if op == '==':
+        return a == b
+    if op == '!=':
+        return a != b
+    raise RuntimeError(op)
+
+
+def _shift(op: str, a: int, b: int) -> Optional[int]:
+    if b < 0:
+        return None
+    if op == '<<':
+        return a << b
+    if op == '>>':
+        return a >> b
+    raise RuntimeError(op)
+
+
+# Binary operators on two known values, called with (operator text, left, right). None when the result is not
+# defined, like a division by zero, which is then left for the backend to report.
+BINARY: Dict[str, Callable[[str, int, int], Optional[int]]] = {
+    '+': lambda op, a, b: a + b,
+    '-': lambda op, a, b: a - b,
+    '*': lambda op, a, b: a * b,
+    '/': lambda op, a, b: a // b if b != 0 else None,
+    '%': lambda op, a, b: a % b if b != 0 else None,
+    '&': lambda op, a, b: a & b,
+    '|': lambda op, a, b: a | b,
+    '^': lambda op, a, b: a ^ b,
+    'SHIFT': _shift,
+    '<': lambda op, a, b: int(_compare(op, a, b)),
+    '>': lambda op, a, b: int(_compare(op, a, b)),
+    '==': lambda op, a, b: int(_compare(op, a, b)),
+    '&&': lambda op, a, b: int(bool(a) and bool(b)),
+    '||': lambda op, a, b: int(bool(a) or bool(b)),
+}
+UNARY: Dict[str, Callable[[int], int]] = {
+    'U-': lambda a: -a,
+    'U!': lambda a: int(not a),
+}
+# Operators that can be regrouped freely to bring constants together, with the value that leaves the other
+# operand unchanged.
+ASSOCIATIVE: Dict[str, int] = {'*': 1, '&': -1, '|': 0, '^': 0}
+
+
+def constant_collapse(node: AstNode, lookup: Dict[str, int]={}, *, fold: bool = True):
+    """Replace const names by their value and fold constant subexpressions in place, with exact integer math.
+
+    Const, reg and var definitions have no width yet, function code only gets the consts replaced with
+    fold=False and is folded by constant_fold once the type of every expression is known."""
     for p in node.params:
-        constant_collapse(p, lookup)
-    if node.kind in {'+', '-', '/', '*', 'SHIFT'} and node.params[0].kind == "NUM" and node.params[1].kind == "NUM":
-        if node.kind == '+':
-            node.token.value = node.params[0].token.value + node.params[1].token.value
-        elif node.kind == '-':
-            node.token.value = node.params[0].token.value - node.params[1].token.value
-        elif node.kind == '/':
-            node.token.value = node.params[0].token.value // node.params[1].token.value
-        elif node.kind == '*':
-            node.token.value = node.params[0].token.value * node.params[1].token.value
-        elif node.kind == 'SHIFT' and node.token.value == '<<':
-            node.token.value = node.params[0].token.value << node.params[1].token.value
-        elif node.kind == 'SHIFT' and node.token.value == '>>':
-            node.token.value = node.params[0].token.value >> node.params[1].token.value
-        else:
-            raise RuntimeError(node.kind)
-        node.kind = node.params[0].kind
-        node.params = ()
-    elif node.kind == 'U-' and node.params[0].kind == "NUM":
-        node.token.value = -node.params[0].token.value
-        node.kind = node.params[0].kind
+        constant_collapse(p, lookup, fold=fold)
+    if not fold:
+        pass
+    elif node.kind in BINARY and len(node.params) == 2 and node.params[0].kind == "NUM" and node.params[1].kind == "NUM":
+        value = BINARY[node.kind](node.token.value, node.params[0].token.value, node.params[1].token.value)
+        if value is not None:
+            node.token.value = value
+            node.kind = "NUM"
+            node.params = ()
+    elif node.kind in UNARY and node.params[0].kind == "NUM":
+        node.token.value = UNARY[node.kind](node.params[0].token.value)
+        node.kind = "NUM"
         node.params = ()
-    elif node.kind == "ID" and node.token.value in lookup:
+    if node.kind == "ID" and node.token.value in lookup:
         node.kind = "NUM"
         node.token.value = lookup[node.token.value]
+
+
+def constant_fold(node: AstNode, data_type: DataType, *, simplify: bool = True) -> AstNode:
+    """Fold and simplify an expression that is evaluated with the given integer type.
+
+    Every intermediate result wraps around at the width of the type, like the generated code does, so (200 + 100) >> 1
+    is 22 as u8 but 150 as u16, and comparisons are made between the wrapped values. Constants spread over a chain
+    of + and - or of the same * & | ^ operator are brought together, and operations that do not change the result,
+    like x + 0 or x & 0xFF in u8, are dropped. Parts of the expression are only dropped when they do not call a
+    function. Without simplify only the parts that are completely constant are folded. The node is not changed,
+    a new tree is returned when anything was folded."""
+    return _fold(node, data_type, simplify)
+
+
+def _fold(node: AstNode, data_type: DataType, simplify: bool) -> AstNode:
+    mask = (1 << data_type.size) - 1
+    if node.kind == 'CAST':
+        # The operand of a cast is evaluated in its own type, which is only known here when it has none.
+        if node.params[1].data_type is data_type and _is_constant(node.params[0]):
+            value = _exact_value(node.params[0])
+            if value is not None:
+                return _num(value & mask, node.token)
+        return node
+    if node.kind in UNARY:
+        param = _fold(node.params[0], data_type, simplify)
+        if param.kind == "NUM":
+            return _num(UNARY[node.kind](param.token.value & mask) & mask, node.token)
+        return node if param is node.params[0] else AstNode(node.kind, node.token, param)
+    if node.kind not in BINARY or len(node.params) != 2:
+        return node
+    a = _fold(node.params[0], data_type, simplify)
+    b = _fold(node.params[1], data_type, simplify)
+    if a.kind == "NUM" and b.kind == "NUM":
+        value = BINARY[node.kind](node.token.value, a.token.value & mask, b.token.value & mask)
+        if value is not None:
+            return _num(value & mask, node.token)
+    elif not simplify:
+        pass
+    elif node.kind in {'+', '-'}:
+        return _fold_sum(node, a, b, mask)
+    elif node.kind in ASSOCIATIVE:
+        return _fold_chain(node, a, b, mask)
+    elif node.kind in {'/', '%'} and b.kind == "NUM" and b.token.value & mask == 1:
+        if node.kind == '/':
+            return a
+        if _is_pure(a):
+            return _num(0, node.token)
+    elif node.kind == 'SHIFT' and b.kind == "NUM":
+        amount = b.token.value & mask
+        if amount == 0:
+            return a
+        if amount >= mask.bit_length() and _is_pure(a):
+            return _num(0, node.token)
+        if a.kind == 'SHIFT' and a.token.value == node.token.value and a.params[1].kind == "NUM":
+            # (x << 1) << 2 is x << 3, this only adds up to the width of the type so it stays a constant.
+            total = min(amount + (a.params[1].token.value & mask), mask.bit_length())
+            return _fold(AstNode(node.kind, node.token, a.params[0], _num(total, b.token)), data_type, simplify)
+    if a is node.params[0] and b is node.params[1]:
+        return node
+    return AstNode(node.kind, node.token, a, b)
+
+
+def _fold_sum(node: AstNode, a: AstNode, b: AstNode, mask: int) -> AstNode:
+    terms: List[Tuple[int, AstNode]] = []
+    _add_terms(a, 1, terms)
+    _add_terms(b, 1 if node.kind == '+' else -1, terms)
+    constant = sum(sign * term.token.value for sign, term in terms if term.kind == "NUM") & mask
+    others = [(sign, term) for sign, term in terms if term.kind != "NUM"]
+    result = None
+    for sign, term in others:
+        if result is None and sign > 0:
+            result = term
+            continue
+        if result is None:
+            result = _num(constant, node.token)
+            constant = 0
+        result = _op('+' if sign > 0 else '-', node.token, result, term)
+    if result is None:
+        return _num(constant, node.token)
+    if constant == 0:
+        return result
+    if (-constant) & mask < constant:
+        return _op('-', node.token, result, _num((-constant) & mask, node.token))
+    return _op('+', node.token, result, _num(constant, node.token))
+
+
+def _add_terms(node: AstNode, sign: int, terms: List[Tuple[int, AstNode]]):
+    if node.kind == '+':
+        _add_terms(node.params[0], sign, terms)
+        _add_terms(node.params[1], sign, terms)
+    elif node.kind == '-':
+        _add_terms(node.params[0], sign, terms)
+        _add_terms(node.params[1], -sign, terms)
+    else:
+        terms.append((sign, node))
+
+
+def _fold_chain(node: AstNode, a: AstNode, b: AstNode, mask: int) -> AstNode:
+    terms: List[AstNode] = []
+    _chain_terms(a, node.kind, terms)
+    _chain_terms(b, node.kind, terms)
+    identity = ASSOCIATIVE[node.kind] & mask
+    constant = identity
+    for term in terms:
+        if term.kind == "NUM":
+            constant = BINARY[node.kind](node.kind, constant, term.token.value & mask) & mask
+    others = [term for term in terms if term.kind != "NUM"]
+    absorbing = 0 if node.kind in {'*', '&'} else mask if node.kind == '|' else None
+    if constant == absorbing and all(_is_pure(term) for term in others):
+        return _num(constant, node.token)
+    if not others:
+        return _num(constant, node.token)
+    result = others[0]
+    for term in others[1:]:
+        result = _op(node.kind, node.token, result, term)
+    if constant != identity:
+        result = _op(node.kind, node.token, result, _num(constant, node.token))
+    return result
+
+
+def _chain_terms(node: AstNode, kind: str, terms: List[AstNode]):
+    if node.kind == kind:
+        _chain_terms(node.params[0], kind, terms)
+        _chain_terms(node.params[1], kind, terms)
+    else:
+        terms.append(node)
+
+
+def _is_constant(node: AstNode) -> bool:
+    if node.kind == "NUM":
+        return True
+    if node.kind not in BINARY and node.kind not in UNARY:
+        return False
+    return all(_is_constant(p) for p in node.params)
+
+
+def _exact_value(node: AstNode) -> Optional[int]:
+    if node.kind == "NUM":
+        return node.token.value
+    values = [_exact_value(p) for p in node.params]
+    if None in values:
+        return None
+    if node.kind in UNARY:
+        return UNARY[node.kind](values[0])
+    return BINARY[node.kind](node.token.value, values[0], values[1])
+
+
+def _is_pure(node: AstNode) -> bool:
+    """No function calls or assignments, so leaving out the code for this node does not change the program."""
+    if node.kind in {'CALL', '='}:
+        return False
+    return all(_is_pure(p) for p in node.params)
+
+
+def _num(value: int, token: Token) -> AstNode:
+    return AstNode("NUM", Token("NUM", value, token.line_number, token.module))
+
+
+def _op(kind: str, token: Token, a: AstNode, b: AstNode) -> AstNode:
+    return AstNode(kind, Token(kind, kind, token.line_number, token.module), a, b)
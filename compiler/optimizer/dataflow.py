@@ -0,0 +1,212 @@
+import itertools
+from typing import Dict, List, Optional, Set, Tuple
+
+from ..parse.function import Function
+from ..pseudo import *
+from ..scope import Scope
+from .cfg import ControlFlowGraph, CONSUMED_ARGS, RESULT_ARG, UNKNOWN, function_labels, registers, renamed
+from .passes import optimization_pass, PSEUDO_PASS
+
+# Registers that can hold values at the same time around a kept common subexpression, so the register allocator
+# still has room to move values into A and to put a 16 bit value in a register pair.
+MAX_LIVE_REGISTERS = 5
+
+
+@optimization_pass("copy-propagation", PSEUDO_PASS)
+def propagate_copies(ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+    """A load of a label that every reaching store gave the same constant loads the constant instead. A load of a
+    label that was stored with the value of another label earlier in the block, loads that label when it did not
+    change in between, so the store can become dead."""
+    own, volatile = function_labels(scope)
+    reaching = ControlFlowGraph(ops).reaching_definitions(own)
+    result = list(ops)
+    for idx, op in enumerate(ops):
+        if op.kind != OP_LOAD or op.args[1] in volatile:
+            continue
+        defs = reaching[idx].get(op.args[1], frozenset())
+        if not defs or UNKNOWN in defs:
+            continue
+        values = {_stored_value(ops, store, op.size, volatile) for store in defs}
+        if len(values) != 1:
+            continue
+        value = values.pop()
+        if value is None:
+            continue
+        if value[0] == OP_LOAD_VALUE:
+            result[idx] = _op(OP_LOAD_VALUE, op.size, op.args[0], value[1])
+        elif len(defs) == 1 and not _written_between(ops, min(defs), idx, value[1], own):
+            result[idx] = _op(OP_LOAD, op.size, op.args[0], value[1])
+    return result
+
+
+def _stored_value(ops: List[PseudoOp], store: int, size: int, volatile: Set[str]) -> Optional[Tuple[int, object]]:
+    """The constant or the label a store directly copies, when it has that size."""
+    value = ops[store - 1] if store > 0 else None
+    if value is None or ops[store].size != size or value.size != size or value.args[0] != ops[store].args[0]:
+        return None
+    if value.kind == OP_LOAD_VALUE:
+        return OP_LOAD_VALUE, value.args[1] & ((1 << size) - 1)
+    if value.kind == OP_LOAD and value.args[1] not in volatile and value.args[1] != ops[store].args[1]:
+        return OP_LOAD, value.args[1]
+    return None
+
+
+def _written_between(ops: List[PseudoOp], start: int, end: int, label: str, own: Set[str]) -> bool:
+    for op in ops[start:end]:
+        if op.kind in {OP_LABEL, OP_JUMP, OP_JUMP_ZERO, OP_RETURN, OP_STORE_REF}:
+            return True
+        if op.kind == OP_STORE and op.args[1] == label:
+            return True
+        if op.kind == OP_CALL and label not in own:
+            return True
+    return False
+
+
+@optimization_pass("dead-stores", PSEUDO_PASS)
+def remove_dead_stores(ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+    """Leave out stores to labels that are not read anymore before they are stored again, together with the ops
+    that compute the stored value when leaving those out has no effect."""
+    own, volatile = function_labels(scope)
+    live = ControlFlowGraph(ops).liveness(own)
+    removed: Set[int] = set()
+    for idx, op in enumerate(ops):
+        if op.kind == OP_STORE and op.args[1] not in volatile and op.args[1] not in live[idx]:
+            value_ops = _value_ops(ops, idx - 1, op.args[0], volatile)
+            if value_ops is not None:
+                removed.add(idx)
+                removed.update(value_ops)
+    return [op for idx, op in enumerate(ops) if idx not in removed]
+
+
+def _value_ops(ops: List[PseudoOp], end: int, register: int, volatile: Set[str]) -> Optional[Set[int]]:
+    """The ops up to end that compute the value of a register, None when they read a reg or through a pointer."""
+    needed = {register}
+    result: Set[int] = set()
+    idx = end
+    while needed:
+        if idx < 0 or ops[idx].kind == OP_LABEL:
+            return None
+        op = ops[idx]
+        if op.kind in RESULT_ARG and op.args[RESULT_ARG[op.kind]] in needed:
+            if op.kind in {OP_DEREF, OP_COPY} or (op.kind == OP_LOAD and op.args[1] in volatile):
+                return None
+            result.add(idx)
+            if op.kind in {OP_LOAD, OP_LOAD_VALUE}:
+                needed.discard(op.args[0])
+            needed.update(op.args[pos] for pos in CONSUMED_ARGS.get(op.kind, ()))
+        idx -= 1
+    return result
+
+
+@optimization_pass("cse", PSEUDO_PASS)
+def eliminate_common_subexpressions(ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+    """Keep a copy of a computed value in a register when the same computation is done again later in the basic
+    block, with the same values of the labels it reads."""
+    own, volatile = function_labels(scope)
+    next_register = max((r for op in ops for r in registers(op)), default=0) + 1
+    result: List[PseudoOp] = []
+    for block in ControlFlowGraph(ops).blocks:
+        block_ops, next_register = _eliminate_in_block(ops[block.start:block.end], volatile, next_register)
+        result += block_ops
+    return result
+
+
+def _eliminate_in_block(ops: List[PseudoOp], volatile: Set[str], next_register: int) -> Tuple[List[PseudoOp], int]:
+    # Value numbering, loads are numbered with the number of stores to the label before them and calls and stores
+    # through pointers change the value of every label.
+    values: Dict[int, tuple] = {}
+    versions: Dict[str, int] = {}
+    epoch = 0
+    unique = itertools.count()
+    occurrences: List[Tuple[int, int, tuple]] = []
+    live: Set[int] = set()
+    pressure: List[int] = []
+    for idx, op in enumerate(ops):
+        if op.kind == OP_LOAD:
+            label = op.args[1]
+            if label in volatile:
+                values[op.args[0]] = ("volatile", next(unique))
+            else:
+                values[op.args[0]] = ("load", label, op.size, versions.get(label, 0), epoch)
+        elif op.kind == OP_LOAD_VALUE:
+            values[op.args[0]] = ("value", op.size, op.args[1] & ((1 << op.size) - 1))
+        elif op.kind in {OP_ARITHMETIC, OP_LOGIC, OP_SHIFT}:
+            values[op.args[1]] = (op.kind, op.args[0], op.size, values[op.args[1]], values[op.args[2]])
+            occurrences.append((idx, op.args[1], values[op.args[1]]))
+        elif op.kind in {OP_COMPLEMENT, OP_CAST}:
+            values[op.args[0]] = (op.kind, op.args[1:], op.size, values[op.args[0]])
+            occurrences.append((idx, op.args[0], values[op.args[0]]))
+        elif op.kind == OP_DEREF:
+            values[op.args[0]] = ("deref", next(unique))
+        elif op.kind == OP_COPY:
+            values[op.args[0]] = values[op.args[1]]
+        elif op.kind == OP_STORE:
+            versions[op.args[1]] = versions.get(op.args[1], 0) + 1
+        elif op.kind in {OP_CALL, OP_STORE_REF}:
+            epoch += 1
+        if op.kind in RESULT_ARG:
+            live.add(op.args[RESULT_ARG[op.kind]])
+        live.difference_update(op.args[pos] for pos in CONSUMED_ARGS.get(op.kind, ()))
+        pressure.append(len(live))
+
+    first: Dict[tuple, Tuple[int, int]] = {}
+    for idx, register, value in occurrences:
+        first.setdefault(value, (idx, register))
+    # Later occurrences are picked from the back, so the largest repeated expression is kept and the parts of it
+    # are not considered anymore.
+    covered: Set[int] = set()
+    chosen: Dict[tuple, List[Tuple[int, int, Set[int]]]] = {}
+    extra = [0] * len(ops)
+    for idx, register, value in reversed(occurrences):
+        start, _ = first[value]
+        if idx in covered or start == idx or _result_size(ops[idx]) != 8:
+            continue
+        slice_ops = _value_ops(ops, idx, register, volatile)
+        if slice_ops is None or start >= min(slice_ops):
+            continue
+        if value not in chosen:
+            span = range(start, idx + 1)
+            if any(_result_size(op) == 16 or op.kind in {OP_DEREF, OP_STORE_REF} for op in ops[start:idx + 1]):
+                continue
+            if any(pressure[p] + extra[p] + 1 > MAX_LIVE_REGISTERS for p in span):
+                continue
+            for p in span:
+                extra[p] += 1
+            chosen[value] = []
+        chosen[value].append((idx, register, slice_ops))
+        covered.update(slice_ops)
+
+    insert_after: Dict[int, PseudoOp] = {}
+    replace: Dict[int, PseudoOp] = {}
+    removed: Set[int] = set()
+    mapping: Dict[int, int] = {}
+    for value, later in chosen.items():
+        start, register = first[value]
+        temp = next_register
+        next_register += 1
+        insert_after[start] = _op(OP_COPY, 8, temp, register)
+        for idx, later_register, slice_ops in later:
+            removed.update(slice_ops)
+            if idx == later[0][0]:
+                mapping[later_register] = temp
+            else:
+                replace[idx] = _op(OP_COPY, 8, later_register, temp)
+    result: List[PseudoOp] = []
+    for idx, op in enumerate(ops):
+        if idx in replace:
+            result.append(replace[idx])
+        elif idx not in removed:
+            result.append(renamed(op, mapping))
+        if idx in insert_after:
+            result.append(insert_after[idx])
+    return result, next_register
+
+
+def _result_size(op: PseudoOp) -> int:
+    return op.args[1] if op.kind == OP_CAST else op.size
+
+
+def _op(kind: int, size: int, *args) -> PseudoOp:
+    op = PseudoOp(kind, *args)
+    op.size = size
+    return op
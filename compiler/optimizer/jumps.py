@@ -0,0 +1,56 @@
+from typing import List
+
+from ..parse.function import Function
+from ..pseudo import PseudoOp, OP_LOAD_VALUE, OP_LABEL, OP_JUMP, OP_JUMP_ZERO, OP_RETURN
+from ..scope import Scope
+from .passes import optimization_pass, PSEUDO_PASS
+
+
+@optimization_pass("branches", PSEUDO_PASS)
+def constant_branches(ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+    """A conditional jump on a constant, like the condition of `while 1`, becomes a jump or is left out."""
+    result: List[PseudoOp] = []
+    for op in ops:
+        if op.kind == OP_JUMP_ZERO and result and result[-1].kind == OP_LOAD_VALUE and result[-1].args[0] == op.args[1]:
+            load = result.pop()
+            if load.args[1] & ((1 << op.size) - 1) == 0:
+                result.append(PseudoOp(OP_JUMP, op.args[0]))
+            continue
+        result.append(op)
+    return result
+
+
+@optimization_pass("unreachable", PSEUDO_PASS)
+def remove_unreachable(ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+    """Leave out the ops behind a jump or return that are not behind a label that is jumped to, and unused labels."""
+    while True:
+        targets = {op.args[0] for op in ops if op.kind in {OP_JUMP, OP_JUMP_ZERO}}
+        result: List[PseudoOp] = []
+        reachable = True
+        for op in ops:
+            if op.kind == OP_LABEL:
+                if op.args[0] not in targets:
+                    continue
+                reachable = True
+            if reachable:
+                result.append(op)
+            if op.kind in {OP_JUMP, OP_RETURN}:
+                reachable = False
+        if len(result) == len(ops):
+            return result
+        ops = result
+
+
+@optimization_pass("fallthrough", PSEUDO_PASS)
+def remove_jumps_to_next(ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+    """Leave out jumps to a label that directly follows them."""
+    result: List[PseudoOp] = []
+    for idx, op in enumerate(ops):
+        if op.kind == OP_JUMP:
+            following = idx + 1
+            while following < len(ops) and ops[following].kind == OP_LABEL and ops[following].args[0] != op.args[0]:
+                following += 1
+            if following < len(ops) and ops[following].kind == OP_LABEL:
+                continue
+        result.append(op)
+    return result
@@ -0,0 +1,92 @@
+import time
+from typing import Dict, List, NamedTuple
+
+from ..astnode import AstNode
+from ..parse.function import Function
+from ..pseudo import PseudoOp
+from ..scope import Scope
+from .passes import OptimizationPass, get_pass, AST_PASS, PSEUDO_PASS
+from . import simplify
+from . import jumps
+from . import dataflow
+
+# Passes per optimization level, AST passes run before the function is lowered to pseudo ops and pseudo passes
+# after. Constant expressions are always folded while lowering, as the backend has no code for most operators on
+# constants. All of the passes make the code smaller, -Os runs the same ones as -O2 but has the code generator pick the
+# shorter of two instruction sequences where -O2 picks the faster one.
+OPT_LEVELS: Dict[str, List[str]] = {
+    "0": [],
+    "1": ["simplify", "branches"],
+    "2": ["simplify", "branches", "unreachable", "fallthrough", "copy-propagation", "dead-stores", "cse"],
+    "s": ["simplify", "branches", "unreachable", "fallthrough", "copy-propagation", "dead-stores", "cse"],
+}
+
+
+class PassTiming(NamedTuple):
+    """Time spent in a pass and the size of the IR it was given and gave back, in AST nodes or pseudo ops."""
+    seconds: float
+    size_before: int
+    size_after: int
+
+
+class PassStats:
+    def __init__(self, name: str, kind: str):
+        self.name = name
+        self.kind = kind
+        self.seconds = 0.0
+        self.size_before = 0
+        self.size_after = 0
+        self.functions = 0
+
+    def add(self, timing: PassTiming) -> None:
+        self.seconds += timing.seconds
+        self.size_before += timing.size_before
+        self.size_after += timing.size_after
+        self.functions += 1
+
+    def __repr__(self):
+        unit = "nodes" if self.kind == AST_PASS else "ops"
+        return f"{self.name} ({self.kind}): {self.seconds * 1000:.2f}ms, {self.size_before} -> {self.size_after} {unit} in {self.functions} functions"
+
+
+class PassManager:
+    """Runs the optimization passes of a level on a single function and records how long each one took."""
+
+    def __init__(self, level: str = "2"):
+        if level not in OPT_LEVELS:
+            raise ValueError(f"Unknown optimization level: {level}")
+        self.level = level
+        self.passes: List[OptimizationPass] = [get_pass(name) for name in OPT_LEVELS[level]]
+        # The peephole optimizer of the assembler runs on the linked code, outside of the pass manager.
+        self.peephole = level != "0"
+        self.favor_size = level == "s"
+        self.timings: Dict[str, PassTiming] = {}
+
+    def run_ast(self, block: List[AstNode], scope: Scope, func: Function) -> List[AstNode]:
+        for optimization in self.passes:
+            if optimization.kind == AST_PASS:
+                block = self._timed(optimization, block, _node_count, block, scope, func)
+        return block
+
+    def run_pseudo(self, ops: List[PseudoOp], scope: Scope, func: Function) -> List[PseudoOp]:
+        for optimization in self.passes:
+            if optimization.kind == PSEUDO_PASS:
+                ops = self._timed(optimization, ops, len, ops, scope, func)
+        return ops
+
+    def _timed(self, optimization: OptimizationPass, ir, size, *args):
+        size_before = size(ir)
+        start = time.perf_counter()
+        result = optimization.run(*args)
+        self.timings[optimization.name] = PassTiming(time.perf_counter() - start, size_before, size(result))
+        return result
+
+
+def _node_count(block: List[AstNode]) -> int:
+    count = 0
+    todo = list(block)
+    while todo:
+        node = todo.pop()
+        count += 1
+        todo.extend(node.params)
+    return count
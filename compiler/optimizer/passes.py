@@ -0,0 +1,29 @@
+from typing import Callable, Dict, NamedTuple
+
+# AST passes are called with (block, scope, function) and return the new statements of the function, pseudo passes
+# are called with (ops, scope, function) and return the new list of pseudo ops. Passes do not modify what they are
+# given.
+AST_PASS = "ast"
+PSEUDO_PASS = "pseudo"
+
+
+class OptimizationPass(NamedTuple):
+    name: str
+    kind: str
+    run: Callable
+
+
+_passes: Dict[str, OptimizationPass] = {}
+
+
+def optimization_pass(name: str, kind: str):
+    def impl(f):
+        assert kind in {AST_PASS, PSEUDO_PASS}
+        assert name not in _passes, f"Duplicate optimization pass {name}"
+        _passes[name] = OptimizationPass(name, kind, f)
+        return f
+    return impl
+
+
+def get_pass(name: str) -> OptimizationPass:
+    return _passes[name]
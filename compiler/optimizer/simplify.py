@@ -0,0 +1,61 @@
+from typing import List, Optional
+
+from ..astnode import AstNode
+from ..datatype import DataType, DEFAULT_TYPE
+from ..parse.function import Function
+from ..pseudo import discover_type
+from ..scope import Scope
+from .constant import constant_fold
+from .passes import optimization_pass, AST_PASS
+
+
+@optimization_pass("simplify", AST_PASS)
+def simplify(block: List[AstNode], scope: Scope, func: Function) -> List[AstNode]:
+    """Algebraic simplification of every expression in the function, in the type it is evaluated with."""
+    simplifier = _Simplifier(scope, func)
+    return [simplifier.statement(node) for node in block]
+
+
+class _Simplifier:
+    def __init__(self, scope: Scope, func: Function):
+        self._scope = scope
+        self._func = func
+
+    def statement(self, node: AstNode) -> AstNode:
+        if node.kind == '=':
+            target = node.params[0]
+            if target.kind == "U*":
+                data_type = self._scope.resolve_var(target.params[0])[1].target
+            else:
+                data_type = self._scope.resolve_var(target)[1]
+            return _rebuild(node, (target, self.expression(node.params[1], data_type)))
+        if node.kind == 'VAR':
+            return _rebuild(node, (self.expression(node.params[0], self._scope.resolve_var(node)[1]),))
+        if node.kind == 'RETURN':
+            return _rebuild(node, tuple(self.expression(p, self._func.return_type) for p in node.params))
+        if node.kind == 'IF':
+            return _rebuild(node, tuple(self.statement(p) if p.kind in {"TRUE", "ELIF", "FALSE"} else self.expression(p, DEFAULT_TYPE) for p in node.params))
+        if node.kind == 'WHILE':
+            return _rebuild(node, (self.expression(node.params[0], DEFAULT_TYPE),) + tuple(self.statement(p) for p in node.params[1:]))
+        if node.kind == 'CALL':
+            return self.expression(node, None)
+        return _rebuild(node, tuple(self.statement(p) for p in node.params))
+
+    def expression(self, node: AstNode, data_type: Optional[DataType]) -> AstNode:
+        if data_type is not None and data_type.type == DataType.INT:
+            node = constant_fold(node, data_type)
+        if node.kind == 'CALL':
+            func = self._scope.find_function(node.params[0])
+            if len(func.parameters) != len(node.params) - 1:
+                return node
+            return _rebuild(node, (node.params[0],) + tuple(self.expression(p, param.data_type) for p, param in zip(node.params[1:], func.parameters)))
+        if node.kind in {'CAST', 'U*'}:
+            source_type = discover_type(self._scope, node.params[0])
+            return _rebuild(node, (self.expression(node.params[0], source_type),) + node.params[1:])
+        return _rebuild(node, tuple(self.expression(p, data_type) for p in node.params))
+
+
+def _rebuild(node: AstNode, params: tuple) -> AstNode:
+    if all(a is b for a, b in zip(params, node.params)):
+        return node
+    return AstNode(node.kind, node.token, *params, data_type=node.data_type)
@@ -0,0 +1,199 @@
+import functools
+import gc
+import hashlib
+import marshal
+import os
+import zlib
+from array import array
+from typing import Dict, List, Optional, Union
+
+from .astnode import AstNode
+from .datatype import BASE_TYPES, DataType
+from .module import Module
+from .parse.function import Function
+from .parse.parser import parse
+from .scanner import Token
+
+# Parsed module layout: magic, version byte, then a zlib compressed marshal of a tuple with
+#   module name
+#   tokens as parallel lists: kinds, values, line numbers (array of uint32) and module names. Tokens shared between
+#          nodes stay shared, as constant collapsing updates token values in place.
+#   nodes in post order as parallel lists: kinds, token indexes (array of int32, -1 for no token), data types
+#          (array of uint32) and parameter counts (array of uint32). The nodes left over after rebuilding the
+#          trees are the vars, consts and regs, then per function its parameters followed by its block.
+#   counts of vars, consts and regs
+#   functions as (token index, return type, parameter count, block size)
+# Data types are 0 for no type, else the size of the base type with the pointer depth in the bits above 8.
+MAGIC = b"GBSM"
+VERSION = 1
+
+
+class ParseCacheException(Exception):
+    pass
+
+
+class _ModuleWriter:
+    def __init__(self) -> None:
+        self.tokens: Dict[int, int] = {}
+        # Equal strings are stored once, marshal writes a back reference for every repeated object.
+        self.pool: Dict[Union[str, int], Union[str, int]] = {}
+        self.token_kinds: List[str] = []
+        self.token_values: List[Union[str, int]] = []
+        self.token_lines = array("I")
+        self.token_modules: List[str] = []
+        self.node_kinds: List[str] = []
+        self.node_tokens = array("i")
+        self.node_types = array("I")
+        self.node_params = array("I")
+
+    def token(self, token: Optional[Token]) -> int:
+        if token is None:
+            return -1
+        index = self.tokens.get(id(token))
+        if index is None:
+            index = self.tokens[id(token)] = len(self.token_kinds)
+            self.token_kinds.append(self.pool.setdefault(token.kind, token.kind))
+            self.token_values.append(self.pool.setdefault(token.value, token.value))
+            self.token_lines.append(token.line_number)
+            self.token_modules.append(self.pool.setdefault(token.module, token.module))
+        return index
+
+    def node(self, node: AstNode) -> None:
+        for param in node.params:
+            self.node(param)
+        self.node_kinds.append(self.pool.setdefault(node.kind, node.kind))
+        self.node_tokens.append(self.token(node.token))
+        self.node_types.append(_type_code(node.data_type))
+        self.node_params.append(len(node.params))
+
+
+def _type_code(data_type: Optional[DataType]) -> int:
+    if data_type is None:
+        return 0
+    depth = 0
+    while data_type.type == DataType.POINTER:
+        data_type = data_type.target
+        depth += 1
+    return depth << 8 | data_type.size
+
+
+def _data_type(data_types: Dict[int, DataType], type_code: int) -> Optional[DataType]:
+    data_type = data_types.get(type_code)
+    if data_type is None and type_code:
+        data_type = data_types[type_code & 0xFF]
+        for _ in range(type_code >> 8):
+            data_type = data_type.get_pointer()
+        data_types[type_code] = data_type
+    return data_type
+
+
+def dumps(module: Module) -> bytes:
+    w = _ModuleWriter()
+    for node in module.vars + module.consts + module.regs:
+        w.node(node)
+    functions = []
+    for function in module.funcs:
+        for node in function.parameters + function.block:
+            w.node(node)
+        functions.append((w.token(function.token), _type_code(function.return_type), len(function.parameters), len(function.block)))
+    payload = (
+        module.name,
+        w.token_kinds, w.token_values, w.token_lines.tobytes(), w.token_modules,
+        w.node_kinds, w.node_tokens.tobytes(), w.node_types.tobytes(), w.node_params.tobytes(),
+        (len(module.vars), len(module.consts), len(module.regs)), functions,
+    )
+    return MAGIC + bytes([VERSION]) + zlib.compress(marshal.dumps(payload), 1)
+
+
+def loads(data: bytes) -> Module:
+    if data[:len(MAGIC)] != MAGIC:
+        raise ParseCacheException("Not a parsed module")
+    if data[len(MAGIC):len(MAGIC) + 1] != bytes([VERSION]):
+        raise ParseCacheException("Unsupported parsed module version")
+    try:
+        (name, token_kinds, token_values, token_lines, token_modules, node_kinds, node_tokens, node_types, node_params,
+         (var_count, const_count, reg_count), functions) = marshal.loads(zlib.decompress(data[len(MAGIC) + 1:]))
+    except (zlib.error, EOFError, ValueError, TypeError):
+        raise ParseCacheException("Damaged parsed module")
+
+    # Rebuilding creates many small objects without reference cycles, the garbage collector only slows that down.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        tokens = list(map(Token, token_kinds, token_values, array("I", token_lines), token_modules))
+        data_types = {data_type.size: data_type for data_type in BASE_TYPES.values()}
+        roots: List[AstNode] = []
+        for kind, token, type_code, param_count in zip(node_kinds, array("i", node_tokens), array("I", node_types), array("I", node_params)):
+            data_type = _data_type(data_types, type_code)
+            if param_count:
+                params = roots[-param_count:]
+                del roots[-param_count:]
+                roots.append(AstNode(kind, tokens[token] if token >= 0 else None, *params, data_type=data_type))
+            else:
+                roots.append(AstNode(kind, tokens[token] if token >= 0 else None, data_type=data_type))
+
+        module = Module(name)
+        module.vars = roots[:var_count]
+        module.consts = roots[var_count:var_count + const_count]
+        module.regs = roots[var_count + const_count:var_count + const_count + reg_count]
+        position = var_count + const_count + reg_count
+        for token, type_code, param_count, block_size in functions:
+            function = Function(tokens[token])
+            function.return_type = _data_type(data_types, type_code)
+            function.parameters = roots[position:position + param_count]
+            function.set_block(roots[position + param_count:position + param_count + block_size])
+            position += param_count + block_size
+            module.funcs.append(function)
+    except (IndexError, KeyError, ValueError) as e:
+        raise ParseCacheException(f"Damaged parsed module: {e}")
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return module
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version() -> str:
+    """Digest of the sources that decide what parse() returns, so any change to them invalidates the cache."""
+    base = os.path.dirname(os.path.abspath(__file__))
+    names = ["scanner.py", "astnode.py", "datatype.py", "module.py", "parsecache.py"]
+    names += sorted(os.path.join("parse", name) for name in os.listdir(os.path.join(base, "parse")) if name.endswith(".py"))
+    digest = hashlib.sha256(MAGIC + bytes([VERSION, marshal.version]))
+    for name in names:
+        with open(os.path.join(base, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Parsed modules stored in a directory, keyed by the module name, its source and the compiler version."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, module_name: str, code: str) -> str:
+        key = hashlib.sha256(f"{compiler_version()}\0{module_name}\0{code}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:32] + ".sm")
+
+    def parse(self, module_name: str, code: str) -> Module:
+        filename = self.filename(module_name, code)
+        try:
+            with open(filename, "rb") as f:
+                module = loads(f.read())
+            self.hits += 1
+            return module
+        except (OSError, ParseCacheException):
+            pass  # Missing or damaged entries are parsed again and replaced.
+        module = parse(module_name, code)
+        self.misses += 1
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_filename = f"{filename}.{os.getpid()}.tmp"
+            with open(temp_filename, "wb") as f:
+                f.write(dumps(module))
+            os.replace(temp_filename, filename)
+        except OSError:
+            pass  # A cache that cannot be written only costs the parse next time.
+        return module
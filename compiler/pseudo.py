@@ -1,10 +1,11 @@
-from typing import List
+from typing import List, Optional, Set
 
 from .astnode import AstNode
 from .exception import CompileException
 from .parse.function import Function
 from .scope import Scope
 from .datatype import DataType, DEFAULT_TYPE
+from .optimizer.constant import constant_fold
 
 OP_LOAD = 0
 OP_LOAD_VALUE = 1
@@ -21,7 +22,8 @@ OP_RETURN = 11
 OP_CAST = 12
 OP_DEREF = 13
 OP_STORE_REF = 14
-OP_NAMES = ["LOAD", "LOADV", "STORE", "ARITHETIC", "LOGIC", "LABEL", "JUMP", "JUMP_ZERO", "COMPLEMENT", "SHIFT", "CALL", "RETURN", "CAST", "DEREF", "STORE_REF"]
+OP_COPY = 15  # Only created by optimization passes, the source register stays in use.
+OP_NAMES = ["LOAD", "LOADV", "STORE", "ARITHETIC", "LOGIC", "LABEL", "JUMP", "JUMP_ZERO", "COMPLEMENT", "SHIFT", "CALL", "RETURN", "CAST", "DEREF", "STORE_REF", "COPY"]
 
 
 class PseudoOp:
@@ -35,14 +37,18 @@ class PseudoOp:
 
 
 class PseudoState:
-    def __init__(self, scope: Scope, func: Function):
+    def __init__(self, scope: Scope, func: Function, block: Optional[List[AstNode]] = None):
         self.ops: List[PseudoOp] = []
         self._reg_count = 0
         self._free_regs = []
         self._label_nr = 0
         self._func = func
         self._scope = scope
-        self.block(func.block)
+        # Labels of regs, their loads and stores are hardware accesses.
+        self.volatile: Set[str] = set()
+        # Functions of the calls being lowered that already have arguments stored.
+        self._storing_arguments: List[str] = []
+        self.block(func.block if block is None else block)
         assert len(self._free_regs) == self._reg_count, f"{self._free_regs} != {self._reg_count}"
 
     def block(self, block):
@@ -60,6 +66,8 @@ class PseudoState:
         self._free_regs.append(r)
 
     def step(self, node: AstNode, data_type: DataType):
+        if data_type is not None and data_type.type == DataType.INT:
+            node = constant_fold(node, data_type, simplify=False)
         r0 = -1
         if node.kind == '=':
             assert data_type is None
@@ -73,6 +81,8 @@ class PseudoState:
                 self.free_reg(r2)
             else:
                 label, data_type = self._scope.resolve_var(node.params[0])
+                if self._scope.is_reg(node.params[0]):
+                    self.volatile.add(label)
                 r1 = self.step(node.params[1], data_type)
                 self.ops.append(PseudoOp(OP_STORE, r1, label, data_type=data_type))
                 self.free_reg(r1)
@@ -108,6 +118,8 @@ class PseudoState:
             self.free_reg(r1)
         elif node.kind == 'ID':
             label, var_data_type = self._scope.resolve_var(node)
+            if self._scope.is_reg(node):
+                self.volatile.add(label)
             if var_data_type != data_type:
                 raise CompileException(node.token, f"Wrong type {var_data_type} != {data_type}")
             r0 = self.new_reg()
@@ -157,10 +169,17 @@ class PseudoState:
                 raise CompileException(node.token, f"Wrong number of parameters to function {func.name}")
             if data_type is not None and data_type != func.return_type:
                 raise CompileException(node.token, f"Type mismatch {data_type} != {func.return_type}")
-            for param_node, param in zip(node.params[1:], func.parameters):
+            if func.name in self._storing_arguments:
+                # The call would overwrite the arguments that are already stored for the outer call
+                raise CompileException(node.token, f"Call to {func.name} in its own arguments is not supported")
+            for idx, (param_node, param) in enumerate(zip(node.params[1:], func.parameters)):
                 r1 = self.step(param_node, param.data_type)
                 self.ops.append(PseudoOp(OP_STORE, r1, f"local_{func.name}_{param.token.value}", data_type=param.data_type))
                 self.free_reg(r1)
+                if idx == 0:
+                    self._storing_arguments.append(func.name)
+            if func.parameters:
+                self._storing_arguments.pop()
             self.ops.append(PseudoOp(OP_CALL, func.name))
             if data_type:
                 r0 = self.new_reg()
@@ -170,18 +189,23 @@ class PseudoState:
         return r0
 
     def discover_type(self, node: AstNode):
-        if node.data_type:
-            return node.data_type
-        if node.kind == "CAST":
-            return node.params[1].data_type
-        if node.kind == "ID":
-            return self._scope.resolve_var(node)[1]
-        for p in node.params:
-            res = self.discover_type(p)
-            if res:
-                return res
-        return None
+        return discover_type(self._scope, node)
 
     def next_label(self):
         self._label_nr += 1
         return self._label_nr
+
+
+def discover_type(scope: Scope, node: AstNode) -> Optional[DataType]:
+    """The type of the first typed value in an expression, None when it only has constants."""
+    if node.data_type:
+        return node.data_type
+    if node.kind == "CAST":
+        return node.params[1].data_type
+    if node.kind == "ID":
+        return scope.resolve_var(node)[1]
+    for p in node.params:
+        res = discover_type(scope, p)
+        if res:
+            return res
+    return None
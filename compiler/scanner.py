@@ -1,3 +1,4 @@
+import re
 from typing import Optional, Union
 from .exception import CompileException
 
@@ -17,22 +18,46 @@ class Token:
         return f"<{self.kind}>"
 
 
+OPS = {
+    "SHIFT": {"<<", ">>"},
+    "==": {"<=", ">=", "==", "!="},
+    "&&": {"&&"},
+    "||": {"||"},
+    "=": {"+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=", "^=", "|="},
+}
+OP_LOOKUP = {op: group for group, ops in OPS.items() for op in ops}
+
+# The whole module is split into token texts by a single findall, spaces, tabs and comments are skipped in the
+# prefix. A line break token also takes the empty and comment only lines behind it and the indentation of the next
+# line. Operators are matched on their first two characters only, so "<<=" scans as "<<" followed by "=". The empty
+# text at the end marks the end of the file.
+TOKEN_REGEX = re.compile(r"""(?:[ \t]+|[;\#][^\n]*)*(
+    [A-Za-z_][A-Za-z0-9_]*
+    |[0-9](?:[xX][0-9a-fA-F]*|[bB][01]*|[0-9]*)
+    |(?:\r\n?|\n)(?:\ *(?:;[^\n]*)?\n)*\ *(?:;[^\n]*)?(?:(?:[ \t]+|[;\#][^\n]*)+\Z)?
+    |"(?:[^"\\]+|\\[xX].{0,2}|\\.?)*"?
+    |%s
+    |[^ \t;\#]
+    |\Z
+)""" % "|".join(re.escape(op) for op in sorted(OP_LOOKUP) if len(op) == 2), re.VERBOSE | re.DOTALL)
+STRING_BODY_REGEX = re.compile(r"""(?:[^"\\]+|\\[xX].{0,2}|\\.?)*""", re.DOTALL)
+ESCAPE_REGEX = re.compile(r"\\(?:[xX](.{0,2})|(.?))", re.DOTALL)
+INDENT_REGEX = re.compile(r"( *)(?:;[^\n]*)?")
+LEADING_CHAR_KINDS = {
+    "": "", "\r": "NEWLINE", "\n": "NEWLINE", '"': "STRING", "_": "ID",
+    **{c: "NUM" for c in "0123456789"},
+    **{c: "ID" for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"},
+}
+NUMBER_BASES = {"x": 16, "X": 16, "b": 2, "B": 2}
+
+
 class Scanner:
-    OPS = {
-        "SHIFT": {"<<", ">>"},
-        "==": {"<=", ">=", "==", "!="},
-        "&&": {"&&"},
-        "||": {"||"},
-        "=": {"+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=", "^=", "|="},
-    }
+    OPS = OPS
+    OP_LOOKUP = OP_LOOKUP
 
     def __init__(self, module_name: str, code: str):
-        self.OP_LOOKUP = {}
-        for group, ops in self.OPS.items():
-            for op in ops:
-                self.OP_LOOKUP[op] = group
-        self.__code = code
-        self.__position = 0
+        self.__texts = TOKEN_REGEX.findall(code)
+        self.__index = 0
         self.__line_number = 1
         self.__module = module_name
         self.previous = Token("", "", -1, module_name)
@@ -41,97 +66,46 @@ class Scanner:
 
     def advance(self) -> None:
         self.previous = self.current
-        while self.__next() in {" ", "\t"}:
-            self.__position += 1
-        if self.__position >= len(self.__code):
-            self.current = Token("", "", self.__line_number, self.__module)
-            return
-        c = self.__code[self.__position]
-        if c == ';' or c == '#':
-            while self.__position < len(self.__code) and self.__next() != "\n":
-                self.__position += 1
-            self.advance()
-            return
-        self.__position += 1
-        if c in "0123456789":
-            base = 10
-            if self.__next().lower() == "x":
-                self.__position += 1
-                base = 16
-                while self.__next() in {"0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "A", "B", "C", "D", "E", "F", "a", "b", "c", "d", "e", "f"}:
-                    c += self.__code[self.__position]
-                    self.__position += 1
-            elif self.__next().lower() == "b":
-                self.__position += 1
-                base = 2
-                while self.__next() in {"0", "1"}:
-                    c += self.__code[self.__position]
-                    self.__position += 1
-            else:
-                while self.__next() in {"0", "1", "2", "3", "4", "5", "6", "7", "8", "9"}:
-                    c += self.__code[self.__position]
-                    self.__position += 1
-            self.current = Token("NUM", int(c, base), self.__line_number, self.__module)
-        elif c in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_":
-            while self.__next() in {"A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R", "S", "T", "U", "V", "W", "X", "Y", "Z", "a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m", "n", "o", "p", "q", "r", "s", "t", "u", "v", "w", "x", "y", "z", "_", "0", "1", "2", "3", "4", "5", "6", "7", "8", "9"}:
-                c += self.__code[self.__position]
-                self.__position += 1
-            if c.lower() == "as":
-                self.current = Token("AS", c, self.__line_number, self.__module)
-            else:
-                self.current = Token("ID", c, self.__line_number, self.__module)
-        elif c == "\n" or c == "\r":
-            if c == "\r" and self.__next() == "\n":
-                self.__position += 1
-            indent = 0
-            while self.__next() == " ":
-                self.__position += 1
-                indent += 1
-            if self.__next() == ";":   # skip empty lines with just comments
-                while self.__next() not in {"", "\n"}:
-                    self.__position += 1
-            if self.__next() == "\n":  # skip empty lines in the tokenizer.
+        while True:
+            text = self.__texts[self.__index]
+            kind = LEADING_CHAR_KINDS.get(text[:1])
+            if kind == "":  # End of file
+                self.current = Token("", "", self.__line_number, self.__module)
+                return
+            self.__index += 1
+            value: Union[str, int] = text
+            if kind is None:
+                kind = OP_LOOKUP[text] if len(text) == 2 else text
+            elif kind == "ID":
+                if len(text) == 2 and text.lower() == "as":
+                    kind = "AS"
+            elif kind == "NUM":
+                base = NUMBER_BASES.get(text[1:2], 10)
+                value = int(text if base == 10 else text[0] + text[2:], base)
+            elif kind == "NEWLINE":
+                rest = text[2:] if text.startswith("\r\n") else text[1:]
+                # Lines that are empty or only hold a comment are skipped, but still counted.
+                self.__line_number += rest.count("\n")
+                last_line = rest[rest.rfind("\n") + 1:]
+                indent = INDENT_REGEX.match(last_line)
+                if indent.end() == len(last_line) and self.__texts[self.__index] == "":
+                    continue
                 self.__line_number += 1
-                return self.advance()
-            if self.__next() == "":  # End of file
-                return self.advance()
-            self.__line_number += 1
-            self.current = Token("NEWLINE", indent, self.__line_number, self.__module)
-        elif c == '"':
-            value = ""
-            while True:
-                c = self.__next()
-                self.__position += 1
-                if c in {"\"", ""}:
-                    break
-                if c == '\\':
-                    c = self.__next()
-                    self.__position += 1
-                    if c.lower() == 'x':
-                        upper_nibble = self.__next()
-                        self.__position += 1
-                        lower_nibble = self.__next()
-                        self.__position += 1
-                        try:
-                            value += chr(int(upper_nibble + lower_nibble, 16))
-                        except ValueError:
-                            raise CompileException(self.current, "String format error")
-                    else:
-                        value += c
-                else:
-                    value += c
-            self.current = Token("STRING", value, self.__line_number, self.__module)
-        elif c + self.__next() in self.OP_LOOKUP:
-            c += self.__code[self.__position]
-            self.__position += 1
-            self.current = Token(self.OP_LOOKUP[c], c, self.__line_number, self.__module)
-        else:
-            self.current = Token(c, c, self.__line_number, self.__module)
-
-    def __next(self) -> str:
-        if self.__position < len(self.__code):
-            return self.__code[self.__position]
-        return ""
+                value = len(indent.group(1))
+            elif kind == "STRING":
+                value = text[1:STRING_BODY_REGEX.match(text, 1).end()]
+                if "\\" in value:
+                    value = ESCAPE_REGEX.sub(self.__unescape, value)
+            self.current = Token(kind, value, self.__line_number, self.__module)
+            return
+
+    def __unescape(self, m: re.Match) -> str:
+        if m.group(2) is not None:
+            return m.group(2)
+        try:
+            return chr(int(m.group(1), 16))
+        except ValueError:
+            raise CompileException(self.current, "String format error")
 
     def check(self, kind: str, value: Optional[Union[str, int]] = None) -> bool:
         if self.current.kind == kind and (value is None or self.current.value == value):
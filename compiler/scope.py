@@ -1,4 +1,4 @@
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional, Set, Tuple
 from .astnode import AstNode
 from .parse.function import Function
 from .exception import CompileException
@@ -10,17 +10,26 @@ class Scope:
         self.prefix = prefix
         self.vars: Dict[str, AstNode] = {}
         self.parent = parent
+        # Names looked up in the parent scope, as ("var", name) and ("func", name).
+        self.uses: Set[Tuple[str, str]] = set()
 
     def resolve_var(self, node: AstNode) -> Tuple[str, DataType]:
         if node.token.value in self.vars:
             return f"{self.prefix}_{node.token.value}", self.vars[node.token.value].data_type
         if self.parent:
+            self.uses.add(("var", node.token.value))
             return self.parent.resolve_var(node)
         raise CompileException(node.token, f"Variable not found: {node.token.value}")
 
     def find_function(self, node: AstNode):
+        self.uses.add(("func", node.token.value))
         return self.parent.find_function(node)
 
+    def is_reg(self, node: AstNode) -> bool:
+        if node.token.value in self.vars:
+            return False
+        return self.parent is not None and self.parent.is_reg(node)
+
 
 class TopLevelScope(Scope):
     def __init__(self, prefix: str):
@@ -33,6 +42,9 @@ class TopLevelScope(Scope):
             return node.token.value, self.regs[node.token.value].data_type
         return super().resolve_var(node)
 
+    def is_reg(self, node: AstNode) -> bool:
+        return node.token.value in self.regs
+
     def find_function(self, node: AstNode):
         if node.token.value in self.funcs:
             return self.funcs[node.token.value]
@@ -0,0 +1,70 @@
+from typing import Dict, List, Optional
+import hashlib
+import os
+
+from . import assembler
+from . import objectfile
+from .assembler import Assembler, ObjectFile
+
+
+STDLIB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "stdlib")
+CACHE_PATH = os.path.join(STDLIB_PATH, "__pycache__")
+
+
+def _source_hash(*modules) -> str:
+    h = hashlib.sha1()
+    for module in modules:
+        with open(module.__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Cached objects are only valid for the assembler and object format that produced them.
+ASSEMBLER_HASH = _source_hash(assembler, objectfile)
+_objects: Dict[str, bytes] = {}
+
+
+def stdlib_objects(cache_dir: Optional[str] = CACHE_PATH) -> List[ObjectFile]:
+    """Assembled objects for all stdlib files. Assembling is only done when a file changed, the result is cached
+    by content hash in cache_dir, or only in memory when cache_dir is None. Every call returns fresh objects,
+    as linking modifies them."""
+    result = []
+    for filename in sorted(os.listdir(STDLIB_PATH)):
+        if filename.endswith(".asm"):
+            result.append(objectfile.loads(_load(filename, cache_dir)))
+    return result
+
+
+def _load(filename: str, cache_dir: Optional[str]) -> bytes:
+    with open(os.path.join(STDLIB_PATH, filename), "rb") as f:
+        source = f.read()
+    content_hash = hashlib.sha1(ASSEMBLER_HASH.encode("ascii") + source).hexdigest()
+    if content_hash in _objects:
+        return _objects[content_hash]
+    if cache_dir is None:
+        data = _assemble(filename)
+    else:
+        # Entries are never removed here: other processes sharing the directory may be reading them, and an
+        # entry for a source that changed simply stops being looked up.
+        cache_file = os.path.join(cache_dir, f"{filename}.{content_hash[:16]}.obj")
+        try:
+            with open(cache_file, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = _assemble(filename)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_file = f"{cache_file}.{os.getpid()}.tmp"
+                with open(temp_file, "wb") as f:
+                    f.write(data)
+                os.replace(temp_file, cache_file)
+            except OSError:
+                pass  # Not being able to cache only costs time.
+    _objects[content_hash] = data
+    return data
+
+
+def _assemble(filename: str) -> bytes:
+    asm = Assembler()
+    asm.processFile(STDLIB_PATH, filename, base_address=-2, bank=0)
+    return objectfile.dumps(asm.getObject())
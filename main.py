@@ -1,17 +1,70 @@
+import argparse
+import os
+import time
+
 from compiler.compiler import Compiler
+from compiler.incremental import FunctionCache
+from compiler.listing import write_listing, write_map, write_sym
+from compiler.optimizer.manager import OPT_LEVELS
 
 
-def main(filename):
-    c = Compiler()
+def main(filename, *, output="rom.gb", jobs=1, cache_dir=None, function_cache=None, opt_level="2", verbose=True):
+    c = Compiler(cache_dir=cache_dir, function_cache=function_cache, opt_level=opt_level)
     c.add_file(filename)
-    c.dump_ast()
-    rom, symbols = c.build(print_asm_code=True)
-    open("rom.gb", "wb").write(rom)
+    if verbose:
+        c.dump_ast()
+    rom, symbols = c.build(print_asm_code=verbose, print_bank_usage=verbose, jobs=jobs)
+    open(output, "wb").write(rom)
+    base = os.path.splitext(output)[0]
+    with open(base + ".lst", "wt") as f:
+        write_listing(c.asm, f)
+    with open(base + ".sym", "wt") as f:
+        write_sym(c.asm, f)
+    with open(base + ".map", "wt") as f:
+        write_map(c.asm, f)
+
+
+def watch(filename, *, output="rom.gb", interval=0.1, **kwargs):
+    """Build again every time the source is saved. Functions that did not change are reused from the previous build."""
+    function_cache = FunctionCache()
+    last_mtime = None
+    try:
+        while True:
+            try:
+                mtime = os.stat(filename).st_mtime_ns
+            except OSError:
+                mtime = last_mtime
+            if mtime != last_mtime:
+                last_mtime = mtime
+                function_cache.hits = function_cache.misses = 0
+                start = time.perf_counter()
+                try:
+                    main(filename, output=output, function_cache=function_cache, verbose=False, **kwargs)
+                except Exception as e:
+                    print(f"Build failed: {e}")
+                else:
+                    print(f"Built {output} in {(time.perf_counter() - start) * 1000:.0f}ms, "
+                          f"{function_cache.hits} functions reused, {function_cache.misses} generated")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) > 1:
-        main(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", nargs="?", default="code.sharp")
+    parser.add_argument("-o", "--output", default="rom.gb", help="rom file, the .lst, .sym and .map files are written next to it")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="processes used for code generation, 0 for one per core")
+    parser.add_argument("--cache-dir", help="directory for parsed modules, defaults to __sharpcache__ next to the source")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the source")
+    parser.add_argument("-O", dest="opt_level", choices=list(OPT_LEVELS), default="2",
+                        help="optimization level, -O0 for the fastest build, -Os to favor size over speed")
+    parser.add_argument("-w", "--watch", action="store_true", help="build again every time the source is saved")
+    args = parser.parse_args()
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(os.path.dirname(args.filename), "__sharpcache__")
+    if args.watch:
+        watch(args.filename, output=args.output, jobs=args.jobs or None, cache_dir=cache_dir, opt_level=args.opt_level)
     else:
-        main("code.sharp")
+        main(args.filename, output=args.output, jobs=args.jobs or None, cache_dir=cache_dir, opt_level=args.opt_level)
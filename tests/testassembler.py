@@ -0,0 +1,198 @@
+import unittest
+from compiler.assembler import ASM, Assembler, AssemblerException, Macro, OP, SpaceAllocator, Token, Tokenizer, buildConstantPool
+
+
+class TestAssembler(unittest.TestCase):
+    def test_ld(self):
+        self.assertEqual(ASM("ld a, b"), b'78')
+        self.assertEqual(ASM("ld [hl], a"), b'77')
+        self.assertEqual(ASM("ld c, $12"), b'0e12')
+        self.assertEqual(ASM("ld hl, $1234"), b'213412')
+        self.assertEqual(ASM("ld a, [hl+]"), b'2a')
+        self.assertEqual(ASM("ld a, [c]"), b'f2')
+        self.assertEqual(ASM("ld [$C000], a"), b'ea00c0')
+        self.assertEqual(ASM("ld [$C000], sp"), b'0800c0')
+        self.assertEqual(ASM("ldh a, [$FF44]"), b'f044')
+
+    def test_alu(self):
+        self.assertEqual(ASM("add a, c"), b'81')
+        self.assertEqual(ASM("add hl, de"), b'19')
+        self.assertEqual(ASM("cp a, 144"), b'fe90')
+        self.assertEqual(ASM("xor a"), b'af')
+        self.assertEqual(ASM("and a, $0F"), ASM("and $0F"))
+
+    def test_cb(self):
+        self.assertEqual(ASM("swap a"), b'cb37')
+        self.assertEqual(ASM("bit 7, h"), b'cb7c')
+        self.assertEqual(ASM("set 0, [hl]"), b'cbc6')
+
+    def test_jumps(self):
+        self.assertEqual(ASM("ret"), b'c9')
+        self.assertEqual(ASM("ret nc"), b'd0')
+        self.assertEqual(ASM("jp hl"), b'e9')
+        self.assertEqual(ASM("jp c, $1234"), b'da3412')
+        self.assertEqual(ASM("rst $38"), b'ff')
+        self.assertEqual(ASM("label:\njr nz, label", 0), b'20fe')
+
+    def test_errors(self):
+        for code in ("ld bc, [de]", "bit 8, a", "rst $01", "push sp", "ldi a, [de]"):
+            with self.assertRaises(AssemblerException, msg=code):
+                ASM(code)
+
+    def test_jump_relaxation(self):
+        asm = Assembler()
+        asm.process("""
+top:
+    jpr nz, .a
+.a:
+    jpr z, .b
+.b:
+    ds 122
+    jpr top
+""", base_address=0x0000, bank=0)
+        asm.link()
+        # The backwards jump only gets in range after the two jumps it covers are shortened.
+        self.assertEqual(asm.getRelaxationStats(), [2, 1])
+        data = next(asm.getSections()).data
+        self.assertEqual(len(data), 2 + 2 + 122 + 2)
+        self.assertEqual(data[0:4], b'\x20\x00\x28\x00')
+        self.assertEqual(data[-2:], b'\x18\x80')
+        self.assertEqual(asm.getLabel("top.b"), (4, 0))
+
+    def test_best_fit(self):
+        sa = SpaceAllocator()
+        sa.allocate_fixed(0, 0x3000, 0x10)
+        # The exact fit at the end of the bank is preferred, so the large region stays available.
+        self.assertEqual(sa.allocate(0xFF0), (0, 0x3010))
+        self.assertEqual(sa.allocate(0x3000), (0, 0x0000))
+        self.assertEqual(sa.allocate(0x10), (1, 0x4000))
+        self.assertEqual(sa.getBankUsage(), [(0, 0x4000, 0, 3), (1, 0x10, 0x3FF0, 1)])
+
+    def test_expression_nodes(self):
+        left = Token('NUMBER', 1, 1)
+        folded = OP.make('+', left, Token('NUMBER', 2, 1))
+        self.assertEqual(folded.value, 3)
+        self.assertEqual(left.value, 1)
+        # Structurally equal expressions share one node.
+        a = OP.make('+', Token('ID', 'LABEL', 1), Token('NUMBER', 1, 1))
+        b = OP.make('+', Token('ID', 'LABEL', 2), Token('NUMBER', 1, 2))
+        self.assertIs(a, b)
+
+    def test_shared_expression(self):
+        asm = Assembler()
+        asm.process("ld a, [label+1]\nld [label+1], a\nlabel:\ndb 0, 0", base_address=0x0100, bank=0)
+        asm.link()
+        self.assertEqual(bytes(next(asm.getSections()).data), b'\xfa\x07\x01\xea\x07\x01\x00\x00')
+
+    def test_macro(self):
+        code = """
+#MACRO load
+    ld \\1, \\2
+#END
+#MACRO label
+x ## \\1:
+    jp x ## \\1
+#END
+    load a, b
+    load c, $12
+    load a, b
+    label 1
+"""
+        self.assertEqual(ASM(code, 0x0000), b'780e1278c30400')
+        with self.assertRaises(AssemblerException):
+            ASM("#MACRO load\nld \\1, \\2\n#END\nload a")
+
+    def test_macro_line_numbers(self):
+        a = Assembler()
+        a.process("#MACRO twice\n \\1\n \\1\n#END\n twice nop\n halt\n twice nop\n", base_address=0, bank=0)
+        self.assertEqual([line for _, _, _, line, _, _ in a.getListing()], [5, 5, 6, 7, 7])
+
+    def test_macro_cache(self):
+        macro = Macro(Token('ID', 'LOAD', 1), list(Tokenizer.tokenize(" ld \\1, \\2\n")))
+        first = macro.expand(Token('ID', 'LOAD', 3), [[Token('ID', 'A', 3)], [Token('NUMBER', 1, 3)]])
+        second = macro.expand(Token('ID', 'LOAD', 8), [[Token('ID', 'A', 8)], [Token('NUMBER', 1, 8)]])
+        self.assertEqual(macro.hits, 1)
+        self.assertEqual([(token.kind, token.value) for token in second], [(token.kind, token.value) for token in first])
+        self.assertEqual({token.line_nr for token in first}, {3})
+        self.assertEqual({token.line_nr for token in second}, {8})
+
+    def test_tokenize(self):
+        tokens = Tokenizer.tokenize('label: ld a, [$C000] ; comment\n  db x"ab", `0123 ; end')
+        self.assertEqual([(token.kind, token.value, token.line_nr) for token in (tokens[n] for n in range(len(tokens)))], [
+            ('ID', 'LABEL', 1), ('LABEL', ':', 1), ('ID', 'LD', 1), ('ID', 'A', 1), ('OP', ',', 1),
+            ('REFOPEN', '[', 1), ('NUMBER', 0xC000, 1), ('REFCLOSE', ']', 1), ('NEWLINE', '\n', 1),
+            ('ID', 'DB', 2), ('STRING', 'x"ab"', 2), ('OP', ',', 2), ('NUMBER', 0x3050, 2), ('NEWLINE', '\n', 2),
+        ])
+        with self.assertRaises(AssemblerException):
+            Tokenizer.tokenize("ld a, !")
+
+    def test_constant_pool(self):
+        data, offsets = buildConstantPool([b'World\x00', b'\x01\x02', b'Hello World\x00', b'World\x00'])
+        self.assertEqual(data, b'\x01\x02Hello World\x00')
+        self.assertEqual(offsets, {b'World\x00': 8, b'\x01\x02': 0, b'Hello World\x00': 2})
+
+    def test_inline_data_pool(self):
+        asm = Assembler()
+        asm.process('dw i"Hello World", i"World", INLINE(1, 2)', base_address=0x4000, bank=1)
+        asm.process('dw INLINE(1, 2)', base_address=0x4000, bank=2)
+        asm.link()
+        sections = [(section.bank, section.base_address, bytes(section.data)) for section in asm.getSections()]
+        # Data used from both banks goes to bank 0, the strings only used in bank 1 stay there and share storage.
+        self.assertEqual(sections, [
+            (1, 0x4000, b'\x06\x40\x0c\x40\x00\x00'),
+            (2, 0x4000, b'\x00\x00'),
+            (0, 0x0000, b'\x01\x02'),
+            (1, 0x4006, b'Hello World\x00'),
+        ])
+
+    def test_strip_sections(self):
+        asm = Assembler()
+        asm.process("start:\n call used\n ret", base_address=-2, bank=0)
+        asm.process("used:\n ld hl, data\n ret", base_address=-2, bank=0)
+        asm.process("data:\n db 1, 2, 3", base_address=-2, bank=0)
+        asm.process("unused:\n jp used", base_address=-2, bank=0)
+        asm.link(keep=["start"])
+        self.assertEqual(asm.getStripStats(), (1, 3))
+        self.assertEqual(sorted(label for label, address, bank in asm.getLabels()), ["DATA", "START", "USED"])
+        with self.assertRaises(AssemblerException):
+            Assembler().link(keep=["missing"])
+
+    def test_peephole(self):
+        asm = Assembler()
+        asm.process("var:\n ds 1", base_address=0xC000, bank=0)
+        asm.process("""
+start:
+    ld [var], a
+    ld a, [var]
+    ld b, a
+    ld a, b
+    ld a, 0
+    cp b
+    jp z, hop
+    jp done
+hop:
+    jp done
+done:
+    call func
+    ret
+func:
+    ld a, 0
+    ret
+""", base_address=-2, bank=0)
+        asm.link(keep=["start"], optimize=True)
+        ram, code = asm.getSections()
+        self.assertEqual(bytes(code.data), b'\xea\x00\xc0\x47\xaf\xb8\x3e\x00\xc9')
+        stats = asm.getPeepholeStats()
+        self.assertEqual(stats["redundant load"], 2)
+        self.assertEqual(stats["call ret to jp"], 1)
+        self.assertEqual(stats["ld a 0 to xor a"], 1)
+        self.assertGreater(stats["jump threading"], 0)
+        self.assertGreater(stats["jump to next"], 0)
+
+    def test_peephole_keeps_io_and_labels(self):
+        code = "ldh [$FF44], a\nldh a, [$FF44]\nld [$C000], a\nlabel:\nld a, [$C000]\nld a, 0\njr z, label\n"
+        asm = Assembler()
+        asm.process(code, base_address=-2, bank=0)
+        asm.link(optimize=True)
+        self.assertEqual(bytes(next(asm.getSections()).data), b'\xe0\x44\xf0\x44\xea\x00\xc0\xfa\x00\xc0\x3e\x00\x28\xf9')
+        self.assertEqual(sum(asm.getPeepholeStats().values()), 0)
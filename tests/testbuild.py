@@ -0,0 +1,26 @@
+import unittest
+from compiler.exception import CompileException
+from .util import compiler_with
+
+
+PROGRAM = "var x = 0\nvar y = 0\n\nfn main\n" + "".join(f"    f{n}({n})\n" for n in range(8)) + "".join(f"""
+fn f{n} a
+    x = x + a
+    if x > 10
+        y = y + 1
+""" for n in range(8))
+
+
+class TestBuild(unittest.TestCase):
+    def build(self, code, jobs):
+        return compiler_with(code).build(jobs=jobs)
+
+    def test_parallel_is_deterministic(self):
+        rom, symbols = self.build(PROGRAM, 1)
+        parallel_rom, parallel_symbols = self.build(PROGRAM, 2)
+        self.assertEqual(rom, parallel_rom)
+        self.assertEqual(symbols, parallel_symbols)
+
+    def test_parallel_error(self):
+        with self.assertRaises(CompileException):
+            self.build("fn main\n    x = 1\nfn other\n    pass\n", 2)
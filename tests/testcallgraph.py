@@ -0,0 +1,118 @@
+import unittest
+from compiler.exception import CompileException
+from .util import compile_and_run, compiler_with
+
+
+def symbols(code):
+    return compiler_with(code).build()[1]
+
+
+class TestCallGraph(unittest.TestCase):
+    def test_siblings_share_locals(self):
+        code = """
+var x = 0
+var y = 0
+
+fn main
+    f1(10)
+    f2(20)
+
+fn f1 a
+    var t = a + 1
+    x = t
+
+fn f2 b
+    y = b + 2
+"""
+        res = compile_and_run(code)
+        self.assertEqual((res.x, res.y), (11, 22))
+        sym = symbols(code)
+        self.assertEqual(sym["_LOCAL_F1_A"], sym["_LOCAL_F2_B"])
+        self.assertEqual(sym["_LOCAL_F1_T"][0], sym["_LOCAL_F1_A"][0] + 1)
+
+    def test_callee_after_caller(self):
+        code = """
+var x = 0
+
+fn main
+    x = f1(3)
+
+fn f1 a > u8
+    return f2(a) + a
+
+fn f2 b > u8
+    return b + b
+"""
+        self.assertEqual(compile_and_run(code).x, 9)
+        sym = symbols(code)
+        self.assertNotEqual(sym["_LOCAL_F1_A"], sym["_LOCAL_F2_B"])
+
+    def test_call_in_arguments(self):
+        # f2 runs after the first argument of f1 is stored, so it cannot use the same storage.
+        code = """
+var x = 0
+
+fn main
+    x = f1(1, f2(2))
+
+fn f1 a b > u8
+    return a + b
+
+fn f2 c > u8
+    return c + 10
+"""
+        self.assertEqual(compile_and_run(code).x, 13)
+        sym = symbols(code)
+        self.assertNotIn(sym["_LOCAL_F2_C"], (sym["_LOCAL_F1_A"], sym["_LOCAL_F1_B"]))
+
+    def test_same_function_in_arguments(self):
+        with self.assertRaises(CompileException) as context:
+            symbols("""
+var x = 0
+
+fn main
+    x = f(1, f(2, 3))
+
+fn f a b > u8
+    return a - b
+""")
+        self.assertEqual(context.exception.message, "Call to f in its own arguments is not supported")
+        with self.assertRaises(CompileException) as context:
+            symbols("""
+var x = 0
+
+fn main
+    x = f(1, g(2))
+
+fn f a b > u8
+    return a - b
+
+fn g c > u8
+    return f(c, 1)
+""")
+        self.assertEqual(context.exception.message, "Cannot call g in the arguments of f, it calls f")
+        # The inner call is done before any argument of the outer call is stored.
+        code = """
+var x = 0
+
+fn main
+    x = f(f(2, 3), 1)
+
+fn f a b > u8
+    return a - b
+"""
+        self.assertEqual(compile_and_run(code).x, 254)
+
+    def test_recursion(self):
+        with self.assertRaises(CompileException) as context:
+            symbols("""
+fn main
+    f1()
+
+fn f1
+    f2()
+
+fn f2
+    f1()
+""")
+        self.assertEqual(context.exception.message, "Recursion is not supported: f1 -> f2 -> f1")
@@ -0,0 +1,53 @@
+import unittest
+from compiler.datatype import BASE_TYPES
+from compiler.optimizer.constant import constant_fold
+from compiler.parse.expression import expression
+from compiler.scanner import Scanner
+from .util import compile_and_run
+
+
+def fold(code, type_name="u8"):
+    return repr(constant_fold(expression(Scanner("code", code)), BASE_TYPES[type_name]))
+
+
+class TestConstant(unittest.TestCase):
+    def test_width(self):
+        self.assertEqual(fold("(200 + 100) >> 1"), "NUM<22>")
+        self.assertEqual(fold("(200 + 100) >> 1", "u16"), "NUM<150>")
+        self.assertEqual(fold("0 - 1 > 2"), "NUM<1>")
+        self.assertEqual(fold("300 as u8"), "NUM<44>")
+
+    def test_operators(self):
+        self.assertEqual(fold("(6 & 3) | (5 ^ 1) | 7 % 4"), "NUM<7>")
+        self.assertEqual(fold("(3 < 5) + (3 >= 5) + (2 != 2) + !0"), "NUM<2>")
+
+    def test_identities(self):
+        self.assertEqual(fold("x * 1 + 0"), "ID<x>")
+        self.assertEqual(fold("x & 0"), "NUM<0>")
+        self.assertEqual(fold("x | 0xFF"), "NUM<255>")
+        self.assertEqual(fold("x | 0xFF", "u16"), "|(ID<x>, NUM<255>)")
+        self.assertEqual(fold("x << 0"), "ID<x>")
+        self.assertEqual(fold("f() * 0"), "*(CALL(ID<f>,), NUM<0>)")
+
+    def test_reassociate(self):
+        self.assertEqual(fold("1 + x + 2"), "+(ID<x>, NUM<3>)")
+        self.assertEqual(fold("(x - 1) + 3"), "+(ID<x>, NUM<2>)")
+        self.assertEqual(fold("x + 254"), "-(ID<x>, NUM<2>)")
+        self.assertEqual(fold("5 - (x + 1)"), "-(NUM<4>, ID<x>)")
+        self.assertEqual(fold("x & 0x0F & 0xF0 | y"), "ID<y>")
+        self.assertEqual(fold("x << 1 << 2"), "SHIFT(ID<x>, NUM<3>)")
+
+    def test_run(self):
+        res = compile_and_run("""
+var x = 0
+var y = 3
+var z: u16 = 0
+
+fn main
+    x = (200 + 100) >> 1
+    y = y * 1 + 0
+    z = (200 + 100) >> 1
+""")
+        self.assertEqual(res.x, 22)
+        self.assertEqual(res.y, 3)
+        self.assertEqual(res.z, 150)
@@ -0,0 +1,117 @@
+import unittest
+from compiler.optimizer.cfg import ControlFlowGraph, UNKNOWN
+from compiler.pseudo import OP_COPY, OP_LOAD, OP_LOAD_VALUE, OP_STORE
+from .util import build_main, compile_and_run
+
+
+def ops(code, opt_level="2"):
+    return build_main(code, opt_level)[0]
+
+
+def stores(code, opt_level="2"):
+    return [op.args[1] for op in ops(code, opt_level) if op.kind == OP_STORE]
+
+
+class TestDataflow(unittest.TestCase):
+    def test_cfg(self):
+        code = """
+var x = 0
+
+fn main
+    var t = 1
+    while x < 5
+        x = x + t
+    t = 2
+"""
+        graph = ControlFlowGraph(ops(code, "0"))
+        self.assertEqual(len(graph.blocks), 4)
+        loop = graph.blocks[1]
+        self.assertEqual(set(loop.successors), {graph.blocks[2], graph.blocks[3]})
+        self.assertIn(loop, graph.blocks[2].successors)
+        live = graph.liveness({"local_main_t"})
+        self.assertEqual([live[idx] for idx, op in enumerate(graph.ops) if op.kind == OP_STORE and op.args[1] == "local_main_t"],
+                         [{"local_main_t", "global_var_x"}, {"global_var_x"}])
+        reaching = graph.reaching_definitions({"local_main_t"})
+        load = next(idx for idx, op in enumerate(graph.ops) if op.kind == OP_LOAD and op.args[1] == "global_var_x")
+        self.assertEqual(len(reaching[load]["global_var_x"]), 2)
+        self.assertIn(UNKNOWN, reaching[load]["global_var_x"])
+
+    def test_copy_propagation(self):
+        code = """
+var x = 3
+var y = 0
+var z = 0
+
+fn main
+    var t = 5
+    var u = 0
+    u = x
+    y = u + t
+    z = u
+"""
+        self.assertEqual(stores(code), ["global_var_y", "global_var_z"])
+        self.assertIn(5, [op.args[1] for op in ops(code) if op.kind == OP_LOAD_VALUE])
+        res = compile_and_run(code)
+        self.assertEqual((res.y, res.z), (8, 3))
+
+    def test_dead_store(self):
+        code = """
+var x = 1
+
+fn main
+    var t = 0
+    x = 2
+    t = x + 1
+    x = t
+    f()
+    x = 4
+    x = 5
+
+fn f
+    pass
+"""
+        self.assertEqual(stores(code), ["local_main_t", "global_var_x", "global_var_x"])
+        self.assertEqual(compile_and_run(code).x, 5)
+
+    def test_reg_is_volatile(self):
+        code = """
+reg rSCX = 0xFF43
+var z = 0
+
+fn main
+    rSCX = 1
+    rSCX = 2
+    z = (rSCX + 1) + (rSCX + 1)
+"""
+        self.assertEqual(stores(code), ["rSCX", "rSCX", "global_var_z"])
+        self.assertEqual(len([op for op in ops(code) if op.kind == OP_LOAD and op.args[1] == "rSCX"]), 2)
+
+    def test_common_subexpression(self):
+        code = """
+var x = 3
+var y = 4
+var a = 0
+var b = 0
+
+fn main
+    a = (x + y) & 15
+    b = (x + y) | 64
+    x = 1
+    a = a + (x + y)
+"""
+        result = ops(code)
+        self.assertEqual(len([op for op in result if op.kind == OP_COPY]), 1)
+        self.assertEqual(len([op for op in result if op.kind == OP_LOAD and op.args[1] == "global_var_x"]), 1)
+        res = compile_and_run(code)
+        self.assertEqual((res.a, res.b), (12, 71))
+
+    def test_common_cast(self):
+        code = """
+var g0 = 200
+var h0: u16 = 0
+
+fn main
+    h0 = (g0 as u16) + (g0 as u16)
+"""
+        self.assertFalse([op for op in ops(code) if op.kind == OP_COPY])
+        self.assertEqual(compile_and_run(code).h0, 400)
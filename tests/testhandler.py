@@ -0,0 +1,35 @@
+import unittest
+import compiler.codegen.generator  # Registers the handlers
+from compiler.codegen.handler import match_handlers
+from compiler.datatype import DEFAULT_TYPE
+from compiler.pseudo import PseudoOp, OP_ARITHMETIC, OP_LOAD_VALUE, OP_RETURN, OP_STORE
+from .util import compiler_with
+
+
+class TestHandler(unittest.TestCase):
+    def test_longest_match_first(self):
+        ops = [PseudoOp(OP_LOAD_VALUE, 1, 5, data_type=DEFAULT_TYPE), PseudoOp(OP_ARITHMETIC, "+", 2, 1, data_type=DEFAULT_TYPE)]
+        self.assertEqual([h.name for h in match_handlers(ops, 0)], ["LOADV ARITHETIC (8)", "LOADV (8)"])
+
+    def test_only_matching_handlers(self):
+        ops = [PseudoOp(OP_LOAD_VALUE, 1, 5, data_type=DEFAULT_TYPE), PseudoOp(OP_STORE, 1, "global_var_x", data_type=DEFAULT_TYPE)]
+        self.assertEqual([h.name for h in match_handlers(ops, 0)], ["LOADV (8)"])
+        ops = [PseudoOp(OP_LOAD_VALUE, 1, 5, data_type=DEFAULT_TYPE)]
+        self.assertEqual([h.name for h in match_handlers(ops, 0)], ["LOADV (8)"])
+        self.assertEqual([h.name for h in match_handlers([PseudoOp(OP_RETURN)], 0)], ["RETURN (0)"])
+
+    def test_stats(self):
+        c = compiler_with("""
+var w: u16 = 1000
+var v: u16 = 0
+
+fn main
+    v = w + 300
+    w = w - 1
+""", opt_level="0")
+        c.build()
+        # The constant is added with add HL instead of through A, the handler for the op alone generates it.
+        self.assertEqual(c.handler_stats.tried["LOADV ARITHETIC (16)"], 2)
+        self.assertEqual(c.handler_stats.fired["LOADV ARITHETIC (16)"], 1)
+        self.assertEqual(c.handler_stats.fired["LOADV (16)"], 1)
+        self.assertEqual(c.handler_stats.fired["STORE (16)"], 2)
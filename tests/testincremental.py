@@ -0,0 +1,63 @@
+import unittest
+from compiler.incremental import FunctionCache
+from .util import compiler_with
+
+CODE = """
+const STEP = 2
+var a: u8 = 1
+var b: u8 = 2
+var c: u8 = 0
+
+fn main
+    a = add(a, b)
+    b = twice()
+    reset()
+
+fn add x y > u8
+    return x + y + STEP
+
+fn twice > u8
+    return b + b
+
+fn reset
+    c = 5
+"""
+
+
+def build(code, function_cache=None):
+    return compiler_with(code, function_cache=function_cache).build()[0]
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.cache = FunctionCache()
+        build(CODE, self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 4))
+
+    def rebuild(self, code):
+        self.cache.hits = self.cache.misses = 0
+        rom = build(code, self.cache)
+        self.assertEqual(rom, build(code))
+        return self.cache.hits, self.cache.misses
+
+    def test_unchanged(self):
+        self.assertEqual(self.rebuild(CODE), (4, 0))
+        # Moving functions to other lines does not change their code.
+        self.assertEqual(self.rebuild("; header\n\n" + CODE.replace("fn twice", "\n\nfn twice")), (4, 0))
+
+    def test_function_changed(self):
+        self.assertEqual(self.rebuild(CODE.replace("return b + b", "return b - b")), (3, 1))
+
+    def test_const_changed(self):
+        # Consts are folded into the functions that use them.
+        self.assertEqual(self.rebuild(CODE.replace("STEP = 2", "STEP = 3")), (3, 1))
+
+    def test_global_changed(self):
+        # Only the initial value changes, that is not part of any function.
+        self.assertEqual(self.rebuild(CODE.replace("var b: u8 = 2", "var b: u8 = 3")), (4, 0))
+        # The type of a global changes the code of every function that reads or writes it.
+        self.assertEqual(self.rebuild(CODE.replace("var c: u8 = 0", "var c: u16 = 0")), (3, 1))
+
+    def test_signature_changed(self):
+        # Callers depend on the parameters of the functions they call, not on their body.
+        self.assertEqual(self.rebuild(CODE.replace("fn add x y > u8", "fn add x z > u8").replace("x + y", "x + z")), (2, 2))
@@ -0,0 +1,34 @@
+import unittest
+from compiler import objectfile
+from compiler.linker import assemble, link_objects
+
+
+class TestLinker(unittest.TestCase):
+    def test_roundtrip(self):
+        obj = assemble("""
+VALUE := -5
+start:
+    ld hl, data + 2
+    jpr nz, start
+    call BANK(data)
+data:
+    db HIGH(data), 1
+""", base_address=-2, bank=1)
+        copy = objectfile.loads(objectfile.dumps(obj))
+        self.assertEqual(copy.labels, obj.labels)
+        self.assertEqual(copy.constants, {"VALUE": -5})
+        self.assertEqual(len(copy.sections), len(obj.sections))
+        for a, b in zip(obj.sections, copy.sections):
+            self.assertEqual((a.base_address, a.bank, a.data, a.jpr_list), (b.base_address, b.bank, b.data, b.jpr_list))
+            self.assertEqual((a.instructions, a.instruction_lines), (b.instructions, b.instruction_lines))
+            self.assertEqual({o: (t, e.key) for o, (t, e) in a.link.items()}, {o: (t, e.key) for o, (t, e) in b.link.items()})
+
+    def test_link_separate_objects(self):
+        code = assemble("main:\n ld a, [_var]\n ld [_reg], a\n jp main", base_address=0x0000, bank=0)
+        ram = assemble("_reg := $FF40\n_var:\n ds 1", base_address=0xC000, bank=0)
+        asm = link_objects([objectfile.loads(objectfile.dumps(o)) for o in (code, ram)])
+        self.assertEqual(bytes(next(asm.getSections()).data), b'\xfa\x00\xc0\xea\x40\xff\xc3\x00\x00')
+
+    def test_not_an_object(self):
+        with self.assertRaises(objectfile.ObjectFileException):
+            objectfile.loads(b"GBS")
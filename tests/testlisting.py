@@ -0,0 +1,42 @@
+import io
+import unittest
+from compiler.assembler import Assembler
+from compiler.listing import write_listing, write_map, write_sym
+
+
+class TestListing(unittest.TestCase):
+    def setUp(self):
+        self.asm = Assembler()
+        self.asm.process("var:\n ds 2", base_address=0xC000, bank=0)
+        self.asm.process("""
+start:
+    ld hl, var + 1
+    dec [hl]
+    jr nz, start
+    db 1, 2
+    ret
+""", base_address=0x0150, bank=0)
+        self.asm.link()
+
+    def test_listing(self):
+        self.assertEqual(self.asm.getListing(), [
+            (0, 0x0150, b'\x21\x01\xc0', 3, (3, 3), "ld hl, VAR + 1"),
+            (0, 0x0153, b'\x35', 4, (3, 3), "dec [hl]"),
+            (0, 0x0154, b'\x20\xfa', 5, (3, 2), "jr nz, START"),
+            (0, 0x0158, b'\xc9', 7, (4, 4), "ret"),
+        ])
+        f = io.StringIO()
+        write_listing(self.asm, f)
+        self.assertEqual(f.getvalue().splitlines()[:2], [
+            "START:",
+            "  00:0150  21 01 c0     3  ld hl, VAR + 1                   ; line 3",
+        ])
+        self.assertIn("  00:0154  20 fa      3/2  jr nz, START", f.getvalue())
+
+    def test_sym_and_map(self):
+        f = io.StringIO()
+        write_sym(self.asm, f)
+        self.assertEqual(f.getvalue(), "; Symbols\n00:0150 START\n00:c000 VAR\n")
+        f = io.StringIO()
+        write_map(self.asm, f)
+        self.assertEqual(f.getvalue(), "Bank 00: 9 bytes used, 16375 bytes free\n  0150-0158      9  START\n  C000-C001      2  VAR\n")
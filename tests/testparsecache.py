@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from compiler import parsecache
+from compiler.parse.parser import parse
+from .util import compiler_with
+
+CODE = """
+const SIZE = 4 * 2
+reg LCDC = 0xFF40
+var total: u16 = SIZE << 1
+
+fn sum values: u16* count > u16
+    var result: u16 = 0
+    while count > 0
+        count -= 1
+        if count == 7
+            pass
+        elif count & 1
+            result = result + count as u8
+        else
+            result = result - 1
+    return result
+
+fn main
+    LCDC = 0
+    total = sum(&total, 3)
+    s = "x\\x41"
+"""
+
+BUILD_CODE = """
+var a: u8 = 6 + 4
+var b = 2
+
+fn main
+    a = a - b
+    a = test(1, 2)
+
+fn test x y > u8
+    b = x + -y
+    return 5
+"""
+
+
+def tree(node):
+    token = node.token and (node.token.kind, node.token.value, node.token.line_number, node.token.module)
+    return node.kind, token, repr(node.data_type), [tree(param) for param in node.params]
+
+
+def dump(module):
+    return [tree(node) for node in module.vars + module.consts + module.regs] + [
+        (tree(func), [tree(p) for p in func.parameters], repr(func.return_type), [tree(node) for node in func.block],
+         [var.token.value for var in func.vars]) for func in module.funcs]
+
+
+class TestParseCache(unittest.TestCase):
+    def test_roundtrip(self):
+        module = parse("code", CODE)
+        data = parsecache.dumps(module)
+        loaded = parsecache.loads(data)
+        self.assertEqual((dump(loaded)), (dump(module)))
+        self.assertEqual(parsecache.dumps(loaded), data)
+        token = loaded.funcs[0].block[1].token
+        self.assertEqual((token.kind, token.value, token.line_number, token.module), ("ID", "while", 8, "code"))
+        # Pointer types keep their identity, the code generator compares them with `is`.
+        self.assertIs(loaded.funcs[0].parameters[0].data_type, module.funcs[0].parameters[0].data_type)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = parsecache.ParseCache(directory)
+            cache.parse("code", CODE)
+            module = cache.parse("code", CODE)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual((dump(module)), (dump(parse("code", CODE))))
+            cache.parse("other", CODE)
+            cache.parse("code", CODE + "\n")
+            self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+            with open(cache.filename("code", CODE), "wb") as f:
+                f.write(b"GBSM\x01\x78\x01")
+            cache.parse("code", CODE)
+            self.assertEqual((cache.hits, cache.misses), (1, 4))
+            self.assertEqual(len(os.listdir(directory)), 3)
+
+    def test_build_from_cache(self):
+        roms = []
+        with tempfile.TemporaryDirectory() as directory:
+            for _ in range(2):
+                c = compiler_with(BUILD_CODE, cache_dir=directory)
+                roms.append(c.build()[0])
+            self.assertEqual(c.parse_cache.hits, 1)
+        self.assertEqual(roms[0], roms[1])
@@ -0,0 +1,69 @@
+import unittest
+from compiler.compiler import Compiler, build_function
+from compiler.optimizer.manager import OPT_LEVELS
+from compiler.pseudo import OP_JUMP_ZERO, OP_RETURN
+from .util import build_main, compile_and_run, compiler_with
+
+
+LOOP = """
+var x = 0
+var y = 3
+
+fn main
+    while 1
+        x = x + (y | 0) + 0
+        if x > 10
+            return
+"""
+
+
+def build(code, opt_level):
+    c = compiler_with(code, opt_level=opt_level)
+    rom, symbols = c.build()
+    return c, rom
+
+
+class TestPasses(unittest.TestCase):
+    def test_levels(self):
+        for level in OPT_LEVELS:
+            res = compile_and_run(LOOP, opt_level=level)
+            self.assertEqual(res.x, 12)
+
+    def test_unknown_level(self):
+        with self.assertRaises(ValueError):
+            Compiler(opt_level="3")
+
+    def test_stats(self):
+        for level, names in OPT_LEVELS.items():
+            c, rom = build(LOOP, level)
+            self.assertEqual(list(c.pass_stats), names)
+        stats = c.pass_stats["simplify"]
+        self.assertEqual(stats.functions, 1)
+        self.assertLess(stats.size_after, stats.size_before)
+        self.assertGreaterEqual(stats.seconds, 0)
+
+    def test_constant_loop(self):
+        c = compiler_with(LOOP)
+        kinds = [op.kind for op in build_function(c.main_scope, "main", "2")[0]]
+        self.assertNotIn(OP_JUMP_ZERO, kinds[:2])
+        self.assertEqual(kinds.count(OP_RETURN), 1)
+        kinds = [op.kind for op in build_function(c.main_scope, "main", "0")[0]]
+        self.assertEqual(kinds.count(OP_RETURN), 2)
+
+    def test_favor_size(self):
+        code = """
+var w: u16 = 1000
+var v: u16 = 10
+
+fn main
+    w = w + 3
+    v = v - 6
+"""
+        fast = build_main(code, "2")[1].split("\n")
+        small = build_main(code, "s")[1].split("\n")
+        self.assertIn("add HL, BC", fast)
+        self.assertEqual(small.count("inc HL"), 3)
+        self.assertEqual(small.count("dec HL"), 6)
+        for level in "2s":
+            res = compile_and_run(code, opt_level=level)
+            self.assertEqual((res.w, res.v), (1003, 4))
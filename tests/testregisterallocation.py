@@ -0,0 +1,117 @@
+import unittest
+from .util import build_main, compile_and_run
+
+
+def asm(code, opt_level="0"):
+    return [line for line in build_main(code, opt_level)[1].split("\n") if line and not line.startswith(";")]
+
+
+class TestRegisterAllocation(unittest.TestCase):
+    def test_deep_expression(self):
+        code = """
+var x = 3
+var y = 200
+var z = 7
+var r = 0
+
+fn main
+    var t = 1
+    r = x - (y ^ (z + (t - (x | (y - (z + (t ^ (x - (y & z)))))))))
+"""
+        for opt_level in "02":
+            self.assertEqual(compile_and_run(code, opt_level=opt_level).r, 130)
+
+    def test_deep_expression16(self):
+        code = """
+var p: u16 = 0x1234
+var q: u16 = 0xFF01
+var r: u16 = 0x00F0
+var w: u16 = 0
+
+fn main
+    w = p - (q ^ (r + (p | (q - (r ^ (p & q))))))
+"""
+        for opt_level in "02":
+            self.assertEqual(compile_and_run(code, opt_level=opt_level).w, 0x1210)
+
+    def test_call_in_deep_expression(self):
+        code = """
+var x = 3
+var y = 200
+var r = 0
+
+fn main
+    r = x - (y ^ (x + (y - (x | (y - (x + (y ^ f(x - (y & x)))))))))
+
+fn f a > u8
+    return a + 1
+"""
+        for opt_level in "02":
+            self.assertEqual(compile_and_run(code, opt_level=opt_level).r, 235)
+
+    def test_cast_with_all_registers_in_use(self):
+        code = """
+var y = 200
+var z = 7
+var p: u16 = 4660
+var r = 0
+
+fn main
+    var t = 1
+    r = 8 - (((z + 250) + ((t + ((p - (y as u16)) as u8)) | (z + 249))) ^ (z + 102))
+"""
+        for opt_level in "02":
+            self.assertEqual(compile_and_run(code, opt_level=opt_level).r, 5)
+
+    def test_load_from_overwritten_mirror16(self):
+        code = """
+var h0: u16 = 41035
+var h1: u16 = 25560
+
+fn main
+    h1 = h1
+    h1 = (h0 ^ 4660) - (h1 | 684)
+"""
+        for opt_level in "012":
+            self.assertEqual(compile_and_run(code, opt_level=opt_level).h1, 20099)
+        code = """
+var h0: u16 = 0
+
+fn main
+    h0 = 0
+    h0 = 3 + (h0 - 65535)
+"""
+        for opt_level in "012":
+            self.assertEqual(compile_and_run(code, opt_level=opt_level).h0, 4)
+
+    def test_spill_after_hram_reg(self):
+        code = """
+reg hw = 0xFF80
+var x = 3
+var y = 200
+var z = 7
+var r = 0
+var s = 0
+
+fn main
+    hw = 9
+    r = x - (y ^ (z + (x - (x | (y - (z + (x ^ (x - (y & z)))))))))
+    s = hw
+"""
+        self.assertTrue(any(line.startswith("ldh [_spill_main_") for line in asm(code, "2")))
+        res = compile_and_run(code)
+        self.assertEqual((res.r, res.s), (116, 9))
+
+    def test_constant_is_not_spilled(self):
+        lines = asm("""
+var x = 3
+var y = 200
+var r = 0
+
+fn main
+    r = 100 - (x ^ (y + (x - (y | (x - (y + (x ^ (y - (x & y)))))))))
+""")
+        self.assertTrue(any(line.startswith("ldh [_spill_main_") for line in lines))
+        # The constant is loaded again instead of being stored in a spill slot.
+        self.assertEqual(lines[1:3], ["ld A, 100", "ld B, A"])
+        self.assertIn("ld B, 100", lines)
@@ -0,0 +1,61 @@
+import unittest
+from .util import build_main, compile_and_run
+
+
+def asm(code):
+    return [line for line in build_main(code, "0")[1].split("\n") if line and not line.startswith(";")]
+
+
+class TestRegisterCache(unittest.TestCase):
+    def test_reuse_stored_value(self):
+        lines = asm("""
+var x = 1
+var y = 0
+
+fn main
+    x = x + 1
+    y = x + 2
+""")
+        self.assertEqual(lines.count("ld A, [_global_var_x]"), 1)
+
+    def test_reuse_stored_value16(self):
+        lines = asm("""
+var w: u16 = 0
+
+fn main
+    w = w + 1
+    w = w + 2
+""")
+        self.assertEqual(lines.count("ld A, [_global_var_w]"), 1)
+
+    def test_reg_is_loaded(self):
+        lines = asm("""
+reg rSCY = 0xFF42
+var y = 0
+
+fn main
+    rSCY = 1
+    y = rSCY
+""")
+        self.assertEqual(lines.count("ld A, [_rSCY]"), 1)
+
+    def test_invalidated(self):
+        code = """
+var x = 0
+var y = 0
+
+fn main
+    x = 5
+    f()
+    y = x
+    while x
+        x = x - 1
+    y = y + x
+
+fn f
+    x = 7
+"""
+        lines = asm(code)
+        self.assertEqual(lines.count("ld A, [_global_var_x]"), 3)
+        res = compile_and_run(code, opt_level="0")
+        self.assertEqual((res.x, res.y), (0, 7))
@@ -0,0 +1,38 @@
+import unittest
+from compiler.exception import CompileException
+from compiler.scanner import Scanner
+
+
+def scan(code):
+    scanner = Scanner("test", code)
+    result = []
+    while scanner:
+        result.append((scanner.current.kind, scanner.current.value, scanner.current.line_number))
+        scanner.advance()
+    return result
+
+
+class TestScanner(unittest.TestCase):
+    def test_tokens(self):
+        self.assertEqual(scan("var x_1: u16 = 0x1F + 0b101 * 12 as u8"), [
+            ("ID", "var", 1), ("ID", "x_1", 1), (":", ":", 1), ("ID", "u16", 1), ("=", "=", 1), ("NUM", 0x1F, 1),
+            ("+", "+", 1), ("NUM", 5, 1), ("*", "*", 1), ("NUM", 12, 1), ("AS", "as", 1), ("ID", "u8", 1),
+        ])
+        self.assertEqual(scan("a <= b << c != d && e += f"), [
+            ("ID", "a", 1), ("==", "<=", 1), ("ID", "b", 1), ("SHIFT", "<<", 1), ("ID", "c", 1), ("==", "!=", 1),
+            ("ID", "d", 1), ("&&", "&&", 1), ("ID", "e", 1), ("=", "+=", 1), ("ID", "f", 1),
+        ])
+
+    def test_lines(self):
+        code = "fn main ; comment\n    a = 1\n\n  ; only a comment\n\n    b = 2\n# trailing\n"
+        self.assertEqual(scan(code), [
+            ("ID", "fn", 1), ("ID", "main", 1), ("NEWLINE", 4, 2), ("ID", "a", 2), ("=", "=", 2), ("NUM", 1, 2),
+            ("NEWLINE", 4, 6), ("ID", "b", 6), ("=", "=", 6), ("NUM", 2, 6), ("NEWLINE", 0, 7),
+        ])
+        self.assertEqual(scan("a\r\n  b\r\n"), [("ID", "a", 1), ("NEWLINE", 2, 2), ("ID", "b", 2)])
+
+    def test_string(self):
+        self.assertEqual(scan(r'"a\x41\"b" x'), [("STRING", 'aA"b', 1), ("ID", "x", 1)])
+        self.assertEqual(scan('"open'), [("STRING", "open", 1)])
+        with self.assertRaises(CompileException):
+            scan(r'"\xZZ"')
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+from compiler import stdlib
+from compiler.stdlib import stdlib_objects
+from .util import compile_and_run, compiler_with
+
+
+class TestStdlib(unittest.TestCase):
+    def test_fresh_objects(self):
+        a = stdlib_objects()
+        b = stdlib_objects()
+        self.assertTrue(any("STD_START" in obj.labels for obj in a))
+        self.assertIsNot(a[0].sections[0], b[0].sections[0])
+        self.assertEqual(a[0].sections[0].data, b[0].sections[0].data)
+
+    def test_cache_dir(self):
+        saved = dict(stdlib._objects)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                stdlib._objects.clear()
+                compiler_with("fn main\n    pass\n", cache_dir=directory).build()
+                sources = [name for name in os.listdir(stdlib.STDLIB_PATH) if name.endswith(".asm")]
+                objects = [name for name in os.listdir(directory) if name.endswith(".obj")]
+                self.assertEqual(len(objects), len(sources))
+                stdlib._objects.clear()
+                cached = stdlib_objects(directory)
+                stdlib._objects.clear()
+                self.assertEqual([obj.labels for obj in cached], [obj.labels for obj in stdlib_objects(None)])
+                self.assertFalse([name for name in os.listdir(directory) if name.endswith(".tmp")])
+        finally:
+            stdlib._objects.update(saved)
+
+    def test_other_working_directory(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as path:
+            os.chdir(path)
+            try:
+                res = compile_and_run("""
+var x = 0
+
+fn main
+    x = 3
+""")
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(res.x, 3)
@@ -1,4 +1,4 @@
-from compiler.compiler import Compiler
+from compiler.compiler import Compiler, build_function
 from sim.testcpu import MinimalCPU
 
 
@@ -17,9 +17,19 @@ class Result:
         return None
 
 
-def compile_and_run(code, max_cycles=10000):
-    c = Compiler()
+def compiler_with(code, **kwargs):
+    c = Compiler(**kwargs)
     c.add_module("code", code)
+    return c
+
+
+def build_main(code, opt_level="2"):
+    """Generate the main function only, as (pseudo ops, asm code, object file, ...)."""
+    return build_function(compiler_with(code, opt_level=opt_level).main_scope, "main", opt_level)
+
+
+def compile_and_run(code, max_cycles=10000, opt_level="2"):
+    c = compiler_with(code, opt_level=opt_level)
     c.dump_ast()
     rom, symbols = c.build(print_asm_code=True, print_pseudo_code=True)
     cpu = MinimalCPU(rom)